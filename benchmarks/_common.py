@@ -0,0 +1,124 @@
+"""Shared helpers for the benchmark scripts.
+
+The tool is a single file whose name is not a valid module name, so the
+benchmarks load it through importlib instead of a plain import.
+"""
+
+import importlib.util
+import math
+import os
+import random
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOOL_PATH = os.path.join(ROOT, 'xsukax-Directory-Tree-Comparator.py')
+
+
+def load_tool():
+    """Import xsukax-Directory-Tree-Comparator.py as the module 'dtc'."""
+    if 'dtc' in sys.modules:
+        return sys.modules['dtc']
+    spec = importlib.util.spec_from_file_location('dtc', TOOL_PATH)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['dtc'] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def format_rate(num_bytes, seconds):
+    """Format a throughput in MiB/s."""
+    if seconds <= 0:
+        return 'n/a'
+    return f'{num_bytes / seconds / (1024 * 1024):,.1f} MiB/s'
+
+
+def make_tree(root, files, fanout=10, files_per_dir=100, size=0):
+    """Create a synthetic tree of empty (or size-byte) files.
+
+    Directories are filled breadth-first with files_per_dir files each and
+    fanout subdirectories, until the requested number of files exists.
+    Returns the number of directories created.
+    """
+    payload = b'x' * size
+    os.makedirs(root, exist_ok=True)
+    queue = [root]
+    created = 0
+    directories = 1
+    while created < files:
+        directory = queue.pop(0)
+        for i in range(min(files_per_dir, files - created)):
+            with open(os.path.join(directory, f'f{i:04d}.dat'), 'wb') as f:
+                f.write(payload)
+            created += 1
+        for i in range(fanout):
+            sub = os.path.join(directory, f'd{i:03d}')
+            os.mkdir(sub)
+            queue.append(sub)
+            directories += 1
+    return directories
+
+
+SIZE_DISTRIBUTIONS = ('fixed', 'uniform', 'lognormal')
+
+
+def draw_size(rng, distribution, size, max_size):
+    """Draw one file size: size exactly, uniform in [0, 2*size], or lognormal around size."""
+    if distribution == 'fixed':
+        return size
+    if distribution == 'uniform':
+        return rng.randint(0, 2 * size)
+    return min(max_size, int(rng.lognormvariate(math.log(max(size, 1)), 1.5)))
+
+
+def make_tree_pair(root, files, depth=3, fanout=8, size=4096, distribution='lognormal',
+                   max_size=64 * 1024 * 1024, diff_percent=1.0, seed=0):
+    """Create left/ and right/ under root, two trees that differ in a known way.
+
+    Both trees get the same folders: every folder down to depth levels has
+    fanout subfolders, and the files are spread round-robin over all of
+    them. File sizes come from draw_size. diff_percent of the files differ:
+    half keep their size but change one byte on the right (so only their
+    content tells them apart), a quarter exist only on the left and a
+    quarter only on the right. The same seed gives the same trees.
+    Returns (left, right, summary dict).
+    """
+    rng = random.Random(seed)
+    left, right = os.path.join(root, 'left'), os.path.join(root, 'right')
+    folders = ['']
+    level = ['']
+    for _ in range(depth):
+        level = [os.path.join(parent, f'd{i:03d}') for parent in level for i in range(fanout)]
+        folders.extend(level)
+    for side in (left, right):
+        for folder in folders:
+            os.makedirs(os.path.join(side, folder), exist_ok=True)
+
+    block = bytes(rng.getrandbits(8) for _ in range(65536))
+    changed = int(files * diff_percent / 100)
+    kinds = ['content'] * (changed - 2 * (changed // 4)) + ['left'] * (changed // 4) + ['right'] * (changed // 4)
+    kinds += ['same'] * (files - len(kinds))
+    rng.shuffle(kinds)
+    summary = {'files': files, 'folders': len(folders), 'bytes': 0,
+               'content': 0, 'left_only': 0, 'right_only': 0}
+    for i, kind in enumerate(kinds):
+        name = os.path.join(folders[i % len(folders)], f'f{i:07d}.dat')
+        file_size = draw_size(rng, distribution, size, max_size)
+        if kind == 'content':
+            file_size = max(file_size, 1)
+        offset = rng.randrange(len(block))
+        payload = (block[offset:] + block * (file_size // len(block) + 1))[:file_size]
+        summary['bytes'] += file_size
+        if kind != 'right':
+            with open(os.path.join(left, name), 'wb') as f:
+                f.write(payload)
+        if kind != 'left':
+            if kind == 'content':
+                position = rng.randrange(file_size)
+                payload = payload[:position] + bytes([payload[position] ^ 0xff]) + payload[position + 1:]
+            with open(os.path.join(right, name), 'wb') as f:
+                f.write(payload)
+        if kind == 'content':
+            summary['content'] += 1
+        elif kind != 'same':
+            summary[f'{kind}_only'] += 1
+    return left, right, summary
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""Compare hashing throughput of every registered algorithm on the HashEngine path.
+
+Usage:
+    python benchmarks/bench_algorithms.py [--files N] [--size BYTES] [--workers N]
+
+xxh3 and BLAKE3 are only listed when the xxhash / blake3 packages are
+installed. Files are hashed right after being written, so they are served
+from the page cache and the numbers measure hashing speed, not disk speed.
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from _common import format_rate, load_tool
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=16)
+    parser.add_argument('--size', type=int, default=32 * 1024 * 1024)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    dtc = load_tool()
+    tmp = tempfile.mkdtemp(prefix='dtc-alg-')
+    try:
+        block = os.urandom(1024 * 1024)
+        paths = []
+        for i in range(args.files):
+            path = os.path.join(tmp, f'f{i}.bin')
+            with open(path, 'wb') as f:
+                for _ in range(max(1, args.size // len(block))):
+                    f.write(block)
+            paths.append(path)
+
+        print(f'{len(paths)} files x {args.size} bytes, {args.workers} worker(s), best of {args.repeat}')
+        print(f'{"algorithm":<12}{"seconds":>10}{"throughput":>16}')
+        for algorithm in sorted(dtc.HASH_ALGORITHMS):
+            best = None
+            for _ in range(args.repeat):
+                with dtc.HashEngine(workers=args.workers, algorithm=algorithm) as engine:
+                    start = time.perf_counter()
+                    engine.hash_paths(paths)
+                    elapsed = time.perf_counter() - start
+                if best is None or elapsed < best:
+                    best, total = elapsed, engine.stats['bytes_read']
+            print(f'{algorithm:<12}{best:>10.3f}{format_rate(total, best):>16}')
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
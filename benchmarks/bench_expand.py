@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""Measure the paged tree API against downloading the whole result.
+
+Usage:
+    python benchmarks/bench_expand.py [--files N] [--expands N] [--page-size N]
+
+Two synthetic trees are generated, a few files are changed on one side,
+and the pair is compared as a job through Flask's test client. The script
+then reports the size and time of fetching the full /jobs/<id>/result (what
+the page used to download and render at once) and of single folder expands
+through /jobs/<id>/children, with p50/p99 latency over random folders.
+"""
+
+import argparse
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import time
+
+from _common import load_tool, make_tree
+
+
+def timed_get(client, url, **params):
+    """Return (response, seconds) for one GET."""
+    start = time.perf_counter()
+    response = client.get(url, query_string=params)
+    return response, time.perf_counter() - start
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=100000)
+    parser.add_argument('--expands', type=int, default=200)
+    parser.add_argument('--page-size', type=int, default=500)
+    args = parser.parse_args()
+
+    dtc = load_tool()
+    tmp = tempfile.mkdtemp(prefix='dtc-expand-')
+    try:
+        dir1, dir2 = os.path.join(tmp, 'left'), os.path.join(tmp, 'right')
+        print(f'Generating 2 x {args.files} files...')
+        make_tree(dir1, args.files, size=16)
+        make_tree(dir2, args.files, size=16)
+        with open(os.path.join(dir2, 'f0000.dat'), 'wb') as f:
+            f.write(b'changed content!')
+
+        client = dtc.app.test_client()
+        start = time.perf_counter()
+        job_id = client.post('/jobs', json={'dir1': dir1, 'dir2': dir2}).get_json()['id']
+        while client.get(f'/jobs/{job_id}').get_json()['state'] in ('queued', 'running'):
+            time.sleep(0.05)
+        print(f'comparison job: {time.perf_counter() - start:.2f} s')
+
+        response, seconds = timed_get(client, f'/jobs/{job_id}/result')
+        print(f'full result:  {len(response.data) / 2**20:8.2f} MiB  {seconds * 1000:8.1f} ms')
+
+        index = dtc.get_job_store().get(job_id).index
+        folders = [rel for rel, (folder1, folder2) in index.folders.items() if (folder1 or folder2).children]
+        sample = random.Random(0).sample(folders, min(args.expands, len(folders)))
+        sizes, latencies = [], []
+        for rel in sample:
+            response, seconds = timed_get(client, f'/jobs/{job_id}/children', path=rel, limit=args.page_size)
+            sizes.append(len(response.data))
+            latencies.append(seconds)
+        print(f'expand (n={len(sample)}): {statistics.mean(sizes) / 1024:8.1f} KiB avg  '
+              f'p50 {percentile(latencies, 0.5) * 1000:.2f} ms  p99 {percentile(latencies, 0.99) * 1000:.2f} ms')
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""Measure HashEngine throughput against worker count and executor type.
+
+Usage:
+    python benchmarks/bench_hashing.py [--files N] [--size BYTES] [--dir PATH]
+
+Without --dir a temporary set of random files is generated. Files written
+just before the run are usually still in the page cache, so the numbers
+reflect hashing speed more than disk speed; point --dir at a cold dataset
+to measure storage throughput.
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from _common import format_rate, load_tool
+
+
+def make_files(directory, count, size):
+    paths = []
+    block = os.urandom(min(size, 1024 * 1024))
+    for i in range(count):
+        path = os.path.join(directory, f'file_{i:05d}.bin')
+        with open(path, 'wb') as f:
+            remaining = size
+            while remaining > 0:
+                f.write(block[:remaining])
+                remaining -= len(block)
+        paths.append(path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=64)
+    parser.add_argument('--size', type=int, default=8 * 1024 * 1024)
+    parser.add_argument('--dir', help='hash the files of an existing directory instead')
+    parser.add_argument('--workers', default='1,2,4,8,16')
+    parser.add_argument('--buffer-size', type=int, default=1024 * 1024)
+    args = parser.parse_args()
+
+    dtc = load_tool()
+    tmp = None
+    if args.dir:
+        paths = [os.path.join(args.dir, n) for n in sorted(os.listdir(args.dir))
+                 if os.path.isfile(os.path.join(args.dir, n))]
+    else:
+        tmp = tempfile.mkdtemp(prefix='dtc-bench-')
+        paths = make_files(tmp, args.files, args.size)
+
+    try:
+        print(f'{len(paths)} files, buffer {args.buffer_size} bytes, {os.cpu_count()} CPUs')
+        print(f'{"executor":<10}{"workers":>8}{"seconds":>10}{"throughput":>16}')
+        for executor in dtc.EXECUTORS:
+            for workers in (int(w) for w in args.workers.split(',')):
+                with dtc.HashEngine(workers=workers, executor=executor,
+                                    buffer_size=args.buffer_size) as engine:
+                    start = time.perf_counter()
+                    engine.hash_paths(paths)
+                    elapsed = time.perf_counter() - start
+                print(f'{executor:<10}{workers:>8}{elapsed:>10.3f}'
+                      f'{format_rate(engine.stats["bytes_read"], elapsed):>16}')
+    finally:
+        if tmp:
+            shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
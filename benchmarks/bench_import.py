@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""Measure how long loading the tool takes, using python -X importtime.
+
+Usage:
+    python benchmarks/bench_import.py [--runs N] [--app] [--max-ms MS]
+
+Each run starts a fresh interpreter with -X importtime, loads the tool and
+reports the wall time of the load and the modules it imported, slowest
+first. With --app the Flask application is created too, which is what
+starting the web interface costs. The script exits with status 1 when
+Flask or tkinter are imported by a plain load (the command line mode must
+work without them), or when the median load time exceeds --max-ms, so it
+can guard against regressions.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+MARKER = '--- loading tool ---'
+FORBIDDEN = ('flask', 'tkinter')
+
+CHILD = f'''
+import sys, time
+sys.path.insert(0, {BENCH_DIR!r})
+from _common import load_tool
+print({MARKER!r}, file=sys.stderr, flush=True)
+start = time.perf_counter()
+dtc = load_tool()
+if {{app}}:
+    dtc.get_app()
+print((time.perf_counter() - start) * 1000)
+'''
+
+
+def run_once(create_app):
+    """Return (load time in ms, [(cumulative us, self us, module)] of top-level imports)."""
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', CHILD.format(app=create_app)],
+                               capture_output=True, text=True, check=True)
+    imports = []
+    seen_marker = False
+    for line in completed.stderr.splitlines():
+        if line == MARKER:
+            seen_marker = True
+            continue
+        if not seen_marker or not line.startswith('import time:'):
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        if self_us.strip() == 'self [us]':
+            continue
+        # Nested imports are indented; only count the ones the tool triggers directly.
+        if not name.startswith('  ', 1):
+            imports.append((int(cumulative_us), int(self_us), name.strip()))
+    return float(completed.stdout.strip().splitlines()[-1]), imports
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--app', action='store_true', help='also create the Flask application')
+    parser.add_argument('--top', type=int, default=10, help='number of imports to list')
+    parser.add_argument('--max-ms', type=float, help='fail when the median load time is above this')
+    args = parser.parse_args()
+
+    times = []
+    imports = []
+    for _ in range(args.runs):
+        elapsed, imports = run_once(args.app)
+        times.append(elapsed)
+    median = statistics.median(times)
+
+    print(f'load{" + create_app" if args.app else ""}: median {median:.1f} ms, '
+          f'min {min(times):.1f} ms over {args.runs} runs')
+    print(f'{len(imports)} top-level imports, slowest (last run):')
+    print(f'{"cumulative ms":>14}{"self ms":>9}  module')
+    for cumulative, self_time, name in sorted(imports, reverse=True)[:args.top]:
+        print(f'{cumulative / 1000:>14.1f}{self_time / 1000:>9.1f}  {name}')
+
+    failed = False
+    loaded = {name.split('.')[0] for _, _, name in imports}
+    if not args.app:
+        for name in FORBIDDEN:
+            if name in loaded:
+                print(f'FAIL: {name} is imported when the tool is loaded')
+                failed = True
+    if args.max_ms is not None and median > args.max_ms:
+        print(f'FAIL: median load time {median:.1f} ms is above {args.max_ms:.1f} ms')
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""Measure request latency while a large comparison runs.
+
+Usage:
+    python benchmarks/bench_load.py [--url URL | --production] [--files N]
+        [--clients N] [--duration SECONDS] [--output results.json]
+
+Without --url a server is started in a child process on a free port (with
+--production, the waitress server). A large synthetic tree pair is
+compared as a job, and while it runs --clients threads keep requesting the
+page (GET /) and small comparisons (POST /compare with refresh, so the
+result cache does not answer them). The script reports p50/p99 latency and
+status codes per endpoint, and how long the large job took.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from _common import TOOL_PATH, make_tree, make_tree_pair
+
+
+def request(url, body=None):
+    """Return (status, seconds) for one request; body is sent as JSON."""
+    data = json.dumps(body).encode('utf-8') if body is not None else None
+    req = urllib.request.Request(url, data=data, headers={'Content-Type': 'application/json'} if data else {})
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=300) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        e.read()
+        status = e.code
+    except OSError:
+        status = None
+    return status, time.perf_counter() - start
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def start_server(production):
+    """Start the tool on a free port; return (process, base URL)."""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    command = [sys.executable, TOOL_PATH, 'serve', '--port', str(port), '--no-debug']
+    if production:
+        command.append('--production')
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            sys.exit(f'server exited with status {process.returncode}')
+        if request(url + '/')[0] == 200:
+            return process, url
+        time.sleep(0.2)
+    process.kill()
+    sys.exit('server did not start')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', help='use a running server instead of starting one')
+    parser.add_argument('--production', action='store_true', help='start the server with --production')
+    parser.add_argument('--files', type=int, default=200000, help='files per side of the large comparison')
+    parser.add_argument('--small-files', type=int, default=50)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=20, help='seconds of load, at most')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='dtc-load-')
+    process = None
+    try:
+        print(f'Generating 2 x {args.files} files...')
+        left, right, _ = make_tree_pair(os.path.join(tmp, 'large'), args.files, size=1024)
+        small = os.path.join(tmp, 'small')
+        make_tree(small, args.small_files, size=64)
+        if args.url:
+            url = args.url.rstrip('/')
+        else:
+            process, url = start_server(args.production)
+
+        body = json.dumps({'dir1': left, 'dir2': right, 'hash_mode': 'eager', 'refresh': True}).encode('utf-8')
+        with urllib.request.urlopen(urllib.request.Request(
+                url + '/jobs', data=body, headers={'Content-Type': 'application/json'})) as response:
+            job_id = json.load(response)['id']
+        started = time.perf_counter()
+
+        results = {'page': [], 'compare': []}
+        statuses = {'page': {}, 'compare': {}}
+        stop = threading.Event()
+        lock = threading.Lock()
+
+        def client():
+            small_body = {'dir1': small, 'dir2': small, 'refresh': True}
+            while not stop.is_set():
+                for name, target, body in (('page', url + '/', None), ('compare', url + '/compare', small_body)):
+                    status, seconds = request(target, body)
+                    with lock:
+                        statuses[name][str(status)] = statuses[name].get(str(status), 0) + 1
+                        if status == 200:
+                            results[name].append(seconds)
+
+        threads = [threading.Thread(target=client, daemon=True) for _ in range(args.clients)]
+        for thread in threads:
+            thread.start()
+        deadline = time.perf_counter() + args.duration
+        large_seconds = None
+        while time.perf_counter() < deadline:
+            with urllib.request.urlopen(f'{url}/jobs/{job_id}') as response:
+                state = json.load(response)['state']
+            if state not in ('queued', 'running'):
+                large_seconds = time.perf_counter() - started
+                break
+            time.sleep(0.2)
+        stop.set()
+        for thread in threads:
+            thread.join()
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+        shutil.rmtree(tmp)
+
+    report = {'clients': args.clients, 'files': args.files, 'large_seconds': large_seconds, 'endpoints': {}}
+    print(f'large comparison: {f"{large_seconds:.1f} s" if large_seconds else "still running at the end"}')
+    print(f'{"endpoint":<10}{"requests":>10}{"p50 ms":>10}{"p99 ms":>10}{"max ms":>10}  statuses')
+    for name, latencies in results.items():
+        entry = {'statuses': statuses[name], 'requests': len(latencies)}
+        if latencies:
+            entry.update(p50=percentile(latencies, 0.5), p99=percentile(latencies, 0.99),
+                         max=max(latencies), mean=statistics.mean(latencies))
+            print(f'{name:<10}{len(latencies):>10}{entry["p50"] * 1000:>10.1f}{entry["p99"] * 1000:>10.1f}'
+                  f'{entry["max"] * 1000:>10.1f}  {statuses[name]}')
+        else:
+            print(f'{name:<10}{0:>10}  {statuses[name]}')
+        report['endpoints'][name] = entry
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
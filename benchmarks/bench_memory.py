@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""Measure the memory held by a scanned tree, Node objects vs per-node dicts.
+
+Usage:
+    python benchmarks/bench_memory.py [--files N] [--dir PATH] [--hash]
+
+Without --dir a synthetic tree is generated. The script walks it with
+_build_node and reports the tracemalloc size of the resulting Node tree,
+then the size of the same tree converted by node_to_dict, which is the
+per-node dict layout the walker used to build (full path string, hex
+digest and one dict per entry). Pass --hash to include digests.
+"""
+
+import argparse
+import gc
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+from _common import load_tool, make_tree
+
+
+def measure(func, *args):
+    """Return (result, bytes still allocated by it, peak bytes, seconds)."""
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, current, peak, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=100000)
+    parser.add_argument('--dir', help='walk an existing directory instead')
+    parser.add_argument('--hash', action='store_true', help='hash every file before measuring')
+    args = parser.parse_args()
+
+    dtc = load_tool()
+    tmp = None
+    root = args.dir
+    if not root:
+        tmp = tempfile.mkdtemp(prefix='dtc-memory-')
+        root = os.path.join(tmp, 'tree')
+        print(f'Generating {args.files} files...')
+        make_tree(root, args.files, size=16 if args.hash else 0)
+
+    try:
+        def walk(path):
+            return dtc.build_tree(path, compute_hash=args.hash)
+
+        tree, node_bytes, node_peak, elapsed = measure(walk, root)
+        entries = sum(1 for _ in dtc.iter_nodes(tree))
+        as_dict, dict_bytes, dict_peak, _ = measure(dtc.node_to_dict, tree)
+
+        print(f'{entries} entries, walk took {elapsed:.2f} s')
+        print(f'{"layout":<8}{"retained MiB":>14}{"peak MiB":>10}{"bytes/entry":>13}')
+        for name, retained, peak in (('Node', node_bytes, node_peak), ('dict', dict_bytes, dict_peak)):
+            print(f'{name:<8}{retained / 2**20:>14.1f}{peak / 2**20:>10.1f}{retained / entries:>13.0f}')
+        print(f'dict/Node: {dict_bytes / node_bytes:.2f}x')
+        del as_dict
+    finally:
+        if tmp:
+            shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""Time each stage of the comparison pipeline on a synthetic tree pair.
+
+Usage:
+    python benchmarks/bench_pipeline.py [--files N] [--depth N] [--fanout N]
+        [--size BYTES] [--distribution fixed|uniform|lognormal]
+        [--diff-percent P] [--seed N] [--repeat N] [--trees DIR]
+        [--output results.json] [--baseline old.json]
+
+A pair of trees is generated with make_tree_pair (or reused from --trees
+when it already holds left/ and right/), then every repetition runs the
+stages in order, each on the output of the one before:
+
+    walk       list both trees without stat()ing files (os.scandir only)
+    stat       get_file_info(compute_hash=False) on every file
+    build      build_tree_pair, the real walk + stat, no hashing
+    hash       HashEngine.hash_nodes on every file of both trees
+    merge      compare_nodes on the hashed trees
+    serialise  result_to_json + json.dumps of the /compare response
+
+Where the platform has FIFOs, one named pipe is added at the same path in
+both trees. A walker or hasher that opens it would hang, and the script
+fails unless the pipe comes out of the merge as 'same' with no digest.
+
+For each stage the script reports the median and minimum wall time and
+the process peak RSS once the stage has finished (a high-water mark, so
+it only grows and includes generating the trees when that happens in the
+same run; pass --trees to keep the trees and measure on a second run).
+Everything, including the generator parameters, Python
+version and git commit, is written to --output as JSON. --baseline
+prints the ratio of each median against an earlier results file.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from _common import ROOT, SIZE_DISTRIBUTIONS, load_tool, make_tree_pair
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+STAGES = ('walk', 'stat', 'build', 'hash', 'merge', 'serialise')
+FIFO_NAME = 'pipe.fifo'
+
+
+def peak_rss():
+    """Return the peak resident set size of this process in bytes, if known."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def list_only(root):
+    """Walk a tree with os.scandir, using only the types from the listing."""
+    files = []
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                else:
+                    files.append(entry.path)
+    return files
+
+
+def run_once(dtc, left, right, workers):
+    """Run every stage once; return ({stage: seconds}, {stage: peak RSS}, output bytes)."""
+    times = {}
+    rss = {}
+
+    def stage(name, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        times[name] = time.perf_counter() - start
+        rss[name] = peak_rss()
+        return result
+
+    paths = stage('walk', lambda: list_only(left) + list_only(right))
+    stage('stat', lambda: [dtc.get_file_info(path, compute_hash=False) for path in paths])
+    with dtc.HashEngine(workers=workers) as engine:
+        tree1, tree2 = stage('build', dtc.build_tree_pair, left, right, False, engine)
+        stage('hash', engine.hash_nodes, itertools.chain(dtc.iter_files(tree1), dtc.iter_files(tree2)))
+        stage('merge', dtc.compare_nodes, tree1, tree2, engine)
+        for node in itertools.chain(dtc.iter_files(tree1), dtc.iter_files(tree2)):
+            if node.special and (node.status != 'same' or node.digest is not None):
+                sys.exit(f'FAIL: {node.path} is {node.status} with digest {node.digest!r}')
+        result = {'dir1': left, 'dir2': right, 'tree1': tree1, 'tree2': tree2,
+                  'algorithm': engine.algorithm, 'stats': engine.stats}
+        body = stage('serialise', lambda: json.dumps(dtc.result_to_json(result), ensure_ascii=False))
+    return times, rss, len(body.encode('utf-8'))
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', '-C', ROOT, 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=100000)
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--fanout', type=int, default=8)
+    parser.add_argument('--size', type=int, default=4096, help='typical file size in bytes')
+    parser.add_argument('--distribution', choices=SIZE_DISTRIBUTIONS, default='lognormal')
+    parser.add_argument('--max-size', type=int, default=64 * 1024 * 1024)
+    parser.add_argument('--diff-percent', type=float, default=1.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--workers', type=int, help='hashing workers (default: the engine default)')
+    parser.add_argument('--trees', help='generate the trees here and keep them (reused when present)')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare the medians with an earlier results file')
+    args = parser.parse_args()
+
+    dtc = load_tool()
+    params = {key: getattr(args, key) for key in
+              ('files', 'depth', 'fanout', 'size', 'distribution', 'max_size', 'diff_percent', 'seed')}
+    root = args.trees or tempfile.mkdtemp(prefix='dtc-pipeline-')
+    left, right = os.path.join(root, 'left'), os.path.join(root, 'right')
+    try:
+        generated = None
+        if not (os.path.isdir(left) and os.path.isdir(right)):
+            print(f'Generating 2 x {args.files} files...')
+            start = time.perf_counter()
+            left, right, generated = make_tree_pair(root, args.files, args.depth, args.fanout, args.size,
+                                                    args.distribution, args.max_size, args.diff_percent,
+                                                    args.seed)
+            print(f'  {generated["folders"]} folders, {generated["bytes"] / 2**20:.1f} MiB per side, '
+                  f'{time.perf_counter() - start:.1f} s')
+
+        if hasattr(os, 'mkfifo'):
+            for side in (left, right):
+                if not os.path.exists(os.path.join(side, FIFO_NAME)):
+                    os.mkfifo(os.path.join(side, FIFO_NAME))
+
+        runs = [run_once(dtc, left, right, args.workers) for _ in range(args.repeat)]
+    finally:
+        if not args.trees:
+            shutil.rmtree(root)
+
+    stages = {}
+    for name in STAGES:
+        seconds = [times[name] for times, _, _ in runs]
+        stages[name] = {'median': statistics.median(seconds), 'min': min(seconds), 'runs': seconds,
+                        'peak_rss': max((rss[name] or 0) for _, rss, _ in runs) or None}
+    results = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'created': time.time(),
+        'params': params,
+        'generated': generated,
+        'output_bytes': runs[-1][2],
+        'stages': stages,
+    }
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)['stages']
+
+    print(f'{"stage":<11}{"median s":>10}{"min s":>10}{"peak RSS MiB":>14}' + ('  vs baseline' if baseline else ''))
+    for name, stage in stages.items():
+        line = f'{name:<11}{stage["median"]:>10.3f}{stage["min"]:>10.3f}'
+        line += f'{stage["peak_rss"] / 2**20:>14.1f}' if stage['peak_rss'] else f'{"n/a":>14}'
+        if baseline and name in baseline and baseline[name]['median']:
+            line += f'  {stage["median"] / baseline[name]["median"]:.2f}x'
+        print(line)
+    print(f'serialised result: {results["output_bytes"] / 2**20:.1f} MiB')
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print(f'Results written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
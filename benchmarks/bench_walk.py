@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""Compare the os.scandir walker with the previous os.listdir/os.stat walk.
+
+Usage:
+    python benchmarks/bench_walk.py [--files N] [--dir PATH]
+
+Without --dir a synthetic tree is generated (use --files 1000000 for the
+full-size run; generation alone takes a few minutes). For each walker the
+script reports wall time and the stat and listing calls made from Python,
+including the per-file DirEntry.stat() calls of the scandir walker (a
+cached repeat is not counted, since it makes no system call). The real
+syscall count of each walker, measured in a fresh subprocess, needs strace;
+without it the script says so instead of printing a number.
+"""
+
+import argparse
+import collections
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from _common import load_tool, make_tree
+
+
+def legacy_walk(root_path, get_file_info):
+    """The recursive walker build_tree used before the scandir rewrite."""
+    if not os.path.exists(root_path):
+        return None
+    path_obj = Path(root_path)
+    name = path_obj.name if path_obj.name else str(path_obj)
+    node = {'name': name, 'type': 'folder' if os.path.isdir(root_path) else 'file', 'path': str(root_path)}
+    if os.path.isdir(root_path):
+        node['children'] = []
+        for entry in sorted(os.listdir(root_path)):
+            child = legacy_walk(os.path.join(root_path, entry), get_file_info)
+            if child:
+                node['children'].append(child)
+    else:
+        info = get_file_info(root_path, compute_hash=False)
+        if info:
+            node.update(info)
+    return node
+
+
+class CountedEntry:
+    """A DirEntry proxy that counts the stat() calls which reach the OS."""
+
+    def __init__(self, entry, counts):
+        self._entry = entry
+        self._counts = counts
+        self._statted = set()
+
+    def __getattr__(self, name):
+        return getattr(self._entry, name)
+
+    def stat(self, *, follow_symlinks=True):
+        if follow_symlinks not in self._statted:
+            self._statted.add(follow_symlinks)
+            self._counts['DirEntry.stat'] += 1
+        return self._entry.stat(follow_symlinks=follow_symlinks)
+
+
+class CountedScandir:
+    """An os.scandir iterator that yields CountedEntry objects."""
+
+    def __init__(self, iterator, counts):
+        self._iterator = iterator
+        self._counts = counts
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._iterator.close()
+
+    def __iter__(self):
+        return (CountedEntry(entry, self._counts) for entry in self._iterator)
+
+    def close(self):
+        self._iterator.close()
+
+
+def count_os_calls(func, *args):
+    """Run func while counting os.stat, os.listdir, os.scandir and DirEntry.stat calls."""
+    counts = collections.Counter()
+    originals = {name: getattr(os, name) for name in ('stat', 'lstat', 'listdir', 'scandir')}
+
+    def wrap(name, original):
+        def counted(*a, **kw):
+            counts[name] += 1
+            if name == 'scandir':
+                return CountedScandir(original(*a, **kw), counts)
+            return original(*a, **kw)
+        return counted
+
+    for name, original in originals.items():
+        setattr(os, name, wrap(name, original))
+    try:
+        start = time.perf_counter()
+        func(*args)
+        elapsed = time.perf_counter() - start
+    finally:
+        for name, original in originals.items():
+            setattr(os, name, original)
+    return elapsed, counts
+
+
+def strace_count(walker, root):
+    """Return the total syscall count of one walker run, via strace -c."""
+    out = subprocess.run(
+        ['strace', '-f', '-c', '-o', '/dev/stdout', sys.executable, __file__,
+         '--dir', root, '--only', walker],
+        capture_output=True, text=True).stdout
+    for line in out.splitlines():
+        if line.rstrip().endswith('total'):
+            return int(line.split()[2])
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=100000)
+    parser.add_argument('--dir', help='walk an existing directory instead')
+    parser.add_argument('--only', choices=('legacy', 'scandir'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    dtc = load_tool()
+    walkers = {
+        'legacy': lambda root: legacy_walk(root, dtc.get_file_info),
+        'scandir': dtc._build_node,
+    }
+    if args.only:
+        sys.setrecursionlimit(100000)
+        walkers[args.only](args.dir)
+        return
+
+    tmp = None
+    root = args.dir
+    if not root:
+        tmp = tempfile.mkdtemp(prefix='dtc-walk-')
+        root = os.path.join(tmp, 'tree')
+        print(f'Generating {args.files} files...')
+        make_tree(root, args.files)
+
+    try:
+        print(f'{"walker":<10}{"seconds":>10}  stat and listing calls')
+        for name, walker in walkers.items():
+            elapsed, counts = count_os_calls(walker, root)
+            calls = ', '.join(f'{k}={v}' for k, v in sorted(counts.items()))
+            print(f'{name:<10}{elapsed:>10.3f}  {calls} (total {sum(counts.values())})')
+        if shutil.which('strace'):
+            for name in walkers:
+                print(f'{name:<10} syscalls: {strace_count(name, root)}')
+        else:
+            print('syscalls: not measured, strace is not installed')
+    finally:
+        if tmp:
+            shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
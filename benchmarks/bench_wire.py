@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""Measure the size and encode time of comparison results in each wire format.
+
+Usage:
+    python benchmarks/bench_wire.py [--files N] [--diff-percent P]
+        [--differences-only] [--runs N] [--output results.json]
+
+A pair of trees is generated with make_tree_pair and compared as a job
+through Flask's test client. The finished result is then fetched from
+/jobs/<id>/result in every combination of format (json, compact), media
+type (JSON, and MessagePack when msgpack is installed) and content
+encoding (none, gzip, and zstd when zstandard is installed). For each the
+script reports the payload size, its ratio to plain JSON (what jsonify
+sent before) and the median time of the request. The compact response is
+expanded back to trees and checked against the plain one.
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+from _common import load_tool, make_tree_pair
+
+# Fields of the plain result that the compact format leaves out.
+DROPPED_FIELDS = ('children', 'mtime_ns', 'device', 'inode', 'file_count', 'sample')
+
+
+def expand_compact(data):
+    """Rebuild {path: node fields} for both trees of a compact result."""
+    strings = []
+    for prefix, suffix in zip(data['string_prefixes'], data['strings']):
+        previous = strings[-1].encode('utf-16-le', 'surrogatepass')[:prefix * 2] if strings else b''
+        strings.append(previous.decode('utf-16-le', 'surrogatepass') + suffix)
+    trees = ({}, {})
+    paths = ({}, {})
+    for index, (parent, name, status, decided_by, first_difference, *sides, rollup) in enumerate(data['rows']):
+        for flat, side_paths, root, side in zip(trees, paths, data['roots'], sides):
+            if side is None:
+                continue
+            if parent < 0:
+                node = {'name': root[0], 'path': root[1]}
+            else:
+                node = {'name': strings[name], 'path': side_paths[parent] + data['separator'] + strings[name]}
+            for field, value in zip(data['side_fields'], side):
+                if value is not None:
+                    node[field] = data['types'][value] if field == 'type' else value
+            if status is not None:
+                node['status'] = data['statuses'][status]
+            if decided_by is not None:
+                node['decided_by'] = strings[decided_by]
+            if first_difference is not None:
+                node['first_difference'] = first_difference
+            if rollup is not None and node['type'] == 'folder':
+                node['rollup'] = dict(zip(data['rollup_fields'], rollup))
+            side_paths[index] = node['path']
+            flat[node['path']] = node
+    return trees
+
+
+def flatten_plain(tree):
+    """Return {path: node fields} of a plain result tree, minus what compact drops."""
+    flat = {}
+    stack = [tree] if tree else []
+    while stack:
+        node = stack.pop()
+        stack.extend(node.get('children') or ())
+        flat[node['path']] = {key: value for key, value in node.items() if key not in DROPPED_FIELDS}
+    return flat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=100000)
+    parser.add_argument('--diff-percent', type=float, default=1.0)
+    parser.add_argument('--differences-only', action='store_true')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--output', help='write the results as JSON')
+    args = parser.parse_args()
+
+    dtc = load_tool()
+    media_types = [('json', 'application/json')]
+    if importlib.util.find_spec('msgpack'):
+        media_types.append(('msgpack', 'application/msgpack'))
+    encodings = ['identity', 'gzip']
+    if importlib.util.find_spec('zstandard'):
+        encodings.append('zstd')
+
+    tmp = tempfile.mkdtemp(prefix='dtc-wire-')
+    try:
+        print(f'Generating 2 x {args.files} files...')
+        make_tree_pair(tmp, args.files, size=64, distribution='fixed', diff_percent=args.diff_percent)
+        client = dtc.get_app().test_client()
+        body = {'dir1': os.path.join(tmp, 'left'), 'dir2': os.path.join(tmp, 'right'),
+                'hash_mode': 'eager', 'differences_only': args.differences_only, 'refresh': True}
+        job_id = client.post('/jobs', json=body).get_json()['id']
+        while client.get(f'/jobs/{job_id}').get_json()['state'] in ('queued', 'running'):
+            time.sleep(0.05)
+
+        results = []
+        responses = {}
+        for response_format in dtc.RESPONSE_FORMATS:
+            for media_name, media_type in media_types:
+                for encoding in encodings:
+                    times = []
+                    for _ in range(args.runs):
+                        start = time.perf_counter()
+                        response = client.get(f'/jobs/{job_id}/result', query_string={'format': response_format},
+                                              headers={'Accept': media_type, 'Accept-Encoding': encoding})
+                        times.append(time.perf_counter() - start)
+                    if response.status_code != 200:
+                        sys.exit(f'{response_format}/{media_name}/{encoding}: HTTP {response.status_code}')
+                    responses[response_format, media_name, encoding] = response.data
+                    results.append({'format': response_format, 'media_type': media_name, 'encoding': encoding,
+                                    'bytes': len(response.data), 'median_s': statistics.median(times)})
+
+        baseline = next(r for r in results if (r['format'], r['media_type'], r['encoding']) ==
+                        ('json', 'json', 'identity'))
+        print(f'{"format":<9}{"media":<9}{"encoding":<10}{"MiB":>9}{"vs json":>9}{"median ms":>11}')
+        for r in results:
+            print(f'{r["format"]:<9}{r["media_type"]:<9}{r["encoding"]:<10}{r["bytes"] / 2**20:>9.2f}'
+                  f'{r["bytes"] / baseline["bytes"]:>9.2f}{r["median_s"] * 1000:>11.1f}')
+
+        plain = json.loads(responses['json', 'json', 'identity'])
+        compact = json.loads(responses['compact', 'json', 'identity'])
+        expanded = expand_compact(compact)
+        for side, tree in zip(expanded, ('tree1', 'tree2')):
+            if side != flatten_plain(plain[tree]):
+                sys.exit(f'FAIL: the compact {tree} does not match the plain result')
+        print(f'compact result matches the plain one ({len(compact["rows"])} rows, '
+              f'{len(compact["strings"])} strings)')
+
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump({'files': args.files, 'diff_percent': args.diff_percent,
+                           'differences_only': args.differences_only, 'results': results}, f, indent=2)
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
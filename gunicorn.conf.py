@@ -0,0 +1,12 @@
+# gunicorn -c gunicorn.conf.py wsgi:app
+#
+# One worker process only: comparison jobs, the result cache and /metrics
+# are kept in its memory, so a second process would not see them. Requests
+# are served by threads, and comparisons run on the tool's own bounded pool
+# (see JobStore), so a long comparison holds one thread at most.
+
+bind = '127.0.0.1:5000'
+workers = 1
+worker_class = 'gthread'
+threads = 16
+graceful_timeout = 30
@@ -0,0 +1,26 @@
+"""WSGI entry point for production servers.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+    waitress-serve --threads 16 wsgi:app
+
+The tool's file name is not a valid module name, so it is loaded by path.
+Jobs, the result cache and the metrics live in the memory of one process:
+serve it from a single process with several threads. The folder dialog is
+turned off unless XSUKAX_DTC_BROWSE_DIALOG=1 is set, and requests are
+restricted as on a shared server unless XSUKAX_DTC_RESTRICTED=0 is set.
+"""
+
+import importlib.util
+import os
+import sys
+
+os.environ.setdefault('XSUKAX_DTC_BROWSE_DIALOG', '0')
+os.environ.setdefault('XSUKAX_DTC_RESTRICTED', '1')
+
+_spec = importlib.util.spec_from_file_location(
+    'xsukax_dtc', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'xsukax-Directory-Tree-Comparator.py'))
+tool = importlib.util.module_from_spec(_spec)
+sys.modules['xsukax_dtc'] = tool
+_spec.loader.exec_module(tool)
+
+app = tool.get_app()
@@ -7,12 +7,23 @@ A single-file web application for comparing two directory trees in detail.
 
 import os
 import sys
+import bisect
+import contextlib
 import hashlib
+import functools
+import gzip
+import itertools
+import stat
+import threading
+import time
+import concurrent.futures
 import json
-from datetime import datetime
-from pathlib import Path
-from flask import Flask, render_template_string, request, jsonify
-from tkinter import Tk, filedialog
+from collections import OrderedDict, deque
+
+# Modules needed by only one feature (Flask, tkinter, sqlite3, pathlib,
+# argparse, csv) are imported where they are used, so that loading this
+# file, and the command line mode in particular, stays fast and works on
+# hosts without a display. benchmarks/bench_import.py keeps track of it.
 
 # Ensure proper encoding for Windows
 if sys.platform == 'win32':
@@ -20,9 +31,6 @@ if sys.platform == 'win32':
     if sys.stdout.encoding != 'utf-8':
         sys.stdout.reconfigure(encoding='utf-8')
 
-app = Flask(__name__)
-app.config['JSON_AS_ASCII'] = False
-
 HTML_TEMPLATE = """
 <!DOCTYPE html>
 <html lang="en">
@@ -54,6 +62,8 @@ HTML_TEMPLATE = """
         button:disabled { background: #21262d; color: #484f58; cursor: not-allowed; }
         .secondary-btn { background: #21262d; color: #c9d1d9; }
         .secondary-btn:hover { background: #30363d; }
+        .option-toggle { display: flex; align-items: center; gap: 6px; font-size: 13px; font-weight: 400; color: #8b949e; cursor: pointer; }
+        .option-select { background: #0d1117; border: 1px solid #30363d; border-radius: 6px; padding: 4px 8px; color: #c9d1d9; font-size: 13px; }
         .message-bar { padding: 12px 16px; border-radius: 6px; margin-bottom: 16px; display: none; align-items: center; gap: 10px; font-size: 14px; animation: slideDown 0.3s ease; }
         @keyframes slideDown { from { opacity: 0; transform: translateY(-10px); } to { opacity: 1; transform: translateY(0); } }
         .message-bar.show { display: flex; }
@@ -72,7 +82,7 @@ HTML_TEMPLATE = """
         .legend-missing { color: #8b949e; }
         .main-content { display: grid; grid-template-columns: 2fr 1fr; gap: 20px; }
         .tree-container { display: grid; grid-template-columns: 1fr 1fr; gap: 20px; }
-        .tree-side { background: #0d1117; border: 1px solid #30363d; border-radius: 6px; padding: 16px; max-height: 70vh; overflow-y: auto; }
+        .tree-side { background: #0d1117; border: 1px solid #30363d; border-radius: 6px; padding: 16px; }
         .tree-side h3 { font-size: 16px; font-weight: 600; margin-bottom: 12px; padding-bottom: 8px; border-bottom: 1px solid #21262d; color: #f0f6fc; }
         .tree-item { padding: 2px 0; }
         .tree-item-content { display: flex; align-items: center; padding: 6px 10px; border-radius: 4px; transition: background 0.1s; cursor: pointer; user-select: none; }
@@ -80,7 +90,11 @@ HTML_TEMPLATE = """
         .tree-item-content.selected { background: #1f6feb; }
         .tree-item-icon { width: 18px; margin-right: 8px; flex-shrink: 0; font-size: 16px; }
         .tree-item-name { flex: 1; font-size: 13px; overflow: hidden; text-overflow: ellipsis; white-space: nowrap; }
-        .tree-item-children { margin-left: 24px; }
+        .tree-scroll { position: relative; height: calc(70vh - 90px); overflow-y: auto; }
+        .tree-viewport { position: relative; }
+        .tree-row { position: absolute; left: 0; right: 0; height: 30px; padding-top: 0; padding-bottom: 0; }
+        .tree-row-note { color: #8b949e; font-size: 12px; font-style: italic; }
+        .tree-item-counts { margin-left: 8px; font-size: 11px; color: #8b949e; white-space: nowrap; }
         .folder-icon::before { content: '📁'; }
         .file-icon::before { content: '📄'; }
         .expanded .folder-icon::before { content: '📂'; }
@@ -101,6 +115,14 @@ HTML_TEMPLATE = """
         .badge-same { background: #1a472a; color: #3fb950; }
         .badge-different { background: #4c1e1e; color: #f85149; }
         .badge-missing { background: #21262d; color: #8b949e; }
+        .diff-view { font-family: 'SF Mono', Monaco, Consolas, monospace; font-size: 11px; overflow-x: auto; }
+        .diff-hunk { color: #8b949e; background: #161b22; padding: 2px 6px; margin-top: 8px; }
+        .diff-table { border-collapse: collapse; width: 100%; }
+        .diff-table td { padding: 0 6px; white-space: pre; vertical-align: top; color: #c9d1d9; }
+        .diff-num { color: #6e7681 !important; text-align: right; user-select: none; }
+        .diff-del { background: #3c1618; }
+        .diff-add { background: #12361f; }
+        .diff-note { color: #8b949e; font-size: 12px; padding: 8px 0; }
         .loading { display: none; text-align: center; padding: 60px; color: #8b949e; }
         .loading.active { display: block; }
         .spinner { border: 3px solid #21262d; border-top: 3px solid #58a6ff; border-radius: 50%; width: 50px; height: 50px; animation: spin 1s linear infinite; margin: 0 auto 20px; }
@@ -147,6 +169,26 @@ HTML_TEMPLATE = """
             <div class="button-group">
                 <button onclick="compareDirectories()" id="compareBtn">🔍 Compare Directories</button>
                 <button class="secondary-btn" onclick="clearResults()">Clear Results</button>
+                <label class="option-toggle">Strategy
+                    <select class="option-select" id="strategy">
+                        <option value="full">Full hash</option>
+                        <option value="sample">Sampled blocks</option>
+                        <option value="metadata">Size + modified time</option>
+                        <option value="bytes">Byte-by-byte</option>
+                    </select>
+                </label>
+                <label class="option-toggle">Hash
+                    <select class="option-select" id="algorithm">
+                        {% for name in algorithms %}<option value="{{ name }}"{% if name == default_algorithm %} selected{% endif %}>{{ name }}</option>{% endfor %}
+                    </select>
+                </label>
+                <label class="option-toggle"><input type="checkbox" id="escalate"> Confirm differences with full hash</label>
+                <label class="option-toggle"><input type="checkbox" id="useCache"> Use persistent hash cache</label>
+                <label class="option-toggle"><input type="checkbox" id="differencesOnly" onchange="toggleDifferencesOnly()"> Differences only</label>
+                <label class="option-toggle">Exclude
+                    <input type="text" class="option-select" id="exclude" placeholder="node_modules/, .git/, *.pyc">
+                </label>
+                <label class="option-toggle"><input type="checkbox" id="gitignore"> Honour .gitignore</label>
             </div>
         </div>
 
@@ -154,7 +196,8 @@ HTML_TEMPLATE = """
             <div class="loading" id="loading">
                 <div class="spinner"></div>
                 <div style="font-size: 16px; font-weight: 500;">Analyzing directories...</div>
-                <div style="font-size: 13px; margin-top: 8px; opacity: 0.7;">This may take a moment for large directories</div>
+                <div id="loading-progress" style="font-size: 13px; margin-top: 8px; opacity: 0.7;">This may take a moment for large directories</div>
+                <button class="secondary-btn" id="cancelBtn" onclick="cancelComparison()" style="margin-top: 16px;">Cancel</button>
             </div>
             
             <div id="results" style="display: none;">
@@ -171,6 +214,7 @@ HTML_TEMPLATE = """
                         <div class="legend-dot"></div>
                         <span>Missing</span>
                     </div>
+                    <button class="secondary-btn" onclick="exportResult()">⬇ Export JSON</button>
                 </div>
 
                 <div class="comparison-summary" id="summary"></div>
@@ -179,11 +223,11 @@ HTML_TEMPLATE = """
                     <div class="tree-container">
                         <div class="tree-side">
                             <h3 id="tree1-title">Directory 1</h3>
-                            <div id="tree1"></div>
+                            <div id="tree1" class="tree-scroll" data-side="left"></div>
                         </div>
                         <div class="tree-side">
                             <h3 id="tree2-title">Directory 2</h3>
-                            <div id="tree2"></div>
+                            <div id="tree2" class="tree-scroll" data-side="right"></div>
                         </div>
                     </div>
 
@@ -204,6 +248,12 @@ HTML_TEMPLATE = """
     <script>
         let comparisonData = null;
         let selectedPath = null;
+        let currentJobId = null;
+        let listings = {};
+        let treeState = null;
+        const PAGE_SIZE = 500;
+        let diffCursor = null;
+        const ROW_HEIGHT = 30;
 
         function showMessage(message, type = 'info') {
             const container = document.getElementById('message-container');
@@ -238,6 +288,8 @@ HTML_TEMPLATE = """
 
                 if (response.ok && data.path) {
                     document.getElementById(inputId).value = data.path;
+                } else if (!response.ok) {
+                    showMessage(data.error || 'Folder dialog failed', 'error');
                 }
             } catch (error) {
                 console.error('Browser error:', error);
@@ -247,6 +299,12 @@ HTML_TEMPLATE = """
         async function compareDirectories() {
             const dir1 = document.getElementById('dir1').value.trim();
             const dir2 = document.getElementById('dir2').value.trim();
+            const use_cache = document.getElementById('useCache').checked;
+            const strategy = document.getElementById('strategy').value;
+            const escalate = document.getElementById('escalate').checked;
+            const algorithm = document.getElementById('algorithm').value;
+            const exclude = document.getElementById('exclude').value.split(',').map(p => p.trim()).filter(Boolean);
+            const gitignore = document.getElementById('gitignore').checked;
 
             if (!dir1 || !dir2) {
                 showMessage('Please enter both directory paths.', 'error');
@@ -258,64 +316,104 @@ HTML_TEMPLATE = """
             document.getElementById('compareBtn').disabled = true;
 
             try {
-                const response = await fetch('/compare', {
+                const response = await fetch('/jobs', {
                     method: 'POST',
                     headers: { 'Content-Type': 'application/json; charset=utf-8' },
-                    body: JSON.stringify({ dir1, dir2 })
+                    body: JSON.stringify({ dir1, dir2, use_cache, strategy, escalate, algorithm, exclude, gitignore })
                 });
 
-                const data = await response.json();
-
+                const job = await response.json();
                 if (!response.ok) {
-                    throw new Error(data.error || 'Comparison failed');
+                    throw new Error(job.error || 'Comparison failed');
+                }
+
+                currentJobId = job.id;
+                const status = await waitForJob(job.id);
+                if (status.state === 'cancelled') {
+                    showMessage('Comparison cancelled.', 'info');
+                    return;
+                }
+
+                if (status.state === 'failed') {
+                    throw new Error(status.error || 'Comparison failed');
                 }
 
-                comparisonData = data;
-                renderResults(data);
+                const root = await fetchJson(`/jobs/${job.id}/entry?path=`);
+                comparisonData = { jobId: job.id, dir1: status.dir1, dir2: status.dir2, algorithm: algorithm, root };
+                listings = {};
+                treeState = { left: { expanded: new Set(['']), rows: [] }, right: { expanded: new Set(['']), rows: [] } };
+                renderResults(comparisonData);
+                loadListing('');
                 document.getElementById('results').style.display = 'block';
                 showMessage('Directories compared successfully!', 'success');
             } catch (error) {
                 showMessage(error.message, 'error');
             } finally {
+                currentJobId = null;
                 document.getElementById('loading').classList.remove('active');
+                document.getElementById('loading-progress').textContent = 'This may take a moment for large directories';
                 document.getElementById('compareBtn').disabled = false;
             }
         }
 
+        async function waitForJob(jobId) {
+            while (true) {
+                const response = await fetch(`/jobs/${jobId}`);
+                const status = await response.json();
+                if (!response.ok) {
+                    throw new Error(status.error || 'Comparison failed');
+                }
+                if (status.state !== 'queued' && status.state !== 'running') {
+                    return status;
+                }
+                document.getElementById('loading-progress').textContent = formatProgress(status);
+                await new Promise(resolve => setTimeout(resolve, 500));
+            }
+        }
+
+        function formatProgress(status) {
+            if (status.state === 'queued') return 'Waiting for a free worker...';
+            const progress = status.progress;
+            const parts = [`${progress.files_scanned} files scanned`];
+            if (progress.bytes_planned) {
+                parts.push(`${formatBytes(progress.bytes_hashed)} of ${formatBytes(progress.bytes_planned)} read`);
+            }
+            if (progress.throughput) parts.push(`${formatBytes(progress.throughput)}/s`);
+            if (progress.eta !== null) parts.push(`about ${Math.ceil(progress.eta)} s left`);
+            return parts.join(' · ');
+        }
+
+        async function cancelComparison() {
+            if (!currentJobId) return;
+            document.getElementById('loading-progress').textContent = 'Cancelling...';
+            await fetch(`/jobs/${currentJobId}`, { method: 'DELETE' });
+        }
+
+        async function fetchJson(url) {
+            const response = await fetch(url);
+            const data = await response.json();
+            if (!response.ok) {
+                throw new Error(data.error || 'Request failed');
+            }
+            return data;
+        }
+
+        function escapeHtml(text) {
+            return String(text).replace(/[&<>"']/g, c => ({ '&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;' })[c]);
+        }
+
         function renderResults(data) {
             document.getElementById('tree1-title').textContent = data.dir1;
             document.getElementById('tree2-title').textContent = data.dir2;
-            document.getElementById('tree1').innerHTML = renderTree(data.tree1, 'left', '');
-            document.getElementById('tree2').innerHTML = renderTree(data.tree2, 'right', '');
-            
-            const stats = calculateStats(data.tree1, data.tree2);
-            renderSummary(stats);
-            
+            ['tree1', 'tree2'].forEach(id => { document.getElementById(id).scrollTop = 0; });
+            refreshTrees();
+
+            renderSummary(data.root.rollup || { same: 0, different: 0, missing: 0 });
+
             selectedPath = null;
             document.getElementById('details-content').innerHTML = '<div class="empty-state"><div class="empty-state-icon">📋</div><div>Select a file to view details</div></div>';
         }
 
-        function calculateStats(tree1, tree2) {
-            let stats = { same: 0, different: 0, missing: 0 };
-            
-            function count(node) {
-                if (!node) return;
-                if (node.type === 'file') {
-                    if (node.status === 'same') stats.same++;
-                    else if (node.status === 'different') stats.different++;
-                    else if (node.status === 'missing') stats.missing++;
-                }
-                if (node.children) {
-                    node.children.forEach(count);
-                }
-            }
-            
-            count(tree1);
-            count(tree2);
-            
-            return stats;
-        }
-
         function renderSummary(stats) {
             const html = `
                 <div class="summary-card">
@@ -334,54 +432,150 @@ HTML_TEMPLATE = """
             document.getElementById('summary').innerHTML = html;
         }
 
-        function renderTree(node, side, parentPath) {
-            if (!node) return '<div class="status-missing">Directory not found or empty</div>';
+        async function loadListing(path) {
+            const listing = listings[path];
+            if (listing && (listing.loading || listing.entries.length >= listing.total)) return;
+            const offset = listing ? listing.entries.length : 0;
+            const pending = { entries: listing ? listing.entries : [], total: listing ? listing.total : null, loading: true };
+            listings[path] = pending;
+            refreshTrees();
+            try {
+                const differencesOnly = document.getElementById('differencesOnly').checked ? 1 : 0;
+                const page = await fetchJson(`/jobs/${comparisonData.jobId}/children?path=${encodeURIComponent(path)}&offset=${offset}&limit=${PAGE_SIZE}&differences_only=${differencesOnly}`);
+                if (listings[path] !== pending) return;
+                listings[path] = { entries: pending.entries.concat(page.entries), total: page.total, loading: false };
+            } catch (error) {
+                if (listings[path] !== pending) return;
+                delete listings[path];
+                showMessage(error.message, 'error');
+            }
+            refreshTrees();
+        }
 
-            const currentPath = parentPath ? `${parentPath}/${node.name}` : node.name;
-            const isFolder = node.type === 'folder';
-            const statusClass = node.status ? `status-${node.status}` : '';
-            
-            const safeCurrentPath = currentPath.replace(/'/g, "\\'");
-            
-            let html = '<div class="tree-item">';
-            html += `<div class="tree-item-content ${statusClass}" data-path="${safeCurrentPath}" data-side="${side}" onclick="handleItemClick(event, '${side}', '${safeCurrentPath}', ${isFolder})">`;
-            html += `<span class="tree-item-icon ${isFolder ? 'folder-icon' : 'file-icon'}"></span>`;
-            html += `<span class="tree-item-name">${node.name}</span>`;
-            html += '</div>';
+        function toggleDifferencesOnly() {
+            if (!comparisonData) return;
+            listings = {};
+            ['left', 'right'].forEach(side => {
+                treeState[side].expanded.forEach(path => loadListing(path));
+            });
+            refreshTrees();
+        }
 
-            if (isFolder && node.children && node.children.length > 0) {
-                html += '<div class="tree-item-children">';
-                node.children.forEach(child => {
-                    html += renderTree(child, side, currentPath);
-                });
-                html += '</div>';
+        function buildRows(side) {
+            const rows = [];
+            const root = comparisonData.root;
+            if (!root[side]) return rows;
+            rows.push({ path: '', name: root[side].name, depth: 0, type: root[side].type, status: root.status, rollup: root.rollup });
+            if (root[side].type === 'folder' && treeState[side].expanded.has('')) appendChildRows(side, '', 1, rows);
+            return rows;
+        }
+
+        function appendChildRows(side, path, depth, rows) {
+            const listing = listings[path];
+            if (!listing) return;
+            listing.entries.forEach(entry => {
+                const info = entry[side];
+                if (!info) return;
+                rows.push({ path: entry.path, name: entry.name, depth, type: info.type, status: entry.status, rollup: entry.rollup });
+                if (info.type === 'folder' && treeState[side].expanded.has(entry.path)) appendChildRows(side, entry.path, depth + 1, rows);
+            });
+            if (listing.loading) {
+                rows.push({ kind: 'note', path, depth, text: 'Loading...' });
+            } else if (listing.entries.length < listing.total) {
+                rows.push({ kind: 'more', path, depth, text: `Show ${listing.total - listing.entries.length} more...` });
+            }
+        }
+
+        function refreshTrees() {
+            if (!comparisonData) return;
+            ['left', 'right'].forEach(side => {
+                treeState[side].rows = buildRows(side);
+                renderSide(side);
+            });
+        }
+
+        function renderSide(side) {
+            const container = document.getElementById(side === 'left' ? 'tree1' : 'tree2');
+            const rows = treeState[side].rows;
+            if (!rows.length) {
+                container.innerHTML = '<div class="status-missing">Directory not found or empty</div>';
+                return;
+            }
+
+            const first = Math.max(0, Math.floor(container.scrollTop / ROW_HEIGHT) - 10);
+            const last = Math.min(rows.length, first + Math.ceil(container.clientHeight / ROW_HEIGHT) + 20);
+            let html = `<div class="tree-viewport" style="height: ${rows.length * ROW_HEIGHT}px;">`;
+            for (let i = first; i < last; i++) {
+                html += renderRow(rows[i], side, i);
+            }
+            container.innerHTML = html + '</div>';
+        }
+
+        function renderRow(row, side, index) {
+            const style = `top: ${index * ROW_HEIGHT}px; padding-left: ${row.depth * 24 + 10}px;`;
+            if (row.kind) {
+                return `<div class="tree-row tree-item-content tree-row-note" style="${style}" onclick="handleRowClick('${side}', ${index})">${row.text}</div>`;
             }
 
+            const isFolder = row.type === 'folder';
+            let classes = 'tree-row tree-item-content';
+            if (row.status) classes += ` status-${row.status}`;
+            if (isFolder && treeState[side].expanded.has(row.path)) classes += ' expanded';
+            if (!isFolder && row.path === selectedPath) classes += ' selected';
+
+            let html = `<div class="${classes}" style="${style}" onclick="handleRowClick('${side}', ${index})">`;
+            html += `<span class="tree-item-icon ${isFolder ? 'folder-icon' : 'file-icon'}"></span>`;
+            html += `<span class="tree-item-name">${escapeHtml(row.name)}</span>`;
+            if (isFolder && row.rollup && (row.rollup.different || row.rollup.missing)) {
+                html += `<span class="tree-item-counts">${row.rollup.different} different · ${row.rollup.missing} missing</span>`;
+            }
             html += '</div>';
             return html;
         }
 
-        function handleItemClick(event, side, path, isFolder) {
-            if (isFolder) {
-                const element = event.target.closest('.tree-item');
-                element.classList.toggle('expanded');
+        function handleRowClick(side, index) {
+            const row = treeState[side].rows[index];
+            if (!row) return;
+            if (row.kind === 'more') {
+                loadListing(row.path);
+            } else if (row.kind) {
+                return;
+            } else if (row.type === 'folder') {
+                const expanded = treeState[side].expanded;
+                if (expanded.has(row.path)) {
+                    expanded.delete(row.path);
+                } else {
+                    expanded.add(row.path);
+                    if (!listings[row.path]) {
+                        loadListing(row.path);
+                        return;
+                    }
+                }
+                refreshTrees();
             } else {
-                document.querySelectorAll('.tree-item-content.selected').forEach(el => {
-                    el.classList.remove('selected');
-                });
-                event.target.closest('.tree-item-content').classList.add('selected');
-                
-                selectedPath = path;
-                showFileDetails(path);
+                selectedPath = row.path;
+                refreshTrees();
+                showFileDetails(row.path);
             }
         }
 
-        function showFileDetails(path) {
-            const pathParts = path.split('/').filter(p => p);
-            const relativePath = pathParts.slice(1).join('/');
-            
-            const file1 = findFileByRelativePath(comparisonData.tree1, relativePath);
-            const file2 = findFileByRelativePath(comparisonData.tree2, relativePath);
+        ['tree1', 'tree2'].forEach(id => {
+            const container = document.getElementById(id);
+            container.addEventListener('scroll', () => {
+                if (comparisonData) renderSide(container.dataset.side);
+            });
+        });
+
+        async function showFileDetails(path) {
+            let entry;
+            try {
+                entry = await fetchJson(`/jobs/${comparisonData.jobId}/entry?path=${encodeURIComponent(path)}`);
+            } catch (error) {
+                entry = { left: null, right: null };
+            }
+            if (path !== selectedPath) return;
+            const file1 = entry.left;
+            const file2 = entry.right;
 
             if (!file1 && !file2) {
                 document.getElementById('details-content').innerHTML = '<div class="empty-state"><div class="empty-state-icon">⚠️</div><div>Could not find file in tree</div></div>';
@@ -395,12 +589,14 @@ HTML_TEMPLATE = """
             html += '<div class="detail-item">';
             if (file1 && file1.type === 'file') {
                 html += `<div class="detail-row"><span class="detail-label">Status</span><span class="status-badge badge-${file1.status}">${file1.status}</span></div>`;
+                if (file1.decided_by) html += `<div class="detail-row"><span class="detail-label">Decided By</span><span class="detail-value">${file1.decided_by}</span></div>`;
+                if (file1.first_difference !== undefined && file1.first_difference !== null) html += `<div class="detail-row"><span class="detail-label">First Difference</span><span class="detail-value">byte ${file1.first_difference.toLocaleString()}</span></div>`;
                 html += `<div class="detail-row"><span class="detail-label">Size</span><span class="detail-value">${formatBytes(file1.size)}</span></div>`;
                 html += `<div class="detail-row"><span class="detail-label">Size on Disk</span><span class="detail-value">${formatBytes(file1.size_on_disk)}</span></div>`;
                 html += `<div class="detail-row"><span class="detail-label">Created</span><span class="detail-value">${formatDate(file1.created)}</span></div>`;
                 html += `<div class="detail-row"><span class="detail-label">Modified</span><span class="detail-value">${formatDate(file1.modified)}</span></div>`;
                 html += `<div class="detail-row"><span class="detail-label">Accessed</span><span class="detail-value">${formatDate(file1.accessed)}</span></div>`;
-                if (file1.md5) html += `<div class="detail-hash">MD5: ${file1.md5}</div>`;
+                if (file1.digest) html += `<div class="detail-hash">${comparisonData.algorithm.toUpperCase()}: ${file1.digest}</div>`;
             } else {
                 html += '<div class="detail-value status-missing">❌ File not found in this directory</div>';
             }
@@ -411,43 +607,139 @@ HTML_TEMPLATE = """
             html += '<div class="detail-item">';
             if (file2 && file2.type === 'file') {
                 html += `<div class="detail-row"><span class="detail-label">Status</span><span class="status-badge badge-${file2.status}">${file2.status}</span></div>`;
+                if (file2.decided_by) html += `<div class="detail-row"><span class="detail-label">Decided By</span><span class="detail-value">${file2.decided_by}</span></div>`;
+                if (file2.first_difference !== undefined && file2.first_difference !== null) html += `<div class="detail-row"><span class="detail-label">First Difference</span><span class="detail-value">byte ${file2.first_difference.toLocaleString()}</span></div>`;
                 html += `<div class="detail-row"><span class="detail-label">Size</span><span class="detail-value">${formatBytes(file2.size)}</span></div>`;
                 html += `<div class="detail-row"><span class="detail-label">Size on Disk</span><span class="detail-value">${formatBytes(file2.size_on_disk)}</span></div>`;
                 html += `<div class="detail-row"><span class="detail-label">Created</span><span class="detail-value">${formatDate(file2.created)}</span></div>`;
                 html += `<div class="detail-row"><span class="detail-label">Modified</span><span class="detail-value">${formatDate(file2.modified)}</span></div>`;
                 html += `<div class="detail-row"><span class="detail-label">Accessed</span><span class="detail-value">${formatDate(file2.accessed)}</span></div>`;
-                if (file2.md5) html += `<div class="detail-hash">MD5: ${file2.md5}</div>`;
+                if (file2.digest) html += `<div class="detail-hash">${comparisonData.algorithm.toUpperCase()}: ${file2.digest}</div>`;
             } else {
                 html += '<div class="detail-value status-missing">❌ File not found in this directory</div>';
             }
             html += '</div></div>';
 
+            const showDiff = file1 && file2 && file1.type === 'file' && file2.type === 'file' && entry.status === 'different';
+            if (showDiff) {
+                html += '<div class="detail-section">';
+                html += '<div class="detail-section-title">🔀 Changes <select class="option-select" id="diffMode" onchange="loadDiff(true)"><option value="unified">Unified</option><option value="side-by-side">Side by side</option></select></div>';
+                html += '<div id="diff-view" class="diff-view"></div>';
+                html += '<button class="secondary-btn" id="diffMore" style="display: none; margin-top: 8px;" onclick="loadDiff(false)">Load more</button>';
+                html += '</div>';
+            }
+
             document.getElementById('details-content').innerHTML = html;
+            if (showDiff) loadDiff(true);
         }
 
-        function findFileByRelativePath(rootNode, relativePath) {
-            if (!rootNode) return null;
-            
-            if (!relativePath || relativePath === '') {
-                return rootNode;
+        async function loadDiff(reset) {
+            const path = selectedPath;
+            const mode = document.getElementById('diffMode').value;
+            const view = document.getElementById('diff-view');
+            if (reset) {
+                diffCursor = null;
+                view.innerHTML = '<div class="diff-note">Loading diff...</div>';
             }
-            
-            const parts = relativePath.split('/').filter(p => p);
-            let current = rootNode;
-            
-            for (let i = 0; i < parts.length; i++) {
-                if (!current.children) {
-                    return null;
+            let url = `/jobs/${comparisonData.jobId}/diff?path=${encodeURIComponent(path)}&mode=${mode}`;
+            if (diffCursor) url += `&cursor=${diffCursor}`;
+            let diff;
+            try {
+                diff = await fetchJson(url);
+            } catch (error) {
+                view.innerHTML = `<div class="diff-note">${escapeHtml(error.message)}</div>`;
+                return;
+            }
+            if (path !== selectedPath || mode !== document.getElementById('diffMode').value) return;
+            if (reset) view.innerHTML = '';
+            view.insertAdjacentHTML('beforeend', renderDiff(diff, reset));
+            diffCursor = diff.next;
+            document.getElementById('diffMore').style.display = diff.next ? '' : 'none';
+        }
+
+        function renderDiff(diff, first) {
+            let html = '';
+            if (diff.binary) {
+                if (first) html += `<div class="diff-note">Binary files (${formatBytes(diff.size1)} / ${formatBytes(diff.size2)}), differing byte ranges:</div>`;
+                html += '<table class="diff-table">';
+                for (const range of diff.ranges) {
+                    html += `<tr class="diff-del"><td>${range.start.toLocaleString()} – ${range.end.toLocaleString()}</td><td class="diff-num">${formatBytes(range.end - range.start)}</td></tr>`;
                 }
-                
-                current = current.children.find(child => child.name === parts[i]);
-                
-                if (!current) {
-                    return null;
+                return html + '</table>';
+            }
+            if (first && !diff.hunks.length) return '<div class="diff-note">No line differences</div>';
+            for (const hunk of diff.hunks) {
+                html += `<div class="diff-hunk">@@ -${hunk.old_start},${hunk.old_lines} +${hunk.new_start},${hunk.new_lines} @@</div><table class="diff-table">`;
+                if (hunk.lines) {
+                    for (const [kind, text] of hunk.lines) {
+                        const cls = kind === '-' ? 'diff-del' : kind === '+' ? 'diff-add' : '';
+                        html += `<tr class="${cls}"><td>${kind}${escapeHtml(text)}</td></tr>`;
+                    }
+                } else {
+                    for (const [kind, line1, text1, line2, text2] of hunk.rows) {
+                        const left = kind === '-' || kind === '!' ? 'diff-del' : '';
+                        const right = kind === '+' || kind === '!' ? 'diff-add' : '';
+                        html += `<tr><td class="diff-num">${line1 ?? ''}</td><td class="${left}">${escapeHtml(text1 ?? '')}</td>`;
+                        html += `<td class="diff-num">${line2 ?? ''}</td><td class="${right}">${escapeHtml(text2 ?? '')}</td></tr>`;
+                    }
                 }
+                html += '</table>';
+            }
+            return html;
+        }
+
+        const COMPACT_KEYS = ['format', 'version', 'separator', 'roots', 'statuses', 'types', 'row_fields',
+                              'side_fields', 'rollup_fields', 'string_prefixes', 'strings', 'rows'];
+
+        function decodeCompactResult(data) {
+            // Rebuild the tree1/tree2 form of /compare from the compact format.
+            const strings = [];
+            data.strings.forEach((suffix, i) => {
+                strings.push(i ? strings[i - 1].slice(0, data.string_prefixes[i]) + suffix : suffix);
+            });
+            const result = { tree1: null, tree2: null };
+            for (const [key, value] of Object.entries(data)) {
+                if (!COMPACT_KEYS.includes(key)) result[key] = value;
+            }
+            const nodes = [[], []];
+            data.rows.forEach(([parent, name, status, decidedBy, firstDifference, left, right, rollup], index) => {
+                [left, right].forEach((side, s) => {
+                    if (!side) return;
+                    const parentNode = parent < 0 ? null : nodes[s][parent];
+                    const node = parentNode
+                        ? { name: strings[name], path: parentNode.path + data.separator + strings[name] }
+                        : { name: data.roots[s][0], path: data.roots[s][1] };
+                    data.side_fields.forEach((field, k) => {
+                        if (side[k] !== null) node[field] = k ? side[k] : data.types[side[k]];
+                    });
+                    if (status !== null) node.status = data.statuses[status];
+                    if (decidedBy !== null) node.decided_by = strings[decidedBy];
+                    if (firstDifference !== null) node.first_difference = firstDifference;
+                    if (node.type === 'folder') {
+                        if (rollup) node.rollup = Object.fromEntries(data.rollup_fields.map((key, k) => [key, rollup[k]]));
+                        node.children = [];
+                    }
+                    if (parentNode) parentNode.children.push(node);
+                    else result[s ? 'tree2' : 'tree1'] = node;
+                    nodes[s][index] = node;
+                });
+            });
+            return result;
+        }
+
+        async function exportResult() {
+            if (!comparisonData) return;
+            try {
+                const data = await fetchJson(`/jobs/${comparisonData.jobId}/result?format=compact`);
+                const result = data.format === 'compact' ? decodeCompactResult(data) : data;
+                const link = document.createElement('a');
+                link.href = URL.createObjectURL(new Blob([JSON.stringify(result)], { type: 'application/json' }));
+                link.download = 'comparison.json';
+                link.click();
+                setTimeout(() => URL.revokeObjectURL(link.href), 1000);
+            } catch (error) {
+                showMessage(error.message, 'error');
             }
-            
-            return current;
         }
 
         function formatBytes(bytes) {
@@ -470,6 +762,8 @@ HTML_TEMPLATE = """
             document.getElementById('message-container').innerHTML = '';
             comparisonData = null;
             selectedPath = null;
+            listings = {};
+            treeState = null;
         }
     </script>
 </body>
@@ -480,216 +774,4255 @@ HTML_TEMPLATE = """
 def normalize_path(path_str):
     """Normalize path to handle Unicode characters properly on Windows."""
     try:
+        from pathlib import Path
+        
         path = Path(path_str)
         return str(path.resolve())
     except Exception:
         return path_str
 
 
-def get_file_info(path):
-    """Get detailed file information including metadata and hash."""
+HASH_MODES = ('lazy', 'eager')
+EXECUTORS = ('thread', 'process')
+STRATEGIES = ('full', 'sample', 'metadata', 'bytes')
+TREE_SOURCES = ('directory', 'manifest', 'archive')
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+DEFAULT_SAMPLE_BLOCKS = 8
+SAMPLE_BLOCK_SIZE = 64 * 1024
+HASH_BATCH_SIZE = 4096
+
+
+def new_stats():
+    """Create the counters reported with every comparison."""
+    return {
+        'files_scanned': 0,
+        'files_hashed': 0,
+        'files_sampled': 0,
+        'pairs_compared': 0,
+        'bytes_read': 0,
+        'bytes_skipped': 0,
+        'cache_hits': 0,
+        'cache_misses': 0,
+        'manifest_hits': 0,
+        'dirs_listed': 0,
+        'dirs_reused': 0,
+        'stat_calls': 0,
+        'subtrees_skipped': 0,
+        'errors': {},
+    }
+
+
+def count_error(stats, error):
+    """Count an error in stats['errors'], by exception type name."""
+    if stats is None or error is None:
+        return
+    name = error if isinstance(error, str) else type(error).__name__
+    stats['errors'][name] = stats['errors'].get(name, 0) + 1
+
+
+HASH_ALGORITHMS = {
+    'md5': hashlib.md5,
+    'sha1': hashlib.sha1,
+    'sha256': hashlib.sha256,
+    'blake2b': hashlib.blake2b,
+}
+
+try:
+    import xxhash
+    HASH_ALGORITHMS['xxh3_64'] = xxhash.xxh3_64
+    HASH_ALGORITHMS['xxh3_128'] = xxhash.xxh3_128
+except ImportError:
+    pass
+
+try:
+    import blake3
+    HASH_ALGORITHMS['blake3'] = blake3.blake3
+except ImportError:
+    pass
+
+DEFAULT_ALGORITHM = 'md5'
+
+
+def new_hasher(algorithm=DEFAULT_ALGORITHM):
+    """Create a hash object for a registered algorithm name."""
     try:
-        if sys.platform == 'win32':
-            path = os.path.normpath(path)
-        
-        stat = os.stat(path)
-        info = {
-            'size': stat.st_size,
-            'size_on_disk': stat.st_blocks * 512 if hasattr(stat, 'st_blocks') else stat.st_size,
-            'created': stat.st_ctime,
-            'modified': stat.st_mtime,
-            'accessed': stat.st_atime,
-        }
-        
-        if os.path.isfile(path):
-            md5_hash = hashlib.md5()
-            try:
-                with open(path, 'rb') as f:
-                    for chunk in iter(lambda: f.read(4096), b''):
-                        md5_hash.update(chunk)
-                info['md5'] = md5_hash.hexdigest()
-            except Exception:
-                info['md5'] = None
-        
-        return info
+        return HASH_ALGORITHMS[algorithm]()
+    except KeyError:
+        raise ValueError(f'Unknown hash algorithm: {algorithm}') from None
+
+
+def _open_regular(path, mode='rb', **kwargs):
+    """Open a file like open(), raising OSError unless it is a regular file.
+    
+    Opened with O_NONBLOCK (where the platform has it), which has no effect
+    on regular files but keeps a FIFO without a writer from blocking open().
+    Reading FIFOs, sockets and devices could otherwise wait or run forever.
+    """
+    if 'b' in mode:
+        kwargs.setdefault('buffering', 0)
+    fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0) | getattr(os, 'O_NONBLOCK', 0))
+    try:
+        if not stat.S_ISREG(os.fstat(fd).st_mode):
+            raise OSError(f'Not a regular file: {path}')
+        return open(fd, mode, **kwargs)
+    except BaseException:
+        os.close(fd)
+        raise
+
+
+def _hash_path(path, buffer_size=DEFAULT_BUFFER_SIZE, algorithm=DEFAULT_ALGORITHM):
+    """Hash one file into a reused buffer; returns (digest bytes or None, bytes read, error).
+    
+    error is the exception type name when the file could not be read. Kept
+    at module level so it can be shipped to a process pool.
+    """
+    hasher = new_hasher(algorithm)
+    bytes_read = 0
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    try:
+        with _open_regular(path) as f:
+            while True:
+                n = f.readinto(buffer)
+                if not n:
+                    break
+                hasher.update(view[:n])
+                bytes_read += n
     except Exception as e:
-        print(f"Error getting file info for {path}: {e}")
-        return None
+        return None, bytes_read, type(e).__name__
+    return hasher.digest(), bytes_read, None
+
+
+def sample_offsets(size, blocks=DEFAULT_SAMPLE_BLOCKS, block_size=SAMPLE_BLOCK_SIZE):
+    """Return the offsets read by a sample: first, last and blocks evenly spaced blocks."""
+    last = max(0, size - block_size)
+    offsets = {0, last}
+    offsets.update(round(i * last / (blocks + 1)) for i in range(1, blocks + 1))
+    return sorted(offsets)
+
 
+def sample_covers_file(size, blocks=DEFAULT_SAMPLE_BLOCKS, block_size=SAMPLE_BLOCK_SIZE):
+    """Tell whether sampling would read the whole file anyway."""
+    return size <= (blocks + 2) * block_size
 
-def build_tree(root_path):
-    """Build a tree structure of the directory with file information."""
+
+def _sample_path(path, blocks=DEFAULT_SAMPLE_BLOCKS, block_size=SAMPLE_BLOCK_SIZE, algorithm=DEFAULT_ALGORITHM):
+    """Hash the sampled blocks of one file; returns (digest bytes or None, bytes read, error)."""
+    hasher = new_hasher(algorithm)
+    bytes_read = 0
     try:
-        if sys.platform == 'win32':
-            root_path = os.path.normpath(root_path)
-        
-        if not os.path.exists(root_path):
-            return None
-        
-        path_obj = Path(root_path)
-        name = path_obj.name if path_obj.name else str(path_obj)
-        
-        node = {
-            'name': name,
-            'type': 'folder' if os.path.isdir(root_path) else 'file',
-            'path': str(root_path)
-        }
-        
-        if os.path.isdir(root_path):
-            node['children'] = []
-            try:
-                entries = sorted(os.listdir(root_path))
-                for entry in entries:
-                    child_path = os.path.join(root_path, entry)
-                    child_node = build_tree(child_path)
-                    if child_node:
-                        node['children'].append(child_node)
-            except PermissionError:
-                pass
-            except Exception as e:
-                print(f"Error reading directory {root_path}: {e}")
+        with _open_regular(path) as f:
+            size = os.fstat(f.fileno()).st_size
+            for offset in sample_offsets(size, blocks, block_size):
+                f.seek(offset)
+                chunk = f.read(block_size)
+                hasher.update(chunk)
+                bytes_read += len(chunk)
+    except Exception as e:
+        return None, bytes_read, type(e).__name__
+    return hasher.digest(), bytes_read, None
+
+
+def _first_mismatch(a, b):
+    """Return the index of the first differing byte of two equal-length views."""
+    lo, hi = 0, len(a)
+    while hi - lo > 64:
+        mid = (lo + hi) // 2
+        if a[lo:mid] == b[lo:mid]:
+            lo = mid
         else:
-            info = get_file_info(root_path)
-            if info:
-                node.update(info)
-        
-        return node
+            hi = mid
+    for i in range(lo, hi):
+        if a[i] != b[i]:
+            return i
+    return hi
+
+
+def _compare_paths(pair, buffer_size=DEFAULT_BUFFER_SIZE):
+    """Compare two files block by block, stopping at the first difference.
+    
+    Returns (equal, offset of first difference, bytes read, error); equal is
+    None when either file cannot be read, and error names the exception type.
+    Both files are read with readinto()
+    into buffers allocated once per call.
+    """
+    path1, path2 = pair
+    buffer1, buffer2 = bytearray(buffer_size), bytearray(buffer_size)
+    view1, view2 = memoryview(buffer1), memoryview(buffer2)
+    offset = 0
+    bytes_read = 0
+    try:
+        with _open_regular(path1) as f1, _open_regular(path2) as f2:
+            while True:
+                n1 = f1.readinto(buffer1)
+                n2 = f2.readinto(buffer2)
+                bytes_read += n1 + n2
+                n = min(n1, n2)
+                if view1[:n] != view2[:n]:
+                    return False, offset + _first_mismatch(view1[:n], view2[:n]), bytes_read, None
+                if n1 != n2:
+                    return False, offset + n, bytes_read, None
+                if not n:
+                    return True, None, bytes_read, None
+                offset += n
     except Exception as e:
-        print(f"Error building tree for {root_path}: {e}")
+        return None, None, bytes_read, type(e).__name__
+
+
+def hash_file(path, stats=None, algorithm=DEFAULT_ALGORITHM):
+    """Return the hex digest of a file, or None if it cannot be read."""
+    digest, bytes_read, error = _hash_path(path, algorithm=algorithm)
+    if stats is not None:
+        stats['files_hashed'] += 1
+        stats['bytes_read'] += bytes_read
+        count_error(stats, error)
+    return digest.hex() if digest is not None else None
+
+
+DEFAULT_CACHE_PATH = os.environ.get(
+    'XSUKAX_DTC_CACHE',
+    os.path.join(os.path.expanduser('~'), '.cache', 'xsukax-dtc', 'hashes.sqlite3'))
+DEFAULT_CACHE_ENTRIES = 2_000_000
+
+
+def stat_signature(node):
+    """Return the (device, inode, size, mtime_ns) identity of a file node, or None."""
+    signature = (node.device, node.inode, node.size, node.mtime_ns)
+    if None in signature or not signature[1]:
         return None
+    return signature
 
 
-def compare_nodes(node1, node2):
-    """Compare two nodes and add status information."""
-    if not node1 and not node2:
-        return None, None
-    
-    if not node1:
-        node2_copy = node2.copy()
-        node2_copy['status'] = 'missing'
-        if node2_copy.get('type') == 'folder' and 'children' in node2_copy:
-            node2_copy['children'] = [compare_nodes(None, c)[1] for c in node2_copy['children']]
-        return None, node2_copy
-    
-    if not node2:
-        node1_copy = node1.copy()
-        node1_copy['status'] = 'missing'
-        if node1_copy.get('type') == 'folder' and 'children' in node1_copy:
-            node1_copy['children'] = [compare_nodes(c, None)[0] for c in node1_copy['children']]
-        return node1_copy, None
-    
-    node1_copy = node1.copy()
-    node2_copy = node2.copy()
-    
-    if node1.get('type') == 'file' and node2.get('type') == 'file':
-        if node1.get('md5') and node2.get('md5'):
-            if node1['md5'] == node2['md5']:
-                node1_copy['status'] = 'same'
-                node2_copy['status'] = 'same'
-            else:
-                node1_copy['status'] = 'different'
-                node2_copy['status'] = 'different'
-        else:
-            node1_copy['status'] = 'different'
-            node2_copy['status'] = 'different'
-    elif node1.get('type') == 'folder' and node2.get('type') == 'folder':
-        children1 = {c['name']: c for c in node1.get('children', [])}
-        children2 = {c['name']: c for c in node2.get('children', [])}
-        all_names = set(children1.keys()) | set(children2.keys())
-        
-        new_children1 = []
-        new_children2 = []
-        
-        for name in sorted(all_names):
-            c1, c2 = compare_nodes(children1.get(name), children2.get(name))
-            if c1:
-                new_children1.append(c1)
-            if c2:
-                new_children2.append(c2)
+class HashCache:
+    """Persistent digest cache keyed by file identity and stat signature.
+    
+    A file whose device, inode, size and mtime_ns are unchanged since it was
+    last hashed is served from here without being read. The least recently
+    used rows are evicted once the cache holds more than max_entries; the
+    row count is taken once on open and kept up to date by store().
+    """
+
+    # Signatures per lookup query: 4 parameters each, under SQLite's
+    # default limit of 999.
+    LOOKUP_BATCH = 240
+    
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_entries=DEFAULT_CACHE_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        import sqlite3
         
-        node1_copy['children'] = new_children1
-        node2_copy['children'] = new_children2
-        node1_copy['status'] = 'same'
-        node2_copy['status'] = 'same'
-    else:
-        node1_copy['status'] = 'different'
-        node2_copy['status'] = 'different'
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS digests ('
+            ' device INTEGER, inode INTEGER, size INTEGER, mtime_ns INTEGER,'
+            ' algorithm TEXT, digest TEXT, last_used REAL,'
+            ' PRIMARY KEY (device, inode, size, mtime_ns, algorithm))')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS digests_last_used ON digests (last_used)')
+        self._conn.commit()
+        self._entries = self._conn.execute('SELECT COUNT(*) FROM digests').fetchone()[0]
+    
+    def lookup(self, signatures, algorithm=DEFAULT_ALGORITHM):
+        """Return {signature: digest bytes} for the signatures present in the cache."""
+        found = {}
+        now = time.time()
+        signatures = list(signatures)
+        with self._lock:
+            for start in range(0, len(signatures), self.LOOKUP_BATCH):
+                batch = signatures[start:start + self.LOOKUP_BATCH]
+                rows = self._conn.execute(
+                    'SELECT device, inode, size, mtime_ns, digest FROM digests WHERE algorithm=?'
+                    ' AND (device, inode, size, mtime_ns) IN (VALUES '
+                    + ', '.join(['(?, ?, ?, ?)'] * len(batch)) + ')',
+                    (algorithm, *itertools.chain.from_iterable(batch)))
+                for device, inode, size, mtime_ns, digest in rows:
+                    found[device, inode, size, mtime_ns] = bytes.fromhex(digest)
+            if found:
+                self._conn.executemany(
+                    'UPDATE digests SET last_used=? WHERE device=? AND inode=? AND size=?'
+                    ' AND mtime_ns=? AND algorithm=?',
+                    [(now, *signature, algorithm) for signature in found])
+                self._conn.commit()
+        return found
     
-    return node1_copy, node2_copy
+    def store(self, items, algorithm=DEFAULT_ALGORITHM):
+        """Save (signature, digest) pairs and evict the oldest rows if over budget."""
+        now = time.time()
+        rows = [(*signature, algorithm, digest.hex(), now) for signature, digest in items if digest]
+        if not rows:
+            return
+        with self._lock:
+            changes = self._conn.total_changes
+            self._conn.executemany('INSERT OR IGNORE INTO digests VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            inserted = self._conn.total_changes - changes
+            self._entries += inserted
+            if inserted < len(rows):
+                # Some signatures were cached already (by another comparison).
+                self._conn.executemany(
+                    'UPDATE digests SET digest=?, last_used=? WHERE device=? AND inode=? AND size=?'
+                    ' AND mtime_ns=? AND algorithm=?',
+                    [(digest, used, *key) for *key, digest, used in rows])
+            excess = self._entries - self.max_entries
+            if excess > 0:
+                deleted = self._conn.execute(
+                    'DELETE FROM digests WHERE rowid IN (SELECT rowid FROM digests'
+                    ' ORDER BY last_used LIMIT ?)', (excess,)).rowcount
+                self._entries -= deleted
+            self._conn.commit()
+    
+    def clear(self):
+        """Invalidate every cached digest."""
+        with self._lock:
+            self._conn.execute('DELETE FROM digests')
+            self._conn.commit()
+            self._conn.execute('VACUUM')
+            self._entries = 0
+    
+    def info(self):
+        """Return the cache location and current size."""
+        with self._lock:
+            # Recount, in case another process shares the database.
+            entries = self._entries = self._conn.execute('SELECT COUNT(*) FROM digests').fetchone()[0]
+        return {'path': self.path, 'entries': entries, 'max_entries': self.max_entries}
 
 
-@app.route('/')
-def index():
-    """Render the main page."""
-    return render_template_string(HTML_TEMPLATE)
+_hash_cache = None
+_hash_cache_lock = threading.Lock()
 
 
-@app.route('/browse_folder', methods=['POST'])
-def browse_folder():
-    """Open folder browser dialog and return selected path."""
-    try:
-        root = Tk()
-        root.withdraw()
-        root.attributes('-topmost', True)
-        
-        folder_path = filedialog.askdirectory(title='Select Folder')
-        
-        root.destroy()
-        
-        if folder_path:
-            return jsonify({'path': folder_path})
-        else:
-            return jsonify({'error': 'No folder selected'})
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+def get_hash_cache(create=True):
+    """Return the process-wide hash cache, opening it on first use.
+    
+    With create=False, returns None rather than creating a database that
+    does not exist yet.
+    """
+    global _hash_cache
+    with _hash_cache_lock:
+        if _hash_cache is None:
+            if not create and not os.path.exists(DEFAULT_CACHE_PATH):
+                return None
+            _hash_cache = HashCache()
+        return _hash_cache
 
 
-@app.route('/compare', methods=['POST'])
-def compare():
-    """Compare two directories and return the tree structures."""
-    try:
-        data = request.get_json()
-        dir1 = data.get('dir1', '').strip()
-        dir2 = data.get('dir2', '').strip()
+class ComparisonCancelled(Exception):
+    """Raised inside a comparison whose cancel event was set."""
+
+
+class HashEngine:
+    """Hash many files concurrently on a thread or process pool.
+    
+    Threads suit I/O-bound work (hashlib releases the GIL on large buffers);
+    processes help when hashing is CPU-bound on fast storage. The pool is
+    created on first use and shared by both trees of a comparison.
+    
+    With a cancel_event, the walk and every pool map check it between items
+    and raise ComparisonCancelled once it is set; files already being read
+    finish, queued ones are dropped. Time spent in each stage of a
+    comparison is added up in timings (see span).
+    """
+    
+    def __init__(self, workers=None, executor='thread', buffer_size=DEFAULT_BUFFER_SIZE, stats=None,
+                 cache=None, sample_blocks=DEFAULT_SAMPLE_BLOCKS, algorithm=DEFAULT_ALGORITHM,
+                 cancel_event=None):
+        if executor not in EXECUTORS:
+            raise ValueError(f'Unknown executor: {executor}')
+        if algorithm not in HASH_ALGORITHMS:
+            raise ValueError(f'Unknown hash algorithm: {algorithm}')
+        cpus = os.cpu_count() or 1
+        if workers is None:
+            workers = min(32, cpus + 4) if executor == 'thread' else cpus
+        self.workers = max(1, int(workers))
+        self.executor = executor
+        self.buffer_size = max(4096, int(buffer_size))
+        self.stats = stats if stats is not None else new_stats()
+        self.cache = cache
+        self.sample_blocks = max(1, int(sample_blocks))
+        self.algorithm = algorithm
+        self.cancel_event = cancel_event
+        self.bytes_planned = 0
+        self.hash_started = None
+        self.timings = {}
+        self._pool = None
+        self._stats_lock = threading.Lock()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+    
+    def close(self):
+        """Shut down the worker pool, if one was started."""
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+    
+    def check_cancelled(self):
+        """Raise ComparisonCancelled if the cancel event is set, dropping queued work."""
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            if self._pool is not None:
+                self._pool.shutdown(wait=True, cancel_futures=True)
+                self._pool = None
+            raise ComparisonCancelled()
+    
+    def merge_stats(self, stats):
+        """Add the counters of a new_stats() dict to stats, then zero them.
         
-        if not dir1 or not dir2:
-            return jsonify({'error': 'Both directory paths are required'}), 400
+        Walks running in parallel on one engine count into dicts of their own
+        and merge them here, under a lock, so no update is lost.
+        """
+        with self._stats_lock:
+            for key, value in stats.items():
+                if key == 'errors':
+                    for name, count in value.items():
+                        self.stats['errors'][name] = self.stats['errors'].get(name, 0) + count
+                    value.clear()
+                elif value:
+                    self.stats[key] += value
+                    stats[key] = 0
+    
+    @contextlib.contextmanager
+    def span(self, stage):
+        """Add the wall time of the with block to timings[stage], in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[stage] = self.timings.get(stage, 0.0) + time.perf_counter() - start
+    
+    def plan(self, num_bytes):
+        """Announce bytes about to be read, for progress and ETA reporting."""
+        if self.hash_started is None:
+            self.hash_started = time.time()
+        self.bytes_planned += num_bytes
+    
+    def _get_pool(self):
+        if self._pool is None:
+            if self.executor == 'process':
+                self._pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._pool = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix='hash')
+        return self._pool
+    
+    def _map(self, worker, items):
+        """Yield (item, worker(item)) for every item, in batches on the pool."""
+        items = list(items)
+        for start in range(0, len(items), HASH_BATCH_SIZE):
+            self.check_cancelled()
+            batch = items[start:start + HASH_BATCH_SIZE]
+            if self.workers > 1 and len(batch) > 1:
+                chunksize = max(1, len(batch) // (self.workers * 4))
+                results = self._get_pool().map(worker, batch, chunksize=chunksize)
+            else:
+                results = map(worker, batch)
+            for item, result in zip(batch, results):
+                yield item, result
+                self.check_cancelled()
+    
+    def _map_paths(self, worker, paths, counter):
+        """Run a (digest, bytes read) worker over paths on the pool."""
+        digests = {}
+        for path, (digest, bytes_read, error) in self._map(worker, dict.fromkeys(paths)):
+            digests[path] = digest
+            self.stats[counter] += 1
+            self.stats['bytes_read'] += bytes_read
+            count_error(self.stats, error)
+        return digests
+    
+    def compare_pairs(self, pairs):
+        """Compare (path1, path2) pairs byte by byte.
         
-        dir1 = normalize_path(dir1)
-        dir2 = normalize_path(dir2)
+        Returns {pair: (equal, first difference offset, bytes read)}.
+        """
+        worker = functools.partial(_compare_paths, buffer_size=self.buffer_size)
+        results = {}
+        for pair, (equal, offset, bytes_read, error) in self._map(worker, dict.fromkeys(pairs)):
+            results[pair] = equal, offset, bytes_read
+            self.stats['pairs_compared'] += 1
+            self.stats['bytes_read'] += bytes_read
+            count_error(self.stats, error)
+        return results
+    
+    def hash_paths(self, paths):
+        """Hash the given paths and return a {path: digest bytes or None} dict."""
+        worker = functools.partial(_hash_path, buffer_size=self.buffer_size, algorithm=self.algorithm)
+        return self._map_paths(worker, paths, 'files_hashed')
+    
+    def sample_nodes(self, nodes):
+        """Store a digest of the sampled blocks of each file node in node.sample.
+        
+        Files that cannot be read get b'' so they are not retried; special
+        files are skipped.
+        """
+        nodes = [(n, n.path) for n in nodes if n.sample is None and not n.special]
+        self.plan(sum(min(n.size or 0, len(sample_offsets(n.size or 0, self.sample_blocks)) * SAMPLE_BLOCK_SIZE)
+                      for n, _ in nodes))
+        worker = functools.partial(_sample_path, blocks=self.sample_blocks, algorithm=self.algorithm)
+        digests = self._map_paths(worker, (path for _, path in nodes), 'files_sampled')
+        for node, path in nodes:
+            node.sample = digests.get(path) or b''
+    
+    def hash_nodes(self, nodes):
+        """Hash file nodes that do not carry a digest yet, storing it in place.
         
-        if not os.path.exists(dir1):
-            return jsonify({'error': f'Directory 1 does not exist: {dir1}'}), 400
+        With a cache attached, nodes whose stat signature is known are served
+        from it and only the misses are read. Files that cannot be read get
+        b'' so they are not retried. Special files (see Node) are skipped and
+        keep no digest.
+        """
+        nodes = [(n, stat_signature(n)) for n in nodes if n.digest is None and not n.special]
+        if self.cache is not None:
+            cached = self.cache.lookup({sig for _, sig in nodes if sig}, self.algorithm)
+            misses = []
+            for node, sig in nodes:
+                if sig in cached:
+                    node.digest = cached[sig]
+                else:
+                    misses.append((node, sig))
+            self.stats['cache_hits'] += len(nodes) - len(misses)
+            self.stats['cache_misses'] += len(misses)
+            nodes = misses
         
-        if not os.path.exists(dir2):
-            return jsonify({'error': f'Directory 2 does not exist: {dir2}'}), 400
+        paths = [node.path for node, _ in nodes]
+        self.plan(sum(node.size or 0 for node, _ in nodes))
+        digests = self.hash_paths(paths)
+        for (node, _), path in zip(nodes, paths):
+            node.digest = digests.get(path) or b''
         
-        tree1 = build_tree(dir1)
-        tree2 = build_tree(dir2)
+        if self.cache is not None:
+            self.cache.store(((sig, node.digest) for node, sig in nodes if sig), self.algorithm)
+
+
+def file_info_from_stat(st):
+    """Extract the metadata reported for a file from a stat result."""
+    return {
+        'size': st.st_size,
+        'size_on_disk': st.st_blocks * 512 if hasattr(st, 'st_blocks') else st.st_size,
+        'created': st.st_ctime,
+        'modified': st.st_mtime,
+        'accessed': st.st_atime,
+        'mtime_ns': st.st_mtime_ns,
+        'device': st.st_dev,
+        'inode': st.st_ino,
+    }
+
+
+def get_file_info(path, compute_hash=True, stats=None, algorithm=DEFAULT_ALGORITHM):
+    """Get detailed file information including metadata and, optionally, hash.
+    
+    With stats, the stat() call and any error are counted in it.
+    """
+    try:
+        if sys.platform == 'win32':
+            path = os.path.normpath(path)
         
-        if not tree1 and not tree2:
-            return jsonify({'error': 'Both directories are empty or inaccessible'}), 400
+        if stats is not None:
+            stats['stat_calls'] += 1
+        st = os.stat(path)
+        info = file_info_from_stat(st)
         
-        tree1_compared, tree2_compared = compare_nodes(tree1, tree2)
+        if compute_hash and stat.S_ISREG(st.st_mode):
+            info['digest'] = hash_file(path, stats, algorithm)
         
-        return jsonify({
-            'dir1': dir1,
-            'dir2': dir2,
-            'tree1': tree1_compared,
-            'tree2': tree2_compared
-        })
-    
+        return info
     except Exception as e:
-        import traceback
-        print(f"Error during comparison: {e}")
-        print(traceback.format_exc())
-        return jsonify({'error': str(e)}), 500
+        print(f"Error getting file info for {path}: {e}")
+        count_error(stats, e)
+        return None
 
 
-if __name__ == '__main__':
-    print("=" * 70)
-    print("xsukax Directory Tree Comparison Tool")
-    print("=" * 70)
-    print("\nStarting server on http://127.0.0.1:5000")
-    print("Press Ctrl+C to stop the server\n")
-    app.run(debug=True, host='127.0.0.1', port=5000)
\ No newline at end of file
+class Node:
+    """One file or folder of a scanned tree.
+    
+    Nodes use __slots__ and store their (interned) name plus a reference to
+    their parent instead of a full path string; paths are rebuilt on demand.
+    Digests are raw bytes (16 for MD5). The comparison annotates nodes in
+    place, and node_to_dict() converts a tree to the JSON schema only at the
+    API boundary. A 'file' that is not a regular file (a FIFO, socket or
+    device) has the file type bits of its mode in special; its content is
+    never read.
+    """
+    
+    __slots__ = ('name', 'type', 'parent', 'children', 'root_path',
+                 'size', 'size_on_disk', 'created', 'modified', 'accessed',
+                 'mtime_ns', 'device', 'inode', 'file_count', 'special',
+                 'digest', 'sample', 'status', 'decided_by', 'first_difference', 'rollup')
+    
+    def __init__(self, name, type, parent=None, root_path=None):
+        self.name = sys.intern(name)
+        self.type = type
+        self.parent = parent
+        self.root_path = root_path
+        self.children = [] if type == 'folder' else None
+        self.size = self.size_on_disk = None
+        self.created = self.modified = self.accessed = None
+        self.mtime_ns = self.device = self.inode = None
+        self.file_count = self.special = None
+        self.digest = self.sample = None
+        self.status = self.decided_by = self.first_difference = None
+        self.rollup = None
+    
+    @property
+    def path(self):
+        """Absolute path, rebuilt from the parent chain."""
+        parts = []
+        node = self
+        while node.parent is not None:
+            parts.append(node.name)
+            node = node.parent
+        return os.path.join(node.root_path, *reversed(parts))
+    
+    def set_stat(self, st):
+        """Copy the reported metadata from a stat result."""
+        self.size = st.st_size
+        self.size_on_disk = st.st_blocks * 512 if hasattr(st, 'st_blocks') else st.st_size
+        self.created = st.st_ctime
+        self.modified = st.st_mtime
+        self.accessed = st.st_atime
+        self.mtime_ns = st.st_mtime_ns
+        self.device = st.st_dev
+        self.inode = st.st_ino
+        self.special = None if stat.S_ISREG(st.st_mode) else stat.S_IFMT(st.st_mode)
+        return self
+
+
+NODE_FIELDS = ('size', 'size_on_disk', 'created', 'modified', 'accessed', 'mtime_ns', 'device', 'inode',
+               'file_count')
+NODE_ANNOTATIONS = ('status', 'decided_by', 'first_difference', 'rollup')
+
+
+def _node_fields(node, fields=NODE_FIELDS):
+    """Return the JSON fields of one node, digests as hex."""
+    data = {'type': node.type}
+    for key in fields:
+        value = getattr(node, key)
+        if value is not None:
+            data[key] = value
+    if node.digest is not None:
+        data['digest'] = node.digest.hex() or None
+    if node.sample is not None:
+        data['sample'] = node.sample.hex() or None
+    for key in NODE_ANNOTATIONS:
+        value = getattr(node, key)
+        if value is not None:
+            data[key] = value
+    return data
+
+
+def node_to_dict(node, differences_only=False):
+    """Convert a tree of Nodes to the nested dict schema returned by the API.
+    
+    With differences_only, entries whose status is 'same' are left out, which
+    drops fully identical subtrees without visiting them.
+    """
+    if node is None:
+        return None
+    root = {'name': node.name, 'path': node.path}
+    root.update(_node_fields(node))
+    stack = [(node, root)]
+    while stack:
+        current, data = stack.pop()
+        if current.children is None:
+            continue
+        data['children'] = []
+        for child in current.children:
+            if differences_only and child.status == 'same':
+                continue
+            child_data = {'name': child.name, 'path': os.path.join(data['path'], child.name)}
+            child_data.update(_node_fields(child))
+            data['children'].append(child_data)
+            stack.append((child, child_data))
+    return root
+
+
+def _is_symlink_loop(entry, folder_path):
+    """Tell whether a symlinked directory points at one of its own ancestors."""
+    target = os.path.realpath(entry.path)
+    here = os.path.realpath(folder_path)
+    return here == target or here.startswith(target.rstrip(os.sep) + os.sep)
+
+
+def _glob_to_regex(pattern):
+    """Translate one gitignore-style glob into a regex fragment.
+    
+    '*' and '?' stop at '/', '**' crosses folders and [...] is a character
+    class ('!' negates it); a backslash escapes the next character.
+    """
+    import re
+    
+    parts = []
+    i = 0
+    n = len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == '*':
+            if pattern.startswith('**', i):
+                if pattern.startswith('**/', i):
+                    parts.append('(?:.*/)?')
+                    i += 3
+                else:
+                    parts.append('.*')
+                    i += 2
+                continue
+            parts.append('[^/]*')
+        elif c == '?':
+            parts.append('[^/]')
+        elif c == '[':
+            end = pattern.find(']', i + 2 if pattern.startswith('[!', i) or pattern.startswith('[]', i) else i + 1)
+            if end < 0:
+                parts.append(re.escape(c))
+            else:
+                body = pattern[i + 1:end]
+                if body.startswith('!'):
+                    body = '^' + body[1:]
+                parts.append('[' + body.replace('\\', '\\\\') + ']')
+                i = end
+        elif c == '\\' and i + 1 < n:
+            i += 1
+            parts.append(re.escape(pattern[i]))
+        else:
+            parts.append(re.escape(c))
+        i += 1
+    return ''.join(parts)
+
+
+def compile_ignore_rules(lines, base=''):
+    """Compile gitignore-style lines into (regex, negate, dir_only) rules.
+    
+    Rules match '/'-separated paths relative to the walk root; base is the
+    relative folder the lines came from (a nested .gitignore). As in git, a
+    pattern containing a '/' is anchored to that folder, others match at any
+    depth below it, a trailing '/' only matches folders and a leading '!'
+    re-includes what an earlier rule excluded. Blank lines and '#' comments
+    are skipped. Raises ValueError for a pattern that does not compile.
+    """
+    import re
+    
+    flags = re.IGNORECASE if sys.platform == 'win32' else 0
+    prefix = re.escape(base + '/') if base else ''
+    rules = []
+    for line in lines:
+        pattern = line.rstrip('\r\n')
+        if not pattern.endswith('\\ '):
+            pattern = pattern.rstrip(' ')
+        if not pattern or pattern.startswith('#'):
+            continue
+        negate = pattern.startswith('!')
+        if negate or pattern.startswith('\\!') or pattern.startswith('\\#'):
+            pattern = pattern[1:]
+        dir_only = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+        if not pattern:
+            continue
+        anchored = '/' in pattern
+        body = _glob_to_regex(pattern.lstrip('/'))
+        try:
+            regex = re.compile(prefix + ('' if anchored else '(?:.*/)?') + body + r'\Z', flags)
+        except re.error as e:
+            raise ValueError(f'Invalid pattern {line.strip()!r}: {e}')
+        rules.append((regex, negate, dir_only))
+    return tuple(rules)
+
+
+def _combine_rules(rules):
+    """Merge rules without negations into one regex each for files and folders.
+    
+    Returns (file regex, folder regex), either None when nothing applies,
+    or None instead of the pair when a rule negates and order matters.
+    """
+    if any(negate for _, negate, _ in rules):
+        return None
+    import re
+    
+    def combine(selected):
+        if not selected:
+            return None
+        return re.compile('|'.join(f'(?:{regex.pattern})' for regex in selected), selected[0].flags)
+    return (combine([regex for regex, _, dir_only in rules if not dir_only]),
+            combine([regex for regex, _, _ in rules]))
+
+
+class WalkFilter:
+    """Which entries a walk keeps, decided before anything is stat()ed.
+    
+    exclude holds gitignore-style rules; with gitignore set, the .gitignore
+    file of every folder adds rules for that folder's subtree. include
+    globs, when given, are required of files only. max_depth limits how
+    deep folders are listed (1 lists the root only); min_size and max_size
+    bound file sizes. Patterns are compiled once, here and per .gitignore.
+    """
+    
+    def __init__(self, include=(), exclude=(), gitignore=False, max_depth=None,
+                 min_size=None, max_size=None):
+        # A file passes the include globs when any of them matches.
+        include = tuple((regex, False, False) for regex, _, _ in compile_ignore_rules(include))
+        self.include = _combine_rules(include)[0]
+        self.exclude = compile_ignore_rules(exclude)
+        self.gitignore = gitignore
+        self.max_depth = max_depth
+        self.min_size = min_size
+        self.max_size = max_size
+    
+    def root(self):
+        """Return the scope of the walk root."""
+        return WalkScope(self, '', 0, self.exclude, _combine_rules(self.exclude))
+
+
+class WalkScope:
+    """The rules in force in one folder of a walk (see WalkFilter)."""
+    
+    __slots__ = ('filter', 'rel', 'depth', 'rules', 'combined')
+    
+    def __init__(self, walk_filter, rel, depth, rules, combined):
+        self.filter = walk_filter
+        self.rel = rel
+        self.depth = depth
+        self.rules = rules
+        self.combined = combined
+    
+    @property
+    def may_list(self):
+        """Whether the folder is within max_depth and may be listed."""
+        return self.filter.max_depth is None or self.depth < self.filter.max_depth
+    
+    def enter(self, folder_path, names):
+        """Add the rules of the folder's own .gitignore, if one is listed."""
+        if self.filter.gitignore and '.gitignore' in names:
+            try:
+                with _open_regular(os.path.join(folder_path, '.gitignore'), 'r', encoding='utf-8',
+                                   errors='surrogateescape') as f:
+                    self.add_ignore_lines(f)
+            except (OSError, ValueError) as e:
+                print(f"Error reading {os.path.join(folder_path, '.gitignore')}: {e}")
+    
+    def add_ignore_lines(self, lines):
+        """Add .gitignore rules for this folder's subtree."""
+        rules = compile_ignore_rules(lines, self.rel)
+        if rules:
+            self.rules = self.rules + rules
+            self.combined = _combine_rules(self.rules)
+    
+    def keeps(self, name, is_dir):
+        """Tell whether an entry survives the exclude rules and include globs."""
+        rel = f'{self.rel}/{name}' if self.rel else name
+        if self.combined is not None:
+            regex = self.combined[is_dir]
+            if regex is not None and regex.match(rel):
+                return False
+        else:
+            # Negations present: the last rule that matches decides.
+            for regex, negate, dir_only in reversed(self.rules):
+                if (is_dir or not dir_only) and regex.match(rel):
+                    if not negate:
+                        return False
+                    break
+        if is_dir or self.filter.include is None:
+            return True
+        return self.filter.include.match(rel) is not None
+    
+    def keeps_size(self, size):
+        """Tell whether a file size is within min_size and max_size."""
+        walk_filter = self.filter
+        return ((walk_filter.min_size is None or size >= walk_filter.min_size)
+                and (walk_filter.max_size is None or size <= walk_filter.max_size))
+    
+    def child(self, name):
+        """Return the scope of a subfolder."""
+        return WalkScope(self.filter, f'{self.rel}/{name}' if self.rel else name, self.depth + 1,
+                         self.rules, self.combined)
+
+
+def _scan_children(folder, scope=None, stats=None):
+    """List one directory as child Nodes of folder, sorted by name.
+    
+    Folder children come back with an empty children list for the caller to
+    fill, and with their mtime_ns. Anything else becomes a 'file' Node,
+    with FIFOs, sockets and devices marked special by set_stat so that no
+    content strategy opens them. With a WalkScope, entries it rejects are
+    dropped using only the names and types from the listing, so excluded
+    folders are never opened and excluded files never stat()ed. With stats,
+    the listing, the stat() calls and skipped entries are counted. Raises
+    OSError if the directory itself cannot be listed.
+    """
+    folder_path = folder.path
+    with os.scandir(folder_path) as it:
+        entries = sorted(it, key=lambda e: e.name)
+    if stats is not None:
+        stats['dirs_listed'] += 1
+    if scope is not None:
+        scope.enter(folder_path, [entry.name for entry in entries])
+    
+    children = []
+    for entry in entries:
+        try:
+            if entry.is_dir():
+                if scope is not None and not scope.keeps(entry.name, True):
+                    continue
+                if entry.is_symlink() and _is_symlink_loop(entry, folder_path):
+                    continue
+                if stats is not None:
+                    stats['stat_calls'] += 1
+                child = Node(entry.name, 'folder', folder)
+                # Taken before the folder is listed, so a later change shows (see ResultCache).
+                child.mtime_ns = entry.stat().st_mtime_ns
+            else:
+                if scope is not None and not scope.keeps(entry.name, False):
+                    continue
+                if stats is not None:
+                    stats['stat_calls'] += 1
+                st = entry.stat()
+                if scope is not None and not scope.keeps_size(st.st_size):
+                    continue
+                child = Node(entry.name, 'file', folder).set_stat(st)
+        except OSError as e:
+            # Broken symlinks and entries removed during the walk
+            count_error(stats, e)
+            continue
+        children.append(child)
+    return children
+
+
+def _root_node(root_path):
+    """Stat the root of a walk and return its shallow Node, or None if missing."""
+    if sys.platform == 'win32':
+        root_path = os.path.normpath(root_path)
+    
+    try:
+        root_stat = os.stat(root_path)
+    except OSError:
+        return None
+    
+    from pathlib import Path
+    
+    path_obj = Path(root_path)
+    name = path_obj.name if path_obj.name else str(path_obj)
+    
+    if not stat.S_ISDIR(root_stat.st_mode):
+        return Node(name, 'file', root_path=str(root_path)).set_stat(root_stat)
+    root = Node(name, 'folder', root_path=str(root_path))
+    root.mtime_ns = root_stat.st_mtime_ns
+    return root
+
+
+def _build_node(root_path, engine=None, walk_filter=None):
+    """Collect the structure and metadata below root_path.
+    
+    The walk is iterative, so deep trees cannot hit the recursion limit, and
+    uses os.scandir so each entry's type comes from the directory listing and
+    its stat result is fetched at most once. With an engine, files,
+    system calls and errors are counted and merged into its stats, and its
+    cancel event is checked, once per directory (see merge_stats). A
+    WalkFilter prunes entries as they are listed.
+    """
+    stats = new_stats() if engine is not None else None
+    try:
+        root = _root_node(root_path)
+        scope = walk_filter.root() if walk_filter is not None else None
+        stack = [(root, scope)] if root and root.type == 'folder' else []
+        while stack:
+            folder, scope = stack.pop()
+            if scope is not None and not scope.may_list:
+                continue
+            if engine is not None:
+                engine.merge_stats(stats)
+                engine.check_cancelled()
+            try:
+                folder.children = _scan_children(folder, scope, stats)
+            except PermissionError as e:
+                count_error(stats, e)
+                continue
+            except Exception as e:
+                print(f"Error reading directory {folder.path}: {e}")
+                count_error(stats, e)
+                continue
+            subfolders = [c for c in folder.children if c.type == 'folder']
+            if stats is not None:
+                stats['files_scanned'] += len(folder.children) - len(subfolders)
+            stack.extend((c, scope and scope.child(c.name)) for c in subfolders)
+        
+        return root
+    except ComparisonCancelled:
+        raise
+    except Exception as e:
+        print(f"Error building tree for {root_path}: {e}")
+        return None
+    finally:
+        if engine is not None:
+            engine.merge_stats(stats)
+
+
+def iter_nodes(node):
+    """Yield every node of a tree, including the root."""
+    stack = [node] if node else []
+    while stack:
+        current = stack.pop()
+        yield current
+        if current.children:
+            stack.extend(current.children)
+
+
+def iter_files(node):
+    """Yield every file node of a tree."""
+    return (n for n in iter_nodes(node) if n.type == 'file')
+
+
+def build_tree(root_path, compute_hash=True, engine=None, walk_filter=None):
+    """Build a tree of Nodes for the directory with file information.
+    
+    With compute_hash=False only metadata is collected; compare_nodes then
+    hashes the files that actually need it. walk_filter (a WalkFilter)
+    leaves out excluded entries.
+    """
+    own_engine = engine is None
+    if own_engine:
+        engine = HashEngine(workers=1)
+    try:
+        with engine.span('walk'):
+            tree = _build_node(root_path, engine, walk_filter)
+        if tree and compute_hash:
+            with engine.span('hash'):
+                engine.hash_nodes(iter_files(tree))
+            with engine.span('digests'):
+                compute_folder_digests(tree, engine.algorithm)
+        return tree
+    finally:
+        if own_engine:
+            engine.close()
+
+
+def compute_folder_digests(root, algorithm=DEFAULT_ALGORITHM):
+    """Give every folder a Merkle digest, its total size and its file count.
+    
+    A folder's digest hashes the name, type and digest of each child in name
+    order, so two folders have equal digests exactly when their subtrees
+    hold the same names and contents. A folder with any file below it that
+    has no digest (not hashed, or unreadable) gets none; folders that
+    already carry a digest are left alone. Works bottom-up without recursion.
+    """
+    order = []
+    stack = [root] if root is not None and root.type == 'folder' else []
+    while stack:
+        folder = stack.pop()
+        if folder.digest is not None:
+            continue
+        order.append(folder)
+        stack.extend(c for c in folder.children if c.type == 'folder')
+    
+    for folder in reversed(order):
+        size = 0
+        file_count = 0
+        hasher = new_hasher(algorithm)
+        for child in sorted(folder.children, key=lambda c: c.name):
+            size += child.size or 0
+            file_count += (child.file_count or 0) if child.type == 'folder' else 1
+            if hasher is not None and child.digest:
+                tag = b'\0d' if child.type == 'folder' else b'\0f'
+                hasher.update(child.name.encode('utf-8', 'surrogateescape') + tag + child.digest)
+            else:
+                hasher = None
+        folder.size = size
+        folder.file_count = file_count
+        folder.digest = hasher.digest() if hasher is not None else None
+    return root
+
+
+def build_tree_pair(dir1, dir2, compute_hash, engine, snapshot=None, walk_filter=None):
+    """Walk both directories at the same time, then hash them on one pool.
+    
+    With a snapshot (a loaded manifest, or {} to just record folder mtimes)
+    the walk reuses unchanged folders and digests from it. When files were
+    hashed or digests reused, folder digests are computed too, so
+    compare_nodes can skip identical subtrees. walk_filter (a WalkFilter)
+    applies to both sides. Each walk counts into its own stats and merges
+    them into the engine's (see HashEngine.merge_stats).
+    """
+    with engine.span('walk'), \
+            concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix='walk') as walkers:
+        if snapshot is None:
+            future1 = walkers.submit(_build_node, dir1, engine, walk_filter)
+            future2 = walkers.submit(_build_node, dir2, engine, walk_filter)
+        else:
+            future1 = walkers.submit(_build_node_snapshot, dir1,
+                                     *snapshot_side(snapshot, 0, engine.algorithm), engine, walk_filter)
+            future2 = walkers.submit(_build_node_snapshot, dir2,
+                                     *snapshot_side(snapshot, 1, engine.algorithm), engine, walk_filter)
+        tree1, tree2 = future1.result(), future2.result()
+    if compute_hash:
+        with engine.span('hash'):
+            engine.hash_nodes(itertools.chain(iter_files(tree1), iter_files(tree2)))
+    if compute_hash or snapshot:
+        with engine.span('digests'):
+            compute_folder_digests(tree1, engine.algorithm)
+            compute_folder_digests(tree2, engine.algorithm)
+    return tree1, tree2
+
+
+def mark_unread(node, stats):
+    """Account for a file that was decided without reading its content."""
+    if node.type == 'file' and node.digest is None:
+        stats['bytes_skipped'] += node.size or 0
+
+
+ROLLUP_KEYS = ('same', 'different', 'missing', 'same_bytes', 'different_bytes', 'missing_bytes')
+
+
+def new_rollup():
+    """Create the per-folder file counts and byte totals filled in by the merge."""
+    return dict.fromkeys(ROLLUP_KEYS, 0)
+
+
+def _tally(file_node, status, size):
+    """Add one decided file (or file pair) to the rollup of its folder, if any."""
+    folder = file_node.parent
+    if folder is not None and folder.rollup is not None:
+        folder.rollup[status] += 1
+        folder.rollup[f'{status}_bytes'] += size or 0
+
+
+def _merge_nodes(node1, node2, stats, pending, folders):
+    """Pair two trees by name, annotating statuses in place.
+    
+    Same-size file pairs are queued in pending for resolve_pairs. Every
+    folder gets a rollup (shared by both sides of a folder pair) that files
+    are tallied into as they are decided; folders are appended to folders
+    as (folder1, folder2) in pre-order, for roll_up_folders. A folder facing
+    a file of the same name is 'different' and its contents are 'missing'.
+    """
+    stack = [(node1, node2)]
+    while stack:
+        node1, node2 = stack.pop()
+        if node1 is None or node2 is None:
+            node = node1 or node2
+            node.status = 'missing'
+            if node.type == 'folder':
+                node.rollup = new_rollup()
+                folders.append((node1, node2))
+                stack.extend((child, None) if node2 is None else (None, child) for child in node.children)
+            else:
+                mark_unread(node, stats)
+                _tally(node, 'missing', node.size)
+        elif node1.type == 'file' and node2.type == 'file':
+            if node1.size != node2.size:
+                mark_unread(node1, stats)
+                mark_unread(node2, stats)
+                _decide(node1, node2, 'different', 'metadata')
+            else:
+                pending.append((node1, node2))
+        elif node1.type == 'folder' and node2.type == 'folder':
+            if node1.digest and node1.digest == node2.digest:
+                _mark_identical(node1, node2)
+                stats['subtrees_skipped'] += 1
+                folders.append((node1, node2))
+                continue
+            node1.rollup = node2.rollup = new_rollup()
+            folders.append((node1, node2))
+            children2 = {c.name: c for c in node2.children}
+            for child in node1.children:
+                stack.append((child, children2.pop(child.name, None)))
+            for child in children2.values():
+                stack.append((None, child))
+        else:
+            node1.status = node2.status = 'different'
+            file_node, folder = (node1, node2) if node1.type == 'file' else (node2, node1)
+            mark_unread(file_node, stats)
+            _tally(file_node, 'different', file_node.size)
+            folder.rollup = new_rollup()
+            folders.append((folder, None) if folder is node1 else (None, folder))
+            stack.extend((child, None) if folder is node1 else (None, child) for child in folder.children)
+
+
+def _identical_rollup(folder):
+    rollup = new_rollup()
+    rollup['same'] = folder.file_count or 0
+    rollup['same_bytes'] = folder.size or 0
+    return rollup
+
+
+def _mark_identical(folder1, folder2):
+    """Mark two folders with equal digests, and everything below them, 'same'.
+    
+    Their rollups come from the totals compute_folder_digests stored, so the
+    children are never paired.
+    """
+    for folder in (folder1, folder2):
+        for node in iter_nodes(folder):
+            node.status = 'same'
+            if node.type == 'folder':
+                node.rollup = _identical_rollup(node)
+            else:
+                node.decided_by = 'full'
+    folder1.rollup = folder2.rollup = _identical_rollup(folder1)
+
+
+def roll_up_folders(folders):
+    """Sum folder rollups into their parents and derive folder pair statuses.
+    
+    folders is the pre-order list built by _merge_nodes, so walking it
+    backwards visits every folder after all of its subfolders. A folder pair
+    is 'same' only when nothing below it differs or is missing.
+    """
+    for folder1, folder2 in reversed(folders):
+        folder = folder1 or folder2
+        rollup = folder.rollup
+        if folder1 is not None and folder2 is not None:
+            status = 'different' if rollup['different'] or rollup['missing'] else 'same'
+            folder1.status = folder2.status = status
+        parent = folder.parent
+        if parent is not None and parent.rollup is not None:
+            for key in ROLLUP_KEYS:
+                parent.rollup[key] += rollup[key]
+
+
+def _decide(file1, file2, status, decided_by):
+    file1.status = file2.status = status
+    file1.decided_by = file2.decided_by = decided_by
+    _tally(file1, status, max(file1.size or 0, file2.size or 0))
+
+
+def resolve_pairs(pairs, engine, strategy='full', escalate=False):
+    """Decide same/different for same-size file pairs.
+    
+    'metadata' compares mtimes only, 'sample' hashes a few blocks of each file,
+    'full' hashes everything and 'bytes' reads both files side by side,
+    stopping at the first differing block and recording its offset in
+    first_difference. Pairs a cheaper strategy finds different are
+    re-checked with a full hash when escalate is set. Each file records the
+    strategy that made the final call in decided_by. Special files are
+    never read: a pair is 'same' when both are the same kind of special
+    file (the sizes already match), and decided by metadata.
+    """
+    full = []
+    sampled = []
+    direct = []
+    for file1, file2 in pairs:
+        if file1.special or file2.special:
+            _decide(file1, file2, 'same' if file1.special == file2.special else 'different', 'metadata')
+        elif file1.digest and file2.digest:
+            _decide(file1, file2, 'same' if file1.digest == file2.digest else 'different', 'full')
+        elif strategy == 'metadata':
+            if file1.mtime_ns == file2.mtime_ns:
+                _decide(file1, file2, 'same', 'metadata')
+            elif escalate:
+                full.append((file1, file2))
+            else:
+                _decide(file1, file2, 'different', 'metadata')
+        elif strategy == 'sample' and not sample_covers_file(file1.size or 0, engine.sample_blocks):
+            sampled.append((file1, file2))
+        elif strategy == 'bytes':
+            direct.append((file1, file2))
+        else:
+            full.append((file1, file2))
+    
+    direct_paths = [(file1.path, file2.path) for file1, file2 in direct]
+    engine.plan(sum(2 * (file1.size or 0) for file1, _ in direct))
+    results = engine.compare_pairs(direct_paths)
+    for (file1, file2), paths in zip(direct, direct_paths):
+        equal, offset, bytes_read = results[paths]
+        _decide(file1, file2, 'same' if equal else 'different', 'bytes')
+        if offset is not None:
+            file1.first_difference = file2.first_difference = offset
+        engine.stats['bytes_skipped'] += max(0, 2 * (file1.size or 0) - bytes_read)
+    
+    engine.sample_nodes(node for pair in sampled for node in pair)
+    for file1, file2 in sampled:
+        if file1.sample and file1.sample == file2.sample:
+            _decide(file1, file2, 'same', 'sample')
+        elif escalate or not (file1.sample and file2.sample):
+            full.append((file1, file2))
+        else:
+            _decide(file1, file2, 'different', 'sample')
+    
+    engine.hash_nodes(node for pair in full for node in pair)
+    for file1, file2 in full:
+        _decide(file1, file2, 'same' if file1.digest and file1.digest == file2.digest else 'different', 'full')
+    
+    for file1, file2 in pairs:
+        for node in (file1, file2):
+            if node.digest is not None or node.decided_by == 'bytes':
+                continue
+            if node.sample is not None:
+                size = node.size or 0
+                sampled_bytes = len(sample_offsets(size, engine.sample_blocks)) * SAMPLE_BLOCK_SIZE
+                engine.stats['bytes_skipped'] += max(0, size - sampled_bytes)
+            else:
+                mark_unread(node, engine.stats)
+
+
+def compare_nodes(node1, node2, engine=None, strategy='full', escalate=False):
+    """Compare two trees and annotate their nodes with status information.
+    
+    Files are paired by name first; content is only examined when both sides
+    exist with the same size, and all such pairs are resolved in one batch on
+    the engine's pool (see resolve_pairs). Everything else is decided from
+    metadata. Folders get a rollup of the same/different/missing file counts
+    and bytes below them, and folder pairs are 'different' when anything
+    below them is. Folder pairs whose Merkle digests (see
+    compute_folder_digests) already match are marked identical without
+    pairing their contents, and folder digests are filled in afterwards
+    wherever every file below was hashed. Returns the two (annotated) roots.
+    """
+    own_engine = engine is None
+    if own_engine:
+        engine = HashEngine(workers=1)
+    try:
+        pending = []
+        folders = []
+        with engine.span('merge'):
+            _merge_nodes(node1, node2, engine.stats, pending, folders)
+        with engine.span('hash'):
+            resolve_pairs(pending, engine, strategy, escalate)
+        with engine.span('merge'):
+            roll_up_folders(folders)
+        with engine.span('digests'):
+            compute_folder_digests(node1, engine.algorithm)
+            compute_folder_digests(node2, engine.algorithm)
+        return node1, node2
+    finally:
+        if own_engine:
+            engine.close()
+
+
+def iter_relative_files(root):
+    """Yield (relative path, file node) for every file of a tree."""
+    stack = [('', root)] if root else []
+    while stack:
+        rel, node = stack.pop()
+        if node.type == 'file':
+            yield rel, node
+        elif node.children:
+            stack.extend((f'{rel}/{c.name}' if rel else c.name, c) for c in node.children)
+
+
+def _storage_key(node):
+    # Hard links to one inode are a single copy on disk.
+    return (node.device, node.inode) if node.inode else id(node)
+
+
+def find_moves(tree1, tree2, engine):
+    """Match files that exist on one side only with files of equal content.
+    
+    Only files whose size also occurs among the one-sided files of the other
+    tree can match, so only those are hashed. Returns (moves, copies):
+    moves pairs a left-only file with a right-only one ('renamed' when both
+    are in the same folder, 'moved' otherwise), preferring pairs with the
+    same name and then the same folder; copies lists the remaining
+    one-sided files whose content still exists elsewhere on the other side.
+    Empty and unreadable files are never matched.
+    """
+    files1 = list(iter_relative_files(tree1))
+    files2 = list(iter_relative_files(tree2))
+    only1_sizes = {node.size for _, node in files1 if node.status == 'missing' and node.size}
+    only2_sizes = {node.size for _, node in files2 if node.status == 'missing' and node.size}
+    if not only1_sizes and not only2_sizes:
+        return [], []
+    sizes1 = {node.size for _, node in files1}
+    sizes2 = {node.size for _, node in files2}
+    
+    # A left-only file can match any right file of its size, and the other
+    # way round; nothing else needs a digest.
+    candidates1 = [(rel, node) for rel, node in files1 if node.size in only2_sizes or
+                   (node.status == 'missing' and node.size in sizes2)]
+    candidates2 = [(rel, node) for rel, node in files2 if node.size in only1_sizes or
+                   (node.status == 'missing' and node.size in sizes1)]
+    engine.hash_nodes(node for _, node in itertools.chain(candidates1, candidates2))
+    
+    indexes = ({}, {})
+    one_sided = {}
+    for side, candidates in ((0, candidates1), (1, candidates2)):
+        for rel, node in candidates:
+            if not node.digest:
+                continue
+            indexes[side].setdefault(node.digest, []).append(rel)
+            if node.status == 'missing' and node.size:
+                one_sided.setdefault(node.digest, (node.size, [], []))[1 + side].append(rel)
+    
+    moves = []
+    copies = []
+    for digest, (size, lefts, rights) in one_sided.items():
+        lefts.sort()
+        rights.sort()
+        for key in (_base_name, _folder_of, None):
+            if not lefts or not rights:
+                break
+            available = {}
+            for rel2 in reversed(rights):
+                available.setdefault(key and key(rel2), []).append(rel2)
+            unmatched = []
+            for rel1 in lefts:
+                bucket = available.get(key and key(rel1))
+                if not bucket:
+                    unmatched.append(rel1)
+                    continue
+                rel2 = bucket.pop()
+                moves.append({'kind': 'renamed' if _folder_of(rel1) == _folder_of(rel2) else 'moved',
+                              'from': rel1, 'to': rel2, 'size': size, 'digest': digest.hex()})
+            lefts = unmatched
+            rights = sorted(rel2 for bucket in available.values() for rel2 in bucket)
+        for side, rels, other in (('left', lefts, indexes[1]), ('right', rights, indexes[0])):
+            if digest in other:
+                copies.extend({'side': side, 'path': rel, 'same_as': sorted(other[digest]),
+                               'size': size, 'digest': digest.hex()} for rel in rels)
+    moves.sort(key=lambda move: move['from'])
+    copies.sort(key=lambda copy: (copy['side'], copy['path']))
+    return moves, copies
+
+
+def _base_name(rel):
+    return rel.rpartition('/')[2]
+
+
+def _folder_of(rel):
+    return rel.rpartition('/')[0]
+
+
+def find_duplicates(tree, engine):
+    """Group the files of one tree that have the same content.
+    
+    Files are bucketed by size first and only buckets with more than one
+    file are hashed. Each group lists its paths and the bytes that all but
+    one copy waste (hard links to the same inode count as one copy).
+    Returns {'groups': [...], 'wasted_bytes': total}, biggest waste first.
+    """
+    buckets = {}
+    for rel, node in iter_relative_files(tree):
+        if node.size:
+            buckets.setdefault(node.size, []).append((rel, node))
+    buckets = {size: files for size, files in buckets.items() if len(files) > 1}
+    engine.hash_nodes(node for files in buckets.values() for _, node in files)
+    
+    groups = []
+    for size, files in buckets.items():
+        by_digest = {}
+        for rel, node in files:
+            if node.digest:
+                by_digest.setdefault(node.digest, []).append((rel, node))
+        for digest, members in by_digest.items():
+            if len(members) < 2:
+                continue
+            copies = len({_storage_key(node) for _, node in members})
+            groups.append({'digest': digest.hex(), 'size': size,
+                           'paths': sorted(rel for rel, _ in members),
+                           'wasted_bytes': size * (copies - 1)})
+    groups.sort(key=lambda group: (-group['wasted_bytes'], group['paths'][0]))
+    return {'groups': groups, 'wasted_bytes': sum(group['wasted_bytes'] for group in groups)}
+
+
+MANIFEST_VERSION = 1
+
+
+def _manifest_side(node):
+    """Return the [type, size, mtime_ns, inode, digest] record of a node, or None."""
+    if not node:
+        return None
+    digest = node.digest.hex() or None if node.digest is not None else None
+    return [node.type, node.size, node.mtime_ns, node.inode, digest]
+
+
+def flatten_comparison(tree1, tree2):
+    """Flatten two compared trees into {relative path: [status, left, right]}."""
+    flat = {}
+    stack = [('', tree1, tree2)]
+    while stack:
+        rel, node1, node2 = stack.pop()
+        status = (node1 or node2).status
+        flat[rel] = [status, _manifest_side(node1), _manifest_side(node2)]
+        children1 = {c.name: c for c in (node1 and node1.children or ())}
+        children2 = {c.name: c for c in (node2 and node2.children or ())}
+        for name in children1.keys() | children2.keys():
+            stack.append((f'{rel}/{name}' if rel else name, children1.get(name), children2.get(name)))
+    return flat
+
+
+def save_manifest(path, dir1, dir2, algorithm, flat, filters=None):
+    """Write a comparison snapshot as gzip-compressed JSON."""
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'kind': 'pair',
+        'dir1': dir1,
+        'dir2': dir2,
+        'algorithm': algorithm,
+        'filters': filters,
+        'created': time.time(),
+        'entries': [[rel, *row] for rel, row in sorted(flat.items())],
+    }
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = f'{path}.tmp'
+    with gzip.open(tmp_path, 'wt', encoding='utf-8', compresslevel=6) as f:
+        json.dump(manifest, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+
+def load_manifest(path):
+    """Read a snapshot written by save_manifest; entries become {rel: [status, left, right]}."""
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        manifest = json.load(f)
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise ValueError(f'Unsupported manifest version: {manifest.get("version")}')
+    if manifest.get('kind', 'pair') != 'pair':
+        raise ValueError('Not a comparison manifest (it describes a single tree)')
+    manifest['entries'] = {row[0]: row[1:] for row in manifest['entries']}
+    return manifest
+
+
+def snapshot_side(manifest, side, algorithm):
+    """Index one side of a manifest for _build_node_snapshot.
+    
+    Returns {rel: [type, size, mtime_ns, inode, digest]} and {folder rel:
+    sorted child names}. Digests are dropped when they were computed with a
+    different algorithm.
+    """
+    records = {}
+    children = {}
+    if manifest:
+        same_algorithm = manifest.get('algorithm') == algorithm
+        for rel, row in manifest['entries'].items():
+            record = row[1 + side]
+            if record is None:
+                continue
+            if not same_algorithm:
+                record = record[:4] + [None]
+            records[rel] = record
+            if rel:
+                parent, _, name = rel.rpartition('/')
+                children.setdefault(parent, []).append(name)
+    for names in children.values():
+        names.sort()
+    return records, children
+
+
+def _child_from_stat(folder, folder_path, name):
+    """Build a shallow child Node by stat()ing one known entry name."""
+    st = os.stat(os.path.join(folder_path, name))
+    if stat.S_ISDIR(st.st_mode):
+        return Node(name, 'folder', folder)
+    return Node(name, 'file', folder).set_stat(st)
+
+
+def _build_node_snapshot(root_path, records, children_index, engine, walk_filter=None):
+    """Walk a tree, reusing what a previous snapshot already knows.
+    
+    A folder whose mtime_ns matches the snapshot is not listed again: its
+    entries are taken from the snapshot and only re-stat()ed. A file whose
+    size, mtime_ns and inode are unchanged inherits its digest. Folders get
+    an mtime_ns so the next snapshot can do the same. The snapshot must
+    have been taken with the same walk_filter; reused entries are still
+    checked against it, since sizes and .gitignore files may have changed.
+    Counters are merged into the engine's stats once per directory.
+    """
+    stats = new_stats()
+    try:
+        root = _root_node(root_path)
+        if root and root.type == 'file':
+            return root
+        scope = walk_filter.root() if walk_filter is not None else None
+        stack = [(root, '', scope)] if root else []
+        while stack:
+            folder, rel, scope = stack.pop()
+            folder_path = folder.path
+            engine.merge_stats(stats)
+            engine.check_cancelled()
+            try:
+                folder_stat = os.stat(folder_path)
+                folder.mtime_ns = folder_stat.st_mtime_ns
+                folder.inode = folder_stat.st_ino
+                if scope is not None and not scope.may_list:
+                    continue
+                previous = records.get(rel)
+                if previous and previous[0] == 'folder' and previous[2] == folder_stat.st_mtime_ns:
+                    names = children_index.get(rel, ())
+                    if scope is not None:
+                        scope.enter(folder_path, names)
+                    children = []
+                    stats['stat_calls'] += len(names)
+                    for name in names:
+                        try:
+                            child = _child_from_stat(folder, folder_path, name)
+                        except OSError as e:
+                            count_error(stats, e)
+                            continue
+                        if scope is None or (scope.keeps(name, child.type == 'folder') and
+                                             (child.type == 'folder' or scope.keeps_size(child.size))):
+                            children.append(child)
+                    stats['dirs_reused'] += 1
+                else:
+                    children = _scan_children(folder, scope, stats)
+            except PermissionError as e:
+                count_error(stats, e)
+                continue
+            except Exception as e:
+                print(f"Error reading directory {folder_path}: {e}")
+                count_error(stats, e)
+                continue
+            
+            folder.children = children
+            for child in children:
+                child_rel = f'{rel}/{child.name}' if rel else child.name
+                if child.type == 'folder':
+                    stack.append((child, child_rel, scope and scope.child(child.name)))
+                    continue
+                stats['files_scanned'] += 1
+                previous = records.get(child_rel)
+                if (previous and previous[0] == 'file' and previous[4]
+                        and previous[1:4] == [child.size, child.mtime_ns, child.inode]):
+                    child.digest = bytes.fromhex(previous[4])
+                    stats['manifest_hits'] += 1
+        
+        return root
+    except ComparisonCancelled:
+        raise
+    except Exception as e:
+        print(f"Error building tree for {root_path}: {e}")
+        return None
+    finally:
+        engine.merge_stats(stats)
+
+
+def _delta_key(row):
+    """The parts of a flattened row that count as a change between runs.
+    
+    A folder's status, size and digest are derived from its contents, whose
+    changes are reported on their own, so only its type counts.
+    """
+    status, left, right = row
+    if left and right and left[0] == right[0] == 'folder':
+        status = None
+    
+    def side_key(side):
+        return side and ((side[0], side[1], side[4]) if side[0] == 'file' else (side[0],))
+    return (status, side_key(left), side_key(right))
+
+
+def manifest_delta(previous, current):
+    """List the entries that were added, removed or changed since a snapshot."""
+    delta = []
+    for rel in sorted(previous.keys() | current.keys()):
+        old, new = previous.get(rel), current.get(rel)
+        if old is None:
+            change = 'added'
+        elif new is None:
+            change = 'removed'
+        elif _delta_key(old) != _delta_key(new):
+            change = 'changed'
+        else:
+            continue
+        row = new or old
+        delta.append({
+            'path': rel,
+            'change': change,
+            'status': new and new[0],
+            'previous_status': old and old[0],
+            'left': row[1] and dict(zip(('type', 'size', 'mtime_ns', 'inode', 'digest'), row[1])),
+            'right': row[2] and dict(zip(('type', 'size', 'mtime_ns', 'inode', 'digest'), row[2])),
+        })
+    return delta
+
+
+TREE_RECORD_FIELDS = ('type', 'size', 'mtime_ns', 'inode', 'digest')
+
+
+def save_tree_manifest(path, root_path, algorithm, tree, filters=None):
+    """Write the digest manifest of one hashed tree as gzip-compressed JSON.
+    
+    Entries are [rel, type, size, mtime_ns, inode, digest] rows in pre-order,
+    folders included with their Merkle digests, so two manifests can be
+    compared later by diff_digest_trees without the directories at hand.
+    filters records the walk filter options the tree was built with.
+    """
+    entries = []
+    stack = [('', tree)]
+    while stack:
+        rel, node = stack.pop()
+        entries.append([rel, *_manifest_side(node)])
+        for child in sorted(node.children or (), key=lambda c: c.name, reverse=True):
+            stack.append((f'{rel}/{child.name}' if rel else child.name, child))
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'kind': 'tree',
+        'root': root_path,
+        'algorithm': algorithm,
+        'filters': filters,
+        'created': time.time(),
+        'entries': entries,
+    }
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = f'{path}.tmp'
+    with gzip.open(tmp_path, 'wt', encoding='utf-8', compresslevel=6) as f:
+        json.dump(manifest, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(tmp_path, path)
+    return manifest
+
+
+def load_tree_manifest(path):
+    """Read a manifest written by save_tree_manifest back into a Node tree.
+    
+    Returns the manifest with 'tree' in place of 'entries'. Folder sizes and
+    file counts are recomputed; folder digests are kept as saved. The root
+    does not have to exist on this host.
+    """
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        manifest = json.load(f)
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise ValueError(f'Unsupported manifest version: {manifest.get("version")}')
+    if manifest.get('kind') != 'tree':
+        raise ValueError('Not a tree digest manifest')
+    
+    root = None
+    folders = {}
+    for rel, node_type, size, mtime_ns, inode, digest in manifest.pop('entries'):
+        if rel:
+            parent_rel, _, name = rel.rpartition('/')
+            parent = folders.get(parent_rel)
+            if parent is None:
+                raise ValueError(f'Manifest entry {rel!r} appears before its folder')
+            node = Node(name, node_type, parent)
+            parent.children.append(node)
+        else:
+            root_path = manifest['root']
+            root = node = Node(os.path.basename(os.path.normpath(root_path)) or root_path, node_type,
+                               root_path=root_path)
+        node.size, node.mtime_ns, node.inode = size, mtime_ns, inode
+        node.digest = bytes.fromhex(digest) if digest else None
+        if node_type == 'folder':
+            folders[rel] = node
+    if root is None:
+        raise ValueError('Manifest has no root entry')
+    
+    for folder in reversed(list(folders.values())):
+        folder.size = sum(c.size or 0 for c in folder.children)
+        folder.file_count = sum((c.file_count or 0) if c.type == 'folder' else 1
+                                for c in folder.children)
+    manifest['tree'] = root
+    return manifest
+
+
+def _digest_record(node):
+    if node is None:
+        return None
+    record = {'type': node.type}
+    for key in TREE_RECORD_FIELDS[1:]:
+        value = getattr(node, key)
+        if value is not None:
+            record[key] = value.hex() if key == 'digest' else value
+    return record
+
+
+def diff_digest_trees(tree1, tree2, stats):
+    """Compare two digest trees, descending only where folder digests differ.
+    
+    Meant for trees loaded from digest manifests, so nothing is read from
+    disk. Returns (differences, rollup): one {path, status, left, right}
+    record per differing or missing entry (a missing folder is reported
+    once, with its file count and size), and file counts and bytes by
+    status. Identical subtrees count towards the rollup through their
+    stored totals and are not visited; stats records how many were skipped
+    and how many entries were looked at.
+    """
+    rollup = new_rollup()
+    differences = []
+    
+    def add(rel, status, node1, node2):
+        node = node1 or node2
+        files = (node.file_count or 0) if node.type == 'folder' else 1
+        size = max(node1 and node1.size or 0, node2 and node2.size or 0)
+        rollup[status] += files
+        rollup[f'{status}_bytes'] += size
+        if status != 'same':
+            differences.append({'path': rel, 'status': status,
+                                'left': _digest_record(node1), 'right': _digest_record(node2)})
+    
+    stack = [('', tree1, tree2)]
+    while stack:
+        rel, node1, node2 = stack.pop()
+        stats['entries_visited'] += 1
+        if node1 is None or node2 is None:
+            add(rel, 'missing', node1, node2)
+        elif node1.type != node2.type:
+            add(rel, 'different', node1, node2)
+        elif node1.digest and node1.digest == node2.digest:
+            if node1.type == 'folder':
+                stats['subtrees_skipped'] += 1
+            add(rel, 'same', node1, node2)
+        elif node1.type == 'file':
+            add(rel, 'different', node1, node2)
+        else:
+            children1 = {c.name: c for c in node1.children}
+            children2 = {c.name: c for c in node2.children}
+            for name in sorted(children1.keys() | children2.keys(), reverse=True):
+                stack.append((f'{rel}/{name}' if rel else name, children1.get(name), children2.get(name)))
+    return differences, rollup
+
+
+def _archive_parts(name):
+    """Split an archive member name into path parts, dropping '', '.' and '..'."""
+    return [part for part in name.replace('\\', '/').split('/') if part not in ('', '.', '..')]
+
+
+def _hash_stream(f, algorithm, buffer_size=DEFAULT_BUFFER_SIZE):
+    """Hash a readable file object; returns (digest bytes, bytes read)."""
+    hasher = new_hasher(algorithm)
+    bytes_read = 0
+    while True:
+        chunk = f.read(buffer_size)
+        if not chunk:
+            break
+        hasher.update(chunk)
+        bytes_read += len(chunk)
+    return hasher.digest(), bytes_read
+
+
+def _filter_archive_tree(root, walk_filter, ignore_files):
+    """Drop the entries of an archive tree that walk_filter excludes.
+    
+    ignore_files maps folder paths to the lines of their .gitignore, read
+    from the archive.
+    """
+    stack = [(root, walk_filter.root())]
+    while stack:
+        folder, scope = stack.pop()
+        if not scope.may_list:
+            folder.children = []
+            continue
+        if walk_filter.gitignore and scope.rel in ignore_files:
+            scope.add_ignore_lines(ignore_files[scope.rel])
+        kept = []
+        for child in folder.children:
+            if child.type == 'folder':
+                if scope.keeps(child.name, True):
+                    kept.append(child)
+                    stack.append((child, scope.child(child.name)))
+            elif scope.keeps(child.name, False) and scope.keeps_size(child.size or 0):
+                kept.append(child)
+        folder.children = kept
+
+
+def build_archive_tree(path, engine, walk_filter=None):
+    """Read a tar or zip archive as a hashed tree of Nodes, without extracting it.
+    
+    Tar archives (plain or compressed) are read as a stream in one pass,
+    hashing every regular file as it goes by; zip archives are listed first,
+    so only the members that walk_filter keeps are read. Folders come from
+    the member names, symlinks and special members are skipped and hard
+    links take the digest of their target. Only sizes and modification
+    times are known. Members that cannot be read get b'' as digest. Raises
+    ValueError if path is not a readable archive.
+    """
+    import tarfile
+    import zipfile
+    
+    stats = engine.stats
+    root = Node(os.path.basename(os.path.normpath(path)), 'folder', root_path=path)
+    folders = {'': root}
+    files = {}
+    ignore_files = {}
+    
+    def folder_node(parts):
+        node = root
+        for depth, name in enumerate(parts, 1):
+            rel = '/'.join(parts[:depth])
+            child = folders.get(rel)
+            if child is None:
+                if rel in files:
+                    return None
+                child = folders[rel] = Node(name, 'folder', node)
+                node.children.append(child)
+            node = child
+        return node
+    
+    def file_node(parts, size, mtime):
+        rel = '/'.join(parts)
+        parent = folder_node(parts[:-1])
+        if parent is None or rel in folders:
+            return None
+        previous = files.pop(rel, None)
+        if previous is not None:
+            # A later member of the same name replaces the earlier one.
+            parent.children.remove(previous)
+        node = files[rel] = Node(parts[-1], 'file', parent)
+        node.size = node.size_on_disk = size
+        node.modified = mtime
+        node.mtime_ns = int(mtime * 1_000_000_000)
+        parent.children.append(node)
+        return node
+    
+    def read_member(node, f, ignore_folder=None):
+        # With ignore_folder, the member is that folder's .gitignore and is kept.
+        try:
+            with f:
+                if ignore_folder is not None:
+                    data = f.read()
+                    ignore_files[ignore_folder] = data.decode('utf-8', 'surrogateescape').splitlines()
+                    hasher = new_hasher(engine.algorithm)
+                    hasher.update(data)
+                    digest, bytes_read = hasher.digest(), len(data)
+                else:
+                    digest, bytes_read = _hash_stream(f, engine.algorithm, engine.buffer_size)
+        except Exception as e:
+            count_error(stats, e)
+            node.digest = b''
+            return
+        node.digest = digest
+        stats['files_hashed'] += 1
+        stats['bytes_read'] += bytes_read
+    
+    wants_ignore_files = walk_filter is not None and walk_filter.gitignore
+    try:
+        if zipfile.is_zipfile(path):
+            with zipfile.ZipFile(path) as archive:
+                members = {}
+                for info in archive.infolist():
+                    engine.check_cancelled()
+                    parts = _archive_parts(info.filename)
+                    if not parts or stat.S_ISLNK(info.external_attr >> 16):
+                        continue
+                    mtime = time.mktime(info.date_time + (0, 0, -1))
+                    if info.is_dir():
+                        node = folder_node(parts)
+                        if node is not None:
+                            node.modified, node.mtime_ns = mtime, int(mtime * 1_000_000_000)
+                        continue
+                    node = file_node(parts, info.file_size, mtime)
+                    if node is None:
+                        continue
+                    members[node] = info
+                    if wants_ignore_files and parts[-1] == '.gitignore':
+                        read_member(node, archive.open(info), '/'.join(parts[:-1]))
+                if walk_filter is not None:
+                    _filter_archive_tree(root, walk_filter, ignore_files)
+                for node in iter_files(root):
+                    engine.check_cancelled()
+                    if node.digest is None:
+                        read_member(node, archive.open(members[node]))
+        else:
+            with tarfile.open(path, 'r|*') as archive:
+                for member in archive:
+                    engine.check_cancelled()
+                    parts = _archive_parts(member.name)
+                    if not parts:
+                        continue
+                    if member.isdir():
+                        node = folder_node(parts)
+                        if node is not None:
+                            node.modified, node.mtime_ns = member.mtime, member.mtime * 1_000_000_000
+                    elif member.islnk():
+                        target = files.get('/'.join(_archive_parts(member.linkname)))
+                        node = file_node(parts, target.size if target else 0, member.mtime)
+                        if node is not None:
+                            node.digest = target.digest if target else b''
+                    elif member.isreg():
+                        node = file_node(parts, member.size, member.mtime)
+                        if node is not None:
+                            is_ignore_file = wants_ignore_files and parts[-1] == '.gitignore'
+                            read_member(node, archive.extractfile(member),
+                                        '/'.join(parts[:-1]) if is_ignore_file else None)
+                if walk_filter is not None:
+                    _filter_archive_tree(root, walk_filter, ignore_files)
+    except (OSError, EOFError, tarfile.TarError, zipfile.BadZipFile) as e:
+        raise ValueError(f'Cannot read archive {path}: {e}') from None
+    
+    for node in iter_nodes(root):
+        if node.children:
+            node.children.sort(key=lambda c: c.name)
+    stats['files_scanned'] += sum(1 for _ in iter_files(root))
+    compute_folder_digests(root, engine.algorithm)
+    return root
+
+
+STREAM_FIELDS = ('type', 'size', 'size_on_disk', 'created', 'modified', 'accessed', 'digest')
+
+
+def _stream_side(node):
+    """Reduce a node to the fields carried by a streamed diff record."""
+    if node is None:
+        return None
+    side = {'type': node.type}
+    for key in STREAM_FIELDS[1:-1]:
+        value = getattr(node, key)
+        if value is not None:
+            side[key] = value
+    if node.digest is not None:
+        side['digest'] = node.digest.hex() or None
+    return side
+
+
+def _list_for_stream(folder, scope=None, stats=None):
+    """Return {name: child Node} for one directory of a streamed walk."""
+    if folder is None or (scope is not None and not scope.may_list):
+        return {}
+    try:
+        return {c.name: c for c in _scan_children(folder, scope, stats)}
+    except PermissionError as e:
+        count_error(stats, e)
+        return {}
+    except Exception as e:
+        print(f"Error reading directory {folder.path}: {e}")
+        count_error(stats, e)
+        return {}
+
+
+def iter_compare(dir1, dir2, engine, compute_hash=False, strategy='full', escalate=False,
+                 walk_filter=None):
+    """Walk both trees in lockstep and yield one diff record per entry.
+    
+    Directories are listed and compared one pair at a time, so memory is
+    bounded by the fan-out of the directories on the current path rather
+    than by the size of the trees. Records come out depth-first, parents
+    before their children, with relative '/'-separated paths; the root is
+    the record with path ''. A folder's entry record is written before its
+    contents are known, so once they are, a 'folder' record follows with
+    the folder's final status and rollup, as compare_nodes reports them.
+    A folder facing a file of the same name is 'different' and its
+    contents are 'missing'. walk_filter (a WalkFilter) prunes both sides.
+    """
+    root1, root2 = _root_node(dir1), _root_node(dir2)
+    yield {'event': 'entry', 'path': '', 'status': 'same' if root1 and root2 else 'missing',
+           'left': _stream_side(root1), 'right': _stream_side(root2),
+           'name1': root1 and root1.name, 'name2': root2 and root2.name}
+    
+    scope = walk_filter.root() if walk_filter is not None else None
+    stack = [('open', '', root1 if root1 and root1.type == 'folder' else None,
+              root2 if root2 and root2.type == 'folder' else None, scope, scope and walk_filter.root(),
+              None if root1 and root2 else 'missing', None)]
+    while stack:
+        entry = stack.pop()
+        if entry[0] == 'close':
+            _, rel, status, rollup, parent_rollup = entry
+            if status is None:
+                status = 'different' if rollup['different'] or rollup['missing'] else 'same'
+            if parent_rollup is not None:
+                for key in ROLLUP_KEYS:
+                    parent_rollup[key] += rollup[key]
+            yield {'event': 'folder', 'path': rel, 'status': status, 'rollup': rollup}
+            continue
+        
+        _, rel, folder1, folder2, scope1, scope2, folder_status, parent_rollup = entry
+        if folder1 is None and folder2 is None:
+            continue
+        engine.check_cancelled()
+        rollup = new_rollup()
+        children1 = _list_for_stream(folder1, scope1, engine.stats)
+        children2 = _list_for_stream(folder2, scope2, engine.stats)
+        engine.stats['files_scanned'] += sum(
+            1 for c in itertools.chain(children1.values(), children2.values()) if c.type == 'file')
+        
+        records = []
+        pending = []
+        pairs = []
+        subdirs = []
+        for name in sorted(children1.keys() | children2.keys()):
+            c1, c2 = children1.get(name), children2.get(name)
+            child_rel = f'{rel}/{name}' if rel else name
+            type1, type2 = c1 and c1.type, c2 and c2.type
+            
+            if compute_hash:
+                pending.extend(c for c in (c1, c2) if c and c.type == 'file')
+            
+            if not c1 or not c2:
+                status = 'missing'
+            elif type1 == 'folder' and type2 == 'folder':
+                status = 'same'
+            elif type1 == 'file' and type2 == 'file':
+                if c1.size != c2.size:
+                    status = 'different'
+                    _decide(c1, c2, status, 'metadata')
+                else:
+                    status = None
+                    pairs.append((c1, c2))
+            else:
+                status = 'different'
+            records.append((child_rel, status, c1, c2))
+            if type1 == 'folder' or type2 == 'folder':
+                # A folder facing a file (or nothing) is walked alone, so its
+                # contents are reported as missing.
+                subdirs.append(('open', child_rel, c1 if type1 == 'folder' else None,
+                                c2 if type2 == 'folder' else None,
+                                scope1 and scope1.child(name), scope2 and scope2.child(name),
+                                None if type1 == type2 else status, rollup))
+        
+        engine.hash_nodes(pending)
+        resolve_pairs(pairs, engine, strategy, escalate)
+        
+        for child_rel, status, c1, c2 in records:
+            record = {'event': 'entry', 'path': child_rel}
+            if status is None:
+                record['status'] = c1.status
+                record['decided_by'] = c1.decided_by
+                if c1.first_difference is not None:
+                    record['first_difference'] = c1.first_difference
+            else:
+                record['status'] = status
+                if c1 and c1.decided_by is not None:
+                    record['decided_by'] = c1.decided_by
+                for c in (c1, c2):
+                    if c:
+                        mark_unread(c, engine.stats)
+            record['left'] = _stream_side(c1)
+            record['right'] = _stream_side(c2)
+            yield record
+            
+            files = [c for c in (c1, c2) if c is not None and c.type == 'file']
+            if files and record['status'] in ('same', 'different', 'missing'):
+                rollup[record['status']] += 1
+                rollup[f"{record['status']}_bytes"] += max(c.size or 0 for c in files)
+        
+        stack.append(('close', rel, folder_status, rollup, parent_rollup))
+        stack.extend(reversed(subdirs))
+
+
+class RequestError(ValueError):
+    """Invalid client input, reported as HTTP 400."""
+
+
+MAX_REQUEST_WORKERS = 4 * (os.cpu_count() or 1)
+
+
+def parse_engine_options(data, remote=False):
+    """Validate the hash engine settings of a request body (see make_engine).
+    
+    remote marks a request that came over HTTP: its workers are capped at
+    MAX_REQUEST_WORKERS threads or one process per CPU, so that a single
+    request cannot start more than the server can run.
+    """
+    executor = data.get('executor', 'thread')
+    workers = data.get('workers')
+    algorithm = data.get('algorithm', DEFAULT_ALGORITHM)
+    sample_blocks = data.get('sample_blocks', DEFAULT_SAMPLE_BLOCKS)
+    
+    if executor not in EXECUTORS:
+        raise RequestError(f'Unknown executor: {executor}')
+    
+    if workers is not None and (not isinstance(workers, int) or isinstance(workers, bool) or workers < 1):
+        raise RequestError('workers must be a positive integer')
+    if workers is not None and remote:
+        workers = min(workers, MAX_REQUEST_WORKERS if executor == 'thread' else os.cpu_count() or 1)
+    
+    if not isinstance(sample_blocks, int) or isinstance(sample_blocks, bool) or sample_blocks < 1:
+        raise RequestError('sample_blocks must be a positive integer')
+    
+    if algorithm not in HASH_ALGORITHMS:
+        raise RequestError(f'Unknown hash algorithm: {algorithm} '
+                           f'(available: {", ".join(sorted(HASH_ALGORITHMS))})')
+    
+    return {
+        'executor': executor,
+        'workers': workers,
+        'use_cache': bool(data.get('use_cache', False)),
+        'sample_blocks': sample_blocks,
+        'algorithm': algorithm,
+    }
+
+
+def _pattern_list(value, name):
+    """Accept a list of patterns or one string with a pattern per line."""
+    if value is None:
+        return []
+    if isinstance(value, str):
+        value = value.splitlines()
+    if not isinstance(value, list) or not all(isinstance(p, str) for p in value):
+        raise RequestError(f'{name} must be a list of patterns')
+    return [p.strip() for p in value if p.strip()]
+
+
+def parse_filter_options(data):
+    """Validate the walk filter settings of a request body.
+    
+    Returns None when nothing is filtered, otherwise the keyword arguments
+    of WalkFilter (see make_walk_filter).
+    """
+    filters = {
+        'include': _pattern_list(data.get('include'), 'include'),
+        'exclude': _pattern_list(data.get('exclude'), 'exclude'),
+        'gitignore': bool(data.get('gitignore', False)),
+    }
+    for key, minimum in (('max_depth', 1), ('min_size', 0), ('max_size', 0)):
+        value = data.get(key)
+        if value is not None and (not isinstance(value, int) or isinstance(value, bool) or value < minimum):
+            raise RequestError(f'{key} must be an integer of at least {minimum}')
+        filters[key] = value
+    if filters['min_size'] is not None and filters['max_size'] is not None and filters['min_size'] > filters['max_size']:
+        raise RequestError('min_size is larger than max_size')
+    if (not filters['include'] and not filters['exclude'] and not filters['gitignore']
+            and all(filters[key] is None for key in ('max_depth', 'min_size', 'max_size'))):
+        return None
+    try:
+        WalkFilter(**filters)
+    except ValueError as e:
+        raise RequestError(str(e))
+    return filters
+
+
+def make_walk_filter(filters):
+    """Build the WalkFilter for parsed filter options, or None."""
+    return WalkFilter(**filters) if filters else None
+
+
+def parse_compare_options(data, remote=False):
+    """Validate a comparison request body and return normalized options (see parse_engine_options)."""
+    if not isinstance(data, dict):
+        raise RequestError('Request body must be a JSON object')
+    
+    dir1 = str(data.get('dir1') or '').strip()
+    dir2 = str(data.get('dir2') or '').strip()
+    hash_mode = data.get('hash_mode', 'lazy')
+    strategy = data.get('strategy', 'full')
+    
+    if not dir1 or not dir2:
+        raise RequestError('Both directory paths are required')
+    
+    if hash_mode not in HASH_MODES:
+        raise RequestError(f'Unknown hash mode: {hash_mode}')
+    
+    if strategy not in STRATEGIES:
+        raise RequestError(f'Unknown strategy: {strategy}')
+    
+    response_format = data.get('format', 'json')
+    if response_format not in RESPONSE_FORMATS:
+        raise RequestError(f'Unknown response format: {response_format}')
+    
+    sources = (data.get('source1', 'directory'), data.get('source2', 'directory'))
+    for source in sources:
+        if source not in TREE_SOURCES:
+            raise RequestError(f'Unknown tree source: {source}')
+    if sources != ('directory', 'directory') and (data.get('manifest') or data.get('save_manifest')):
+        raise RequestError('Incremental manifests need two directories')
+    
+    engine_options = parse_engine_options(data, remote)
+    filters = parse_filter_options(data)
+    
+    dir1 = normalize_path(dir1)
+    dir2 = normalize_path(dir2)
+    
+    if not os.path.exists(dir1):
+        raise RequestError(f'Directory 1 does not exist: {dir1}')
+    
+    if not os.path.exists(dir2):
+        raise RequestError(f'Directory 2 does not exist: {dir2}')
+    
+    return {
+        'dir1': dir1,
+        'dir2': dir2,
+        'source1': sources[0],
+        'source2': sources[1],
+        'hash_mode': hash_mode,
+        'strategy': strategy,
+        **engine_options,
+        'escalate': bool(data.get('escalate', False)),
+        'manifest': str(data.get('manifest') or '').strip() or None,
+        'save_manifest': str(data.get('save_manifest') or '').strip() or None,
+        'differences_only': bool(data.get('differences_only', False)),
+        'detect_moves': bool(data.get('detect_moves', False)),
+        'find_duplicates': bool(data.get('find_duplicates', False)),
+        'filters': filters,
+        'profile': bool(data.get('profile', False)),
+        'refresh': bool(data.get('refresh', False)),
+        'format': response_format,
+    }
+
+
+def make_engine(options, cancel_event=None):
+    """Create the hash engine described by parsed comparison options."""
+    cache = get_hash_cache() if options['use_cache'] else None
+    return HashEngine(workers=options['workers'], executor=options['executor'], cache=cache,
+                      sample_blocks=options['sample_blocks'], algorithm=options['algorithm'],
+                      cancel_event=cancel_event)
+
+
+def load_tree_source(path, source, options, engine):
+    """Build the tree of one side of a comparison from a directory, manifest or archive.
+    
+    Manifest and archive trees come with every digest, so nothing below them
+    is read again; a manifest must have been exported with the comparison's
+    algorithm and filters. Raises RequestError when it cannot be used.
+    """
+    walk_filter = make_walk_filter(options['filters'])
+    if source == 'directory':
+        return build_tree(path, options['hash_mode'] == 'eager', engine, walk_filter)
+    with engine.span('load'):
+        if source == 'archive':
+            try:
+                return build_archive_tree(path, engine, walk_filter)
+            except ValueError as e:
+                raise RequestError(str(e))
+        try:
+            manifest = load_tree_manifest(path)
+        except (OSError, ValueError, TypeError) as e:
+            raise RequestError(f'Cannot read manifest {path}: {e}')
+    if manifest['algorithm'] != engine.algorithm:
+        raise RequestError(f'{path} was hashed with {manifest["algorithm"]}, not {engine.algorithm}')
+    if manifest.get('filters') != options['filters']:
+        raise RequestError(f'{path} was exported with different include/exclude filters')
+    return manifest['tree']
+
+
+def build_source_pair(options, engine):
+    """Build both trees of a comparison whose sides may be manifests or archives."""
+    return (load_tree_source(options['dir1'], options['source1'], options, engine),
+            load_tree_source(options['dir2'], options['source2'], options, engine))
+
+
+def export_tree(root_path, path, options, filters=None):
+    """Walk and hash one directory and save its digest manifest at path.
+    
+    options are parsed engine options. Returns a summary of the export.
+    Raises RequestError if the directory cannot be read.
+    """
+    with make_engine(options) as engine:
+        tree = build_tree(root_path, compute_hash=True, engine=engine, walk_filter=make_walk_filter(filters))
+        if tree is None:
+            raise RequestError(f'Cannot read directory: {root_path}')
+        with engine.span('manifest'):
+            save_tree_manifest(path, root_path, engine.algorithm, tree, filters)
+        return {
+            'path': path,
+            'root': root_path,
+            'algorithm': engine.algorithm,
+            'digest': tree.digest.hex() if tree.digest else None,
+            'file_count': tree.file_count,
+            'size': tree.size,
+            'bytes': os.path.getsize(path),
+            'stats': engine.stats,
+            'timings': engine.timings
+        }
+
+
+PROFILE_LINES = 40
+_profile_lock = threading.Lock()
+
+
+def run_profiled(func, *args):
+    """Run func under cProfile; return its result and a report of the top functions.
+    
+    Only the calling thread is profiled, so time spent waiting on the walker
+    and hashing pools shows up as waits. One profile runs at a time; a
+    second one raises RequestError.
+    """
+    import cProfile
+    import io
+    import pstats
+    
+    if not _profile_lock.acquire(blocking=False):
+        raise RequestError('Another comparison is being profiled')
+    try:
+        profiler = cProfile.Profile()
+        result = profiler.runcall(func, *args)
+    finally:
+        _profile_lock.release()
+    report = io.StringIO()
+    pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(PROFILE_LINES)
+    return result, report.getvalue()
+
+
+def run_comparison(options, engine):
+    """Run the comparison described by parsed options and return the result.
+    
+    The result is the response body, except that tree1 and tree2 are still
+    Node trees (see result_to_json). It carries the engine's stats and the
+    seconds spent in each stage as timings, and with the profile option a
+    cProfile report as profile. Raises RequestError for problems with the
+    request itself (unreadable or mismatched manifest, nothing to compare).
+    """
+    if options.get('profile'):
+        result, profile = run_profiled(_run_comparison, options, engine)
+        result['profile'] = profile
+        return result
+    return _run_comparison(options, engine)
+
+
+def _run_comparison(options, engine):
+    dir1, dir2 = options['dir1'], options['dir2']
+    
+    previous = None
+    if options['manifest']:
+        try:
+            previous = load_manifest(options['manifest'])
+        except (OSError, ValueError) as e:
+            raise RequestError(f'Cannot read manifest: {e}')
+        if (previous['dir1'], previous['dir2']) != (dir1, dir2):
+            raise RequestError('Manifest was saved for a different directory pair')
+        if previous.get('filters') != options['filters']:
+            raise RequestError('Manifest was saved with different include/exclude filters')
+    snapshot = previous if previous is not None else ({} if options['save_manifest'] else None)
+    
+    strategy = options['strategy']
+    if (options['source1'], options['source2']) == ('directory', 'directory'):
+        tree1, tree2 = build_tree_pair(dir1, dir2, options['hash_mode'] == 'eager', engine, snapshot,
+                                       make_walk_filter(options['filters']))
+    else:
+        tree1, tree2 = build_source_pair(options, engine)
+        if strategy in ('sample', 'bytes'):
+            # Files of a manifest or an archive can only be compared by digest.
+            strategy = 'full'
+    
+    if not tree1 and not tree2:
+        raise RequestError('Both directories are empty or inaccessible')
+    
+    tree1_compared, tree2_compared = compare_nodes(tree1, tree2, engine, strategy, options['escalate'])
+    
+    content = {}
+    if options['detect_moves']:
+        with engine.span('moves'):
+            content['moves'], content['copies'] = find_moves(tree1_compared, tree2_compared, engine)
+    if options['find_duplicates']:
+        with engine.span('duplicates'):
+            content['duplicates'] = {'tree1': find_duplicates(tree1_compared, engine),
+                                     'tree2': find_duplicates(tree2_compared, engine)}
+    
+    if snapshot is not None:
+        with engine.span('manifest'):
+            flat = flatten_comparison(tree1_compared, tree2_compared)
+            if options['save_manifest']:
+                save_manifest(options['save_manifest'], dir1, dir2, engine.algorithm, flat, options['filters'])
+            delta = manifest_delta(previous['entries'], flat) if previous is not None else None
+        if previous is not None:
+            return {
+                'dir1': dir1,
+                'dir2': dir2,
+                'since': previous['created'],
+                'delta': delta,
+                **content,
+                'algorithm': engine.algorithm,
+                'stats': engine.stats,
+                'timings': engine.timings
+            }
+    
+    return {
+        'dir1': dir1,
+        'dir2': dir2,
+        'tree1': tree1_compared,
+        'tree2': tree2_compared,
+        **content,
+        'algorithm': engine.algorithm,
+        'stats': engine.stats,
+        'timings': engine.timings
+    }
+
+
+def result_to_json(result, differences_only=False):
+    """Convert the Node trees of a run_comparison result to nested dicts."""
+    if 'tree1' not in result:
+        return result
+    return dict(result, tree1=node_to_dict(result['tree1'], differences_only),
+                tree2=node_to_dict(result['tree2'], differences_only))
+
+
+DEFAULT_PAGE_SIZE = 500
+MAX_PAGE_SIZE = 5000
+
+
+def _brief_side(node):
+    """The part of a node shown in a directory listing row."""
+    if node is None:
+        return None
+    if node.type == 'file':
+        return {'type': 'file', 'size': node.size}
+    return {'type': node.type}
+
+
+def _pair_rollup(node1, node2):
+    """Return the rollup of a folder pair, or of the folder side of a folder/file pair."""
+    return next((n.rollup for n in (node1, node2) if n is not None and n.rollup is not None), None)
+
+
+class ComparisonIndex:
+    """Server-side index of two compared trees, browsed one directory at a time.
+    
+    Folders are looked up by their relative '/'-separated path. Their merged
+    child listings are built on demand (the last few are kept); aggregate
+    counts are the rollups compare_nodes left on the folders.
+    """
+    
+    LISTING_CACHE_SIZE = 8
+    
+    def __init__(self, tree1, tree2):
+        self.tree1 = tree1
+        self.tree2 = tree2
+        self.folders = {}
+        self._listings = OrderedDict()
+        self._lock = threading.Lock()
+        
+        stack = [('', tree1, tree2)]
+        while stack:
+            rel, node1, node2 = stack.pop()
+            folder1 = node1 if node1 is not None and node1.type == 'folder' else None
+            folder2 = node2 if node2 is not None and node2.type == 'folder' else None
+            if folder1 is None and folder2 is None:
+                continue
+            self.folders[rel] = (folder1, folder2)
+            for name, child1, child2 in self._merge_children(folder1, folder2):
+                if (child1 is not None and child1.type == 'folder') or (child2 is not None and child2.type == 'folder'):
+                    stack.append((f'{rel}/{name}' if rel else name, child1, child2))
+    
+    @staticmethod
+    def _merge_children(folder1, folder2):
+        """Pair the children of two folders by name, sorted: [(name, child1, child2)]."""
+        children1 = {c.name: c for c in folder1.children} if folder1 is not None else {}
+        children2 = {c.name: c for c in folder2.children} if folder2 is not None else {}
+        return [(name, children1.get(name), children2.get(name))
+                for name in sorted(children1.keys() | children2.keys())]
+    
+    def listing(self, rel):
+        """Return the merged children of the folder at rel, or None if it is not a folder."""
+        if rel not in self.folders:
+            return None
+        with self._lock:
+            listing = self._listings.get(rel)
+            if listing is not None:
+                self._listings.move_to_end(rel)
+                return listing
+        listing = self._merge_children(*self.folders[rel])
+        with self._lock:
+            self._listings[rel] = listing
+            while len(self._listings) > self.LISTING_CACHE_SIZE:
+                self._listings.popitem(last=False)
+        return listing
+    
+    def children(self, rel, offset=0, limit=DEFAULT_PAGE_SIZE, differences_only=False):
+        """Return one page of the listing of rel with its rollup, or None.
+        
+        With differences_only, entries whose status is 'same' are skipped and
+        total counts only the remaining ones.
+        """
+        listing = self.listing(rel)
+        if listing is None:
+            return None
+        if differences_only:
+            listing = [row for row in listing if (row[1] or row[2]).status != 'same']
+        entries = []
+        for name, child1, child2 in listing[offset:offset + limit]:
+            child_rel = f'{rel}/{name}' if rel else name
+            entry = {
+                'name': name,
+                'path': child_rel,
+                'status': (child1 or child2).status,
+                'left': _brief_side(child1),
+                'right': _brief_side(child2),
+            }
+            rollup = _pair_rollup(child1, child2)
+            if rollup is not None:
+                entry['rollup'] = rollup
+            entries.append(entry)
+        return {
+            'path': rel,
+            'offset': offset,
+            'limit': limit,
+            'total': len(listing),
+            'rollup': _pair_rollup(*self.folders[rel]),
+            'entries': entries,
+        }
+    
+    def pair(self, rel):
+        """Return the (node1, node2) pair at rel, or None if it does not exist."""
+        if not rel:
+            return self.tree1, self.tree2
+        parent, _, name = rel.rpartition('/')
+        listing = self.listing(parent) or []
+        i = bisect.bisect_left(listing, (name,))
+        if i == len(listing) or listing[i][0] != name:
+            return None
+        return listing[i][1:]
+    
+    def entry(self, rel):
+        """Return full details of both sides of one entry, or None if it does not exist."""
+        pair = self.pair(rel)
+        if pair is None:
+            return None
+        node1, node2 = pair
+        entry = {'path': rel, 'status': (node1 or node2).status}
+        for side, node in (('left', node1), ('right', node2)):
+            entry[side] = node and dict(_node_fields(node), name=node.name)
+        rollup = _pair_rollup(node1, node2)
+        if rollup is not None:
+            entry['rollup'] = rollup
+        return entry
+
+
+RESPONSE_FORMATS = ('json', 'compact')
+COMPACT_VERSION = 1
+COMPACT_STATUSES = ('same', 'different', 'missing')
+COMPACT_TYPES = ('file', 'folder')
+COMPACT_ROW_FIELDS = ('parent', 'name', 'status', 'decided_by', 'first_difference', 'left', 'right', 'rollup')
+COMPACT_SIDE_FIELDS = ('type', 'size', 'size_on_disk', 'created', 'modified', 'accessed', 'digest')
+MSGPACK_MIMETYPES = ('application/msgpack', 'application/x-msgpack')
+COMPRESS_MIN_BYTES = 1024
+
+
+def _front_code(strings):
+    """Return (prefixes, suffixes) of sorted strings, each sharing a prefix with the one before.
+    
+    Prefix lengths count UTF-16 code units, so that JavaScript's slice() can
+    rebuild the strings.
+    """
+    prefixes, suffixes = [], []
+    previous = ''
+    for string in strings:
+        shared = os.path.commonprefix((previous, string))
+        prefixes.append(len(shared) if shared.isascii() else len(shared.encode('utf-16-le', 'surrogatepass')) // 2)
+        suffixes.append(string[len(shared):])
+        previous = string
+    return prefixes, suffixes
+
+
+def _compact_side(node, types, binary):
+    """One side of a compact row, in COMPACT_SIDE_FIELDS order."""
+    if node is None:
+        return None
+    digest = node.digest or None
+    if digest is not None and not binary:
+        digest = digest.hex()
+    return [types[node.type], node.size, node.size_on_disk, node.created, node.modified, node.accessed, digest]
+
+
+def result_to_compact(result, differences_only=False, binary=False):
+    """Convert a run_comparison result to the compact wire format.
+    
+    The two trees become one list of rows, one per path, parents before
+    their children (see COMPACT_ROW_FIELDS). parent is a row index, so
+    paths are rebuilt from the chain of names instead of being repeated.
+    Names and decided_by point into a sorted, front-coded string table,
+    status into COMPACT_STATUSES, and left/right are COMPACT_SIDE_FIELDS
+    lists, None where the path is missing. Rollups are lists in ROLLUP_KEYS
+    order. With binary (for MessagePack) digests stay raw bytes.
+    """
+    if 'tree1' not in result:
+        return result
+    statuses = {status: code for code, status in enumerate(COMPACT_STATUSES)}
+    types = {type: code for code, type in enumerate(COMPACT_TYPES)}
+    strings = set()
+    rows = []
+    stack = [(-1, '', result['tree1'], result['tree2'])]
+    while stack:
+        parent, name, node1, node2 = stack.pop()
+        node = node1 or node2
+        strings.add(name)
+        if node.decided_by is not None:
+            strings.add(node.decided_by)
+        folder1 = node1 if node1 is not None and node1.type == 'folder' else None
+        folder2 = node2 if node2 is not None and node2.type == 'folder' else None
+        rollup = (folder1 or folder2).rollup if folder1 or folder2 else None
+        row = len(rows)
+        rows.append([parent, name, statuses.get(node.status), node.decided_by, node.first_difference,
+                     _compact_side(node1, types, binary), _compact_side(node2, types, binary),
+                     rollup and [rollup[key] for key in ROLLUP_KEYS]])
+        if folder1 is None and folder2 is None:
+            continue
+        for child_name, child1, child2 in reversed(ComparisonIndex._merge_children(folder1, folder2)):
+            if differences_only and (child1 or child2).status == 'same':
+                continue
+            stack.append((row, child_name, child1, child2))
+    
+    table = sorted(strings)
+    codes = {string: code for code, string in enumerate(table)}
+    for row in rows:
+        row[1] = codes[row[1]]
+        if row[3] is not None:
+            row[3] = codes[row[3]]
+    prefixes, suffixes = _front_code(table)
+    compact = {key: value for key, value in result.items() if key not in ('tree1', 'tree2')}
+    compact.update({
+        'format': 'compact',
+        'version': COMPACT_VERSION,
+        'separator': os.sep,
+        'roots': [tree and [tree.name, tree.path] for tree in (result['tree1'], result['tree2'])],
+        'statuses': COMPACT_STATUSES,
+        'types': COMPACT_TYPES,
+        'row_fields': COMPACT_ROW_FIELDS,
+        'side_fields': COMPACT_SIDE_FIELDS,
+        'rollup_fields': ROLLUP_KEYS,
+        'string_prefixes': prefixes,
+        'strings': suffixes,
+        'rows': rows,
+    })
+    return compact
+
+
+def compress_body(body, accept_encodings):
+    """Compress a response body with zstd or gzip, whichever the client accepts.
+    
+    Returns (body, content encoding or None). zstd needs the optional
+    zstandard package; small bodies are sent as they are.
+    """
+    if len(body) < COMPRESS_MIN_BYTES:
+        return body, None
+    if 'zstd' in accept_encodings:
+        try:
+            import zstandard
+            return zstandard.ZstdCompressor(level=3).compress(body), 'zstd'
+        except ImportError:
+            pass
+    if 'gzip' in accept_encodings:
+        return gzip.compress(body, compresslevel=6, mtime=0), 'gzip'
+    return body, None
+
+
+DIFF_MODES = ('unified', 'side-by-side')
+DIFF_CONTEXT = 3
+MAX_DIFF_CONTEXT = 100
+DIFF_HUNKS = 50
+MAX_DIFF_HUNKS = 1000
+DIFF_MAX_LINES = 2000
+DIFF_WINDOW = 1000
+DIFF_LINE_BYTES = 64 * 1024
+DIFF_SNIFF_BYTES = 8192
+DIFF_BLOCK_SIZE = 64 * 1024
+
+
+def is_binary_file(path):
+    """Guess whether a file is binary, like git: a NUL byte in its first 8 KiB."""
+    with _open_regular(path, buffering=-1) as f:
+        return b'\0' in f.read(DIFF_SNIFF_BYTES)
+
+
+def diff_binary(path1, path2, offset=0, limit=DIFF_HUNKS, block_size=DIFF_BLOCK_SIZE):
+    """Return the byte ranges where two files differ, starting at offset.
+    
+    The files are read block by block; adjacent differing blocks merge into
+    one [start, end) range whose start is the first differing byte. The bytes
+    past the end of the shorter file form the last range. After limit ranges
+    the scan stops and next is the offset to resume from (None at the end).
+    """
+    ranges = []
+    buffer1, buffer2 = bytearray(block_size), bytearray(block_size)
+    view1, view2 = memoryview(buffer1), memoryview(buffer2)
+    
+    def add(block, start, end):
+        if ranges and ranges[-1][1] == block:
+            ranges[-1][1] = end
+            return True
+        if len(ranges) == limit:
+            return False
+        ranges.append([start, end])
+        return True
+    
+    with _open_regular(path1) as f1, _open_regular(path2) as f2:
+        size1 = os.fstat(f1.fileno()).st_size
+        size2 = os.fstat(f2.fileno()).st_size
+        position = min(offset, size1, size2)
+        f1.seek(position)
+        f2.seek(position)
+        next_offset = None
+        while True:
+            n1 = f1.readinto(buffer1)
+            n2 = f2.readinto(buffer2)
+            n = min(n1, n2)
+            if view1[:n] != view2[:n]:
+                if not add(position, position + _first_mismatch(view1[:n], view2[:n]), position + n):
+                    next_offset = position
+                    break
+            position += n
+            if n1 != n2 or not n:
+                start = max(position, offset)
+                if size1 != size2 and not add(start, start, max(size1, size2)):
+                    next_offset = position
+                break
+    return {
+        'binary': True,
+        'size1': size1,
+        'size2': size2,
+        'ranges': [{'start': start, 'end': end} for start, end in ranges],
+        'next': next_offset,
+    }
+
+
+class _LineReader:
+    """Read a file as numbered lines from a byte offset, without loading it.
+    
+    Lines are (number, end offset, text) with the line ending stripped and
+    invalid UTF-8 replaced; lines longer than DIFF_LINE_BYTES are split.
+    """
+    
+    def __init__(self, f, line=1, offset=0):
+        f.seek(offset)
+        self.f = f
+        self.line = line
+        self.offset = offset
+        self.done = False
+    
+    def read(self, count):
+        lines = []
+        while len(lines) < count and not self.done:
+            raw = self.f.readline(DIFF_LINE_BYTES)
+            if not raw:
+                self.done = True
+                break
+            self.offset += len(raw)
+            lines.append((self.line, self.offset, raw.decode('utf-8', 'replace').rstrip('\r\n')))
+            self.line += 1
+        return lines
+
+
+def _diff_opcodes(reader1, reader2, window=DIFF_WINDOW):
+    """Yield (tag, lines1, lines2) for two line readers, one window at a time.
+    
+    Identical leading lines are passed through without diffing. The rest of
+    each window goes to difflib, and only the opcodes up to its last equal
+    run are kept; the lines after it are diffed again with the next window.
+    Memory is bounded by the window size, at the price of a less minimal
+    diff when a change spans more than a window.
+    """
+    import difflib
+    
+    lines1, lines2 = [], []
+    while True:
+        lines1 += reader1.read(window - len(lines1))
+        lines2 += reader2.read(window - len(lines2))
+        if not lines1 and not lines2:
+            return
+        common = 0
+        for line1, line2 in zip(lines1, lines2):
+            if line1[2] != line2[2]:
+                break
+            common += 1
+        if common:
+            yield 'equal', lines1[:common], lines2[:common]
+            del lines1[:common], lines2[:common]
+            continue
+        matcher = difflib.SequenceMatcher(None, [line[2] for line in lines1], [line[2] for line in lines2],
+                                          autojunk=False)
+        opcodes = matcher.get_opcodes()
+        if not (reader1.done and reader2.done):
+            last_equal = max((k for k, opcode in enumerate(opcodes) if opcode[0] == 'equal'), default=None)
+            if last_equal is not None:
+                opcodes = opcodes[:last_equal + 1]
+        for tag, i1, i2, j1, j2 in opcodes:
+            yield tag, lines1[i1:i2], lines2[j1:j2]
+        del lines1[:opcodes[-1][2]], lines2[:opcodes[-1][4]]
+
+
+def _group_hunks(opcodes, position, context=DIFF_CONTEXT, max_lines=DIFF_MAX_LINES):
+    """Group diff opcodes into hunks with context lines, like diff -U.
+    
+    position is (line1, offset1, line2, offset2) where both readers start.
+    Yields (hunk, cursor) where cursor is the position right after the hunk,
+    from which a later request can resume, or None after the last hunk. A
+    hunk is closed early once it reaches max_lines.
+    """
+    line1, end1, line2, end2 = position
+    hunk = None
+    leading = deque(maxlen=context)
+    gap = []
+    after = 0
+    cursor = None
+    
+    def context_lines(pairs):
+        return [(' ', n1, n2, text) for (n1, _, text), (n2, _, _) in pairs]
+    
+    for tag, lines1, lines2 in opcodes:
+        if tag == 'equal':
+            for pair in zip(lines1, lines2):
+                (line1, end1, text), (line2, end2, _) = pair
+                line1 += 1
+                line2 += 1
+                if hunk is None:
+                    leading.append(pair)
+                elif after < context:
+                    hunk['lines'].append((' ', line1 - 1, line2 - 1, text))
+                    cursor = (line1, end1, line2, end2)
+                    after += 1
+                else:
+                    gap.append(pair)
+                    if len(gap) > context:
+                        yield hunk, cursor
+                        hunk = None
+                        leading.extend(gap)
+                        gap = []
+            continue
+        if hunk is None:
+            start = leading[0] if leading else ((line1,), (line2,))
+            hunk = {'old_start': start[0][0], 'new_start': start[1][0], 'lines': context_lines(leading)}
+            leading.clear()
+        else:
+            hunk['lines'] += context_lines(gap)
+            gap = []
+        hunk['lines'] += [('-', n, None, text) for n, _, text in lines1]
+        hunk['lines'] += [('+', None, n, text) for n, _, text in lines2]
+        if lines1:
+            line1, end1 = lines1[-1][0] + 1, lines1[-1][1]
+        if lines2:
+            line2, end2 = lines2[-1][0] + 1, lines2[-1][1]
+        cursor = (line1, end1, line2, end2)
+        after = 0
+        if len(hunk['lines']) >= max_lines:
+            yield hunk, cursor
+            hunk = None
+    if hunk is not None:
+        yield hunk, None
+
+
+def _side_by_side(lines):
+    """Turn unified hunk lines into [kind, line1, text1, line2, text2] rows.
+    
+    Runs of removed and added lines are paired up as changed rows ('!');
+    the unpaired rest stays '-' or '+' with an empty other side.
+    """
+    rows = []
+    removed, added = [], []
+    
+    def flush():
+        for old, new in itertools.zip_longest(removed, added):
+            kind = '!' if old and new else '-' if old else '+'
+            rows.append([kind, old and old[1], old and old[3], new and new[2], new and new[3]])
+        removed.clear()
+        added.clear()
+    
+    for line in lines:
+        if line[0] == '-':
+            removed.append(line)
+        elif line[0] == '+':
+            added.append(line)
+        else:
+            flush()
+            rows.append([' ', line[1], line[3], line[2], line[3]])
+    flush()
+    return rows
+
+
+def diff_text(path1, path2, position=None, mode='unified', context=DIFF_CONTEXT, limit=DIFF_HUNKS,
+              max_lines=DIFF_MAX_LINES):
+    """Return one page of the line diff of two text files.
+    
+    Both files are read as streams from position (line1, offset1, line2,
+    offset2), and reading stops as soon as limit hunks or max_lines lines
+    are collected, so the first page of a large file comes back quickly.
+    next is the position to continue from, or None at the end.
+    """
+    position = position or (1, 0, 1, 0)
+    hunks = []
+    lines = 0
+    next_position = None
+    with _open_regular(path1, buffering=-1) as f1, _open_regular(path2, buffering=-1) as f2:
+        size1 = os.fstat(f1.fileno()).st_size
+        size2 = os.fstat(f2.fileno()).st_size
+        reader1 = _LineReader(f1, position[0], position[1])
+        reader2 = _LineReader(f2, position[2], position[3])
+        for hunk, next_position in _group_hunks(_diff_opcodes(reader1, reader2), position, context, max_lines):
+            data = {
+                'old_start': hunk['old_start'],
+                'old_lines': sum(1 for line in hunk['lines'] if line[0] != '+'),
+                'new_start': hunk['new_start'],
+                'new_lines': sum(1 for line in hunk['lines'] if line[0] != '-'),
+            }
+            if mode == 'unified':
+                data['lines'] = [[kind, text] for kind, _, _, text in hunk['lines']]
+            else:
+                data['rows'] = _side_by_side(hunk['lines'])
+            hunks.append(data)
+            lines += len(hunk['lines'])
+            if len(hunks) >= limit or lines >= max_lines:
+                break
+        else:
+            next_position = None
+    return {
+        'binary': False,
+        'mode': mode,
+        'size1': size1,
+        'size2': size2,
+        'hunks': hunks,
+        'next': ','.join(map(str, next_position)) if next_position else None,
+    }
+
+
+def parse_diff_options(args):
+    """Validate the query of a diff request: mode, context, limit and cursor."""
+    mode = args.get('mode', 'unified')
+    if mode not in DIFF_MODES:
+        raise RequestError(f'Unknown diff mode: {mode}')
+    try:
+        context = int(args.get('context', DIFF_CONTEXT))
+        limit = int(args.get('limit', DIFF_HUNKS))
+        cursor = [int(part) for part in args['cursor'].split(',')] if args.get('cursor') else None
+    except ValueError:
+        raise RequestError('context, limit and cursor must be integers')
+    if cursor is not None and (len(cursor) not in (1, 4) or min(cursor) < 0):
+        raise RequestError('Invalid diff cursor')
+    return {
+        'mode': mode,
+        'context': min(MAX_DIFF_CONTEXT, max(0, context)),
+        'limit': min(MAX_DIFF_HUNKS, max(1, limit)),
+        'cursor': cursor,
+    }
+
+
+def diff_files(path1, path2, options):
+    """Diff two files: lines for text, byte ranges when either one is binary."""
+    cursor = options['cursor']
+    if is_binary_file(path1) or is_binary_file(path2):
+        if cursor is not None and len(cursor) != 1:
+            raise RequestError('Invalid diff cursor')
+        return diff_binary(path1, path2, cursor[0] if cursor else 0, options['limit'])
+    if cursor is not None and len(cursor) != 4:
+        raise RequestError('Invalid diff cursor')
+    return diff_text(path1, path2, cursor, options['mode'], options['context'], options['limit'])
+
+
+JOB_WORKERS = 2
+JOB_TTL = 3600
+MAX_FINISHED_JOBS = 16
+MAX_QUEUED_JOBS = 8
+STREAM_WORKERS = 2
+BUSY_RETRY_AFTER = 5
+
+
+class ServerBusy(Exception):
+    """Too many comparisons are running or queued; reported as HTTP 503."""
+
+
+RESULT_CACHE_BYTES = 256 * 1024 * 1024
+RESULT_CACHE_TTL = 600
+RESULT_NODE_BYTES = 300
+# Options that change how a comparison runs or is returned, not its result.
+RESULT_CACHE_IGNORED = ('executor', 'workers', 'use_cache', 'differences_only', 'profile', 'refresh', 'format')
+
+
+def result_cache_key(options):
+    """Return the result cache key of parsed options, or None if the result is not cacheable.
+    
+    Runs that read or write an incremental manifest, and profiled runs, are
+    never cached.
+    """
+    if options['manifest'] or options['save_manifest'] or options['profile']:
+        return None
+    return json.dumps({key: value for key, value in options.items() if key not in RESULT_CACHE_IGNORED},
+                      sort_keys=True)
+
+
+class ResultCache:
+    """Recent comparison results, served again while the compared trees look unchanged.
+    
+    Results are keyed by the normalized pair and the options that affect
+    them. A cached result is valid while every folder of both trees keeps
+    the mtime it had when the folder was listed (for manifests and archives,
+    the file's own mtime), and for at most ttl seconds, since editing a
+    file in place does not change its folder's mtime. Entries are evicted
+    least recently used first once their estimated size passes max_bytes.
+    Identical requests arriving while one is being computed wait for it
+    instead of scanning the same trees again.
+    """
+    
+    def __init__(self, max_bytes=RESULT_CACHE_BYTES, ttl=RESULT_CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._running = {}
+        self._lock = threading.Lock()
+    
+    def run(self, options, compute, cancel_event=None):
+        """Return (result, how): compute()'s result, or a cached or in-flight one.
+        
+        how is 'hit', 'coalesced' or 'miss'. With the refresh option no
+        cached result is used. A waiting caller whose cancel_event is set
+        raises ComparisonCancelled.
+        """
+        key = result_cache_key(options)
+        if key is None:
+            return compute(), 'miss'
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+            if entry is not None and not options.get('refresh') and self._is_valid(entry):
+                with self._lock:
+                    if key in self._entries:
+                        self._entries.move_to_end(key)
+                return entry['result'], 'hit'
+            
+            with self._lock:
+                future = self._running.get(key)
+                owner = future is None
+                if owner:
+                    future = self._running[key] = concurrent.futures.Future()
+            if owner:
+                break
+            try:
+                return self._wait(future, cancel_event), 'coalesced'
+            except ComparisonCancelled:
+                if cancel_event is not None and cancel_event.is_set():
+                    raise
+                # The comparison we waited for was cancelled; run our own.
+        
+        try:
+            mtimes = [(options[f'dir{side}'], os.stat(options[f'dir{side}']).st_mtime_ns)
+                      for side in (1, 2) if options[f'source{side}'] != 'directory']
+            result = compute()
+            self._store(key, options, result, mtimes)
+            future.set_result(result)
+            return result, 'miss'
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._running[key]
+    
+    @staticmethod
+    def _wait(future, cancel_event):
+        while True:
+            if cancel_event is not None and cancel_event.is_set():
+                raise ComparisonCancelled()
+            try:
+                return future.result(timeout=0.2)
+            except concurrent.futures.TimeoutError:
+                continue
+    
+    def _is_valid(self, entry):
+        if time.time() - entry['created'] > self.ttl:
+            return False
+        for path, mtime_ns in entry['mtimes']:
+            try:
+                if os.stat(path).st_mtime_ns != mtime_ns:
+                    return False
+            except OSError:
+                return False
+        return True
+    
+    def _store(self, key, options, result, mtimes):
+        if 'tree1' not in result:
+            return
+        nodes = 0
+        for side in (1, 2):
+            for node in iter_nodes(result[f'tree{side}']):
+                nodes += 1
+                if options[f'source{side}'] == 'directory' and (node.type == 'folder' or node.parent is None):
+                    mtimes.append((node.path, node.mtime_ns))
+        size = nodes * RESULT_NODE_BYTES
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous['size']
+            self._entries[key] = {'result': result, 'mtimes': mtimes, 'size': size, 'created': time.time()}
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.bytes -= evicted['size']
+    
+    def clear(self):
+        """Drop every cached result."""
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+    
+    def info(self):
+        """Return the number of cached results and their estimated size."""
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self.bytes, 'max_bytes': self.max_bytes,
+                    'ttl': self.ttl}
+
+
+_result_cache = None
+_result_cache_lock = threading.Lock()
+
+
+def get_result_cache():
+    """Return the process-wide result cache, creating it on first use."""
+    global _result_cache
+    with _result_cache_lock:
+        if _result_cache is None:
+            _result_cache = ResultCache()
+        return _result_cache
+
+
+def run_cached_comparison(options, engine):
+    """Run a comparison through the result cache; returns (result, how) as ResultCache.run.
+    
+    A cached or coalesced result reports this request's own (near zero)
+    stats and timings; those of the run that produced it move to
+    cached_stats and cached_timings.
+    """
+    result, how = get_result_cache().run(options, lambda: run_comparison(options, engine),
+                                         engine.cancel_event)
+    METRICS.observe_result_cache(how)
+    if how != 'miss':
+        result = dict(result, stats=engine.stats, timings=engine.timings,
+                      cached_stats=result['stats'], cached_timings=result['timings'])
+    return result, how
+
+
+class ComparisonJob:
+    """A comparison running on the job pool, polled and cancelled through /jobs.
+    
+    state moves from queued to running and ends as done, failed or
+    cancelled. The engine is kept while running so its counters can be
+    reported as progress.
+    """
+    
+    def __init__(self, options):
+        self.id = os.urandom(16).hex()
+        self.options = options
+        self.state = 'queued'
+        self.cancel_event = threading.Event()
+        self.engine = None
+        self.future = None
+        self.result = None
+        self.index = None
+        self.error = None
+        self.error_status = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+    
+    def run(self):
+        if self.cancel_event.is_set():
+            self._finish('cancelled')
+            return
+        self.state = 'running'
+        self.started = time.time()
+        try:
+            with make_engine(self.options, self.cancel_event) as engine:
+                self.engine = engine
+                result, how = run_cached_comparison(self.options, engine)
+                self.result = dict(result, result_cache=how)
+            if 'tree1' in self.result:
+                self.index = ComparisonIndex(self.result['tree1'], self.result['tree2'])
+            self._finish('done')
+        except ComparisonCancelled:
+            self._finish('cancelled')
+        except RequestError as e:
+            self.error, self.error_status = str(e), 400
+            self._finish('failed')
+        except Exception as e:
+            import traceback
+            print(f"Error during comparison job {self.id}: {e}")
+            print(traceback.format_exc())
+            self.error, self.error_status = str(e), 500
+            self._finish('failed')
+        if self.engine is not None:
+            METRICS.observe(self.engine, self.state, self.finished - self.started)
+    
+    def _finish(self, state):
+        self.finished = time.time()
+        self.state = state
+    
+    def cancel(self):
+        """Ask the job to stop; a job still queued is dropped immediately."""
+        self.cancel_event.set()
+        if self.future is not None and self.future.cancel():
+            self._finish('cancelled')
+    
+    @property
+    def is_finished(self):
+        return self.state in ('done', 'failed', 'cancelled')
+    
+    def progress(self):
+        """Report files scanned, bytes hashed, throughput (bytes/s) and ETA (seconds)."""
+        engine = self.engine
+        stats = engine.stats if engine is not None else new_stats()
+        bytes_planned = engine.bytes_planned if engine is not None else 0
+        hashed = stats['bytes_read']
+        now = self.finished or time.time()
+        throughput = None
+        if engine is not None and engine.hash_started is not None and now > engine.hash_started:
+            throughput = hashed / (now - engine.hash_started)
+        eta = None
+        if self.state == 'done':
+            eta = 0
+        elif self.state == 'running' and throughput:
+            eta = max(0, bytes_planned - hashed) / throughput
+        return {
+            'files_scanned': stats['files_scanned'],
+            'bytes_hashed': hashed,
+            'bytes_planned': bytes_planned,
+            'throughput': throughput,
+            'eta': eta,
+        }
+    
+    def status(self):
+        status = {
+            'id': self.id,
+            'state': self.state,
+            'dir1': self.options['dir1'],
+            'dir2': self.options['dir2'],
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+            'progress': self.progress(),
+        }
+        if self.error:
+            status['error'] = self.error
+        return status
+
+
+class JobStore:
+    """Run comparison jobs on a small pool and keep them for polling.
+    
+    At most workers jobs run at a time and max_queued more may wait; beyond
+    that submit raises ServerBusy instead of letting the queue grow. Finished
+    jobs (and their results) are dropped ttl seconds after they end, or
+    earlier, least recently polled first, once more than max_finished are
+    kept. Queued and running jobs are never dropped.
+    """
+    
+    def __init__(self, workers=JOB_WORKERS, ttl=JOB_TTL, max_finished=MAX_FINISHED_JOBS,
+                 max_queued=MAX_QUEUED_JOBS):
+        self.workers = workers
+        self.ttl = ttl
+        self.max_finished = max_finished
+        self.max_queued = max_queued
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._pool = None
+    
+    def submit(self, options):
+        job = ComparisonJob(options)
+        with self._lock:
+            self._prune()
+            pending = sum(1 for other in self._jobs.values() if not other.is_finished)
+            if pending >= self.workers + self.max_queued:
+                raise ServerBusy(f'{pending} comparisons are running or queued; try again later')
+            if self._pool is None:
+                self._pool = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix='job')
+            self._jobs[job.id] = job
+            job.future = self._pool.submit(job.run)
+        return job
+    
+    def discard(self, job_id):
+        """Forget a finished job whose result has been delivered."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None and job.is_finished:
+                del self._jobs[job_id]
+    
+    def counts(self):
+        """Return the number of jobs per state."""
+        with self._lock:
+            counts = dict.fromkeys(('queued', 'running'), 0)
+            for job in self._jobs.values():
+                counts[job.state] = counts.get(job.state, 0) + 1
+            return counts
+    
+    def get(self, job_id):
+        """Return a job by id, marking it recently used, or None."""
+        with self._lock:
+            self._prune()
+            job = self._jobs.get(job_id)
+            if job is not None:
+                self._jobs.move_to_end(job_id)
+            return job
+    
+    def _prune(self):
+        now = time.time()
+        finished = [job for job in self._jobs.values() if job.is_finished]
+        excess = len(finished) - self.max_finished
+        for job in finished:
+            if excess > 0 or now - job.finished > self.ttl:
+                del self._jobs[job.id]
+                excess -= 1
+
+
+_job_store = None
+_job_store_lock = threading.Lock()
+
+
+def get_job_store():
+    """Return the process-wide job store, creating it on first use."""
+    global _job_store
+    with _job_store_lock:
+        if _job_store is None:
+            _job_store = JobStore()
+        return _job_store
+
+
+def configure_job_store(workers=JOB_WORKERS, max_queued=MAX_QUEUED_JOBS):
+    """Replace the process-wide job store with one of the given size, before serving."""
+    global _job_store
+    with _job_store_lock:
+        _job_store = JobStore(workers=workers, max_queued=max_queued)
+        return _job_store
+
+
+def _metric_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metrics:
+    """Counters summed over every comparison this process has served, for /metrics.
+    
+    observe adds up the stats, errors and stage timings of a finished
+    engine; render writes them in the Prometheus text exposition format.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.comparisons = {}
+        self.seconds = 0.0
+        self.stats = {key: 0 for key, value in new_stats().items() if isinstance(value, int)}
+        self.errors = {}
+        self.timings = {}
+        self.result_cache = {}
+    
+    def observe_stage(self, stage, seconds):
+        """Add time spent outside a comparison's engine, such as serialising it."""
+        with self._lock:
+            self.timings[stage] = self.timings.get(stage, 0.0) + seconds
+    
+    def observe_result_cache(self, how):
+        """Count one lookup of the result cache ('hit', 'coalesced' or 'miss')."""
+        with self._lock:
+            self.result_cache[how] = self.result_cache.get(how, 0) + 1
+    
+    def observe(self, engine, outcome, seconds):
+        """Record one comparison that ended as outcome ('done', 'failed' or 'cancelled')."""
+        with self._lock:
+            self.comparisons[outcome] = self.comparisons.get(outcome, 0) + 1
+            self.seconds += seconds
+            for key in self.stats:
+                self.stats[key] += engine.stats.get(key, 0)
+            for name, count in engine.stats['errors'].items():
+                self.errors[name] = self.errors.get(name, 0) + count
+            for stage, elapsed in engine.timings.items():
+                self.timings[stage] = self.timings.get(stage, 0.0) + elapsed
+    
+    def render(self, jobs=None):
+        """Return every metric as Prometheus text, with jobs (counts per state) as a gauge."""
+        lines = []
+        
+        def metric(name, kind, help_text, samples):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in samples:
+                label_text = ','.join(f'{key}="{_metric_label(label)}"' for key, label in labels)
+                lines.append(f'{name}{{{label_text}}} {value}' if label_text else f'{name} {value}')
+        
+        with self._lock:
+            metric('dtc_comparisons_total', 'counter', 'Comparisons run, by outcome.',
+                   [((('outcome', outcome),), count) for outcome, count in sorted(self.comparisons.items())])
+            metric('dtc_comparison_seconds_total', 'counter', 'Wall time spent in comparisons.',
+                   [((), self.seconds)])
+            for key, value in self.stats.items():
+                metric(f'dtc_{key}_total', 'counter', f'Sum of the {key} comparison statistic.', [((), value)])
+            metric('dtc_errors_total', 'counter', 'Errors met during comparisons, by exception type.',
+                   [((('type', name),), count) for name, count in sorted(self.errors.items())])
+            metric('dtc_stage_seconds_total', 'counter', 'Wall time spent in each comparison stage.',
+                   [((('stage', stage),), elapsed) for stage, elapsed in sorted(self.timings.items())])
+            metric('dtc_result_cache_requests_total', 'counter',
+                   'Comparisons answered from the result cache (hit), by waiting for an identical '
+                   'one (coalesced) or by running (miss).',
+                   [((('outcome', how),), count) for how, count in sorted(self.result_cache.items())])
+        if jobs is not None:
+            metric('dtc_jobs', 'gauge', 'Comparison jobs currently kept, by state.',
+                   [((('state', state),), count) for state, count in sorted(jobs.items())])
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
+
+
+BROWSE_TIMEOUT = 600
+BROWSE_SCRIPT = '''
+import sys
+from tkinter import Tk, filedialog
+root = Tk()
+root.withdraw()
+root.attributes('-topmost', True)
+sys.stdout.write(filedialog.askdirectory(title='Select Folder') or '')
+'''
+
+
+def browse_for_folder():
+    """Show the folder dialog in a child Python process and return the chosen path ('' if none)."""
+    import subprocess
+    
+    completed = subprocess.run([sys.executable, '-c', BROWSE_SCRIPT], capture_output=True,
+                               encoding='utf-8', env=dict(os.environ, PYTHONIOENCODING='utf-8'),
+                               timeout=BROWSE_TIMEOUT)
+    if completed.returncode != 0:
+        lines = completed.stderr.strip().splitlines()
+        raise RuntimeError(lines[-1] if lines else f'Folder dialog failed ({completed.returncode})')
+    return completed.stdout.strip()
+
+
+def create_app():
+    """Create the Flask application serving the web page and the JSON API.
+    
+    Flask is imported here instead of at module level, so the command line
+    mode (see main) starts without it.
+    """
+    from flask import Flask, Response, request, jsonify, stream_with_context
+    
+    app = Flask(__name__)
+    app.config['JSON_AS_ASCII'] = False
+    # The folder dialog opens on the server's own display, so it is turned
+    # off when serving other machines (see run_server and wsgi.py).
+    app.config['BROWSE_DIALOG'] = os.environ.get('XSUKAX_DTC_BROWSE_DIALOG', '1') != '0'
+    # A restricted server may be reached by other machines: requests cannot
+    # start worker processes, and manifests and archives are only read and
+    # written inside MANIFEST_DIR (not at all when it is not set).
+    app.config['RESTRICTED'] = os.environ.get('XSUKAX_DTC_RESTRICTED', '0') == '1'
+    app.config['MANIFEST_DIR'] = os.environ.get('XSUKAX_DTC_MANIFEST_DIR') or None
+    stream_slots = threading.BoundedSemaphore(STREAM_WORKERS)
+    browse_lock = threading.Lock()
+    
+    def busy(message):
+        return jsonify({'error': message}), 503, {'Retry-After': str(BUSY_RETRY_AFTER)}
+    
+    def manifest_path(path):
+        """Resolve a manifest or archive path from a request; a restricted server confines it to MANIFEST_DIR."""
+        if not app.config['RESTRICTED']:
+            return path
+        if not app.config['MANIFEST_DIR']:
+            raise RequestError('Manifests and archives are turned off on this server')
+        base = os.path.realpath(app.config['MANIFEST_DIR'])
+        resolved = os.path.realpath(path)
+        if os.path.commonpath((base, resolved)) != base:
+            raise RequestError(f'Manifests and archives must be inside {base}')
+        return resolved
+    
+    def request_options(data, parse=parse_compare_options):
+        """Parse the options of a request body with the limits of a server."""
+        options = parse(data, remote=True)
+        if options['executor'] == 'process' and app.config['RESTRICTED']:
+            raise RequestError('The process executor is turned off on this server')
+        for key in ('manifest', 'save_manifest'):
+            if options.get(key):
+                options[key] = manifest_path(options[key])
+        for key, source in (('dir1', 'source1'), ('dir2', 'source2')):
+            if options.get(source, 'directory') != 'directory':
+                options[key] = manifest_path(options[key])
+        return options
+    
+    def result_response(result, differences_only, response_format):
+        """Serialise a comparison result in the format, media type and encoding the client asked for."""
+        started = time.perf_counter()
+        packer = None
+        if request.accept_mimetypes.best_match(('application/json',) + MSGPACK_MIMETYPES) in MSGPACK_MIMETYPES:
+            try:
+                import msgpack as packer
+            except ImportError:
+                pass
+        if response_format == 'compact':
+            data = result_to_compact(result, differences_only, binary=packer is not None)
+        else:
+            data = result_to_json(result, differences_only)
+        if packer is not None:
+            response = Response(packer.packb(data, use_bin_type=True), mimetype='application/msgpack')
+        else:
+            response = Response(app.json.dumps(data).encode('utf-8'), mimetype='application/json')
+        response.data, encoding = compress_body(response.data, request.accept_encodings)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.vary.update(('Accept', 'Accept-Encoding'))
+        METRICS.observe_stage('serialise', time.perf_counter() - started)
+        return response
+    
+    # The page only depends on which algorithms are available, so it is
+    # rendered and compressed once here rather than on every request.
+    page = app.jinja_env.from_string(HTML_TEMPLATE).render(
+        algorithms=sorted(HASH_ALGORITHMS), default_algorithm=DEFAULT_ALGORITHM).encode('utf-8')
+    page_gzip = gzip.compress(page, compresslevel=9, mtime=0)
+    page_etag = hashlib.sha1(page).hexdigest()
+    
+    @app.route('/')
+    def index():
+        """Serve the pre-rendered page, gzipped when the client accepts it."""
+        if 'gzip' in request.accept_encodings:
+            response = Response(page_gzip, mimetype='text/html')
+            response.headers['Content-Encoding'] = 'gzip'
+            response.set_etag(f'{page_etag}-gz')
+        else:
+            response = Response(page, mimetype='text/html')
+            response.set_etag(page_etag)
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.headers['Cache-Control'] = 'no-cache'
+        return response.make_conditional(request)
+    
+    @app.route('/browse_folder', methods=['POST'])
+    def browse_folder():
+        """Open folder browser dialog and return selected path.
+        
+        The dialog runs in a child process, so Tk never runs on a server
+        thread, and one dialog is open at a time.
+        """
+        if not app.config['BROWSE_DIALOG']:
+            return jsonify({'error': 'The folder dialog is disabled on this server'}), 403
+        if not browse_lock.acquire(blocking=False):
+            return jsonify({'error': 'A folder dialog is already open'}), 409
+        try:
+            folder_path = browse_for_folder()
+            if folder_path:
+                return jsonify({'path': folder_path})
+            else:
+                return jsonify({'error': 'No folder selected'})
+        except Exception as e:
+            return jsonify({'error': str(e)}), 500
+        finally:
+            browse_lock.release()
+    
+    @app.route('/compare', methods=['POST'])
+    def compare():
+        """Compare two directories and return the tree structures."""
+        try:
+            try:
+                options = request_options(request.get_json(silent=True))
+            except RequestError as e:
+                return jsonify({'error': str(e)}), 400
+            # The work runs on the job pool, so it is bounded like /jobs.
+            store = get_job_store()
+            try:
+                job = store.submit(options)
+            except ServerBusy as e:
+                return busy(str(e))
+            job.future.result()
+            store.discard(job.id)
+            if job.state != 'done':
+                return jsonify({'error': job.error or 'Comparison cancelled'}), job.error_status or 500
+            return result_response(job.result, options['differences_only'], options['format'])
+        
+        except Exception as e:
+            import traceback
+            print(f"Error during comparison: {e}")
+            print(traceback.format_exc())
+            return jsonify({'error': str(e)}), 500
+    
+    @app.route('/compare/stream', methods=['POST'])
+    def compare_stream():
+        """Compare two directories and stream diff records as NDJSON."""
+        try:
+            options = request_options(request.get_json(silent=True))
+            if (options['source1'], options['source2']) != ('directory', 'directory'):
+                raise RequestError('Streaming needs two directories')
+        except RequestError as e:
+            return jsonify({'error': str(e)}), 400
+        if not stream_slots.acquire(blocking=False):
+            return busy('Too many streamed comparisons are running; try again later')
+        
+        def generate():
+            try:
+                with make_engine(options) as engine:
+                    started = time.perf_counter()
+                    outcome = 'failed'
+                    try:
+                        yield json.dumps({'event': 'start', 'dir1': options['dir1'], 'dir2': options['dir2'],
+                                          'algorithm': engine.algorithm}, ensure_ascii=False) + '\n'
+                        records = iter_compare(options['dir1'], options['dir2'], engine,
+                                               compute_hash=options['hash_mode'] == 'eager',
+                                               strategy=options['strategy'], escalate=options['escalate'],
+                                               walk_filter=make_walk_filter(options['filters']))
+                        for record in records:
+                            yield json.dumps(record, ensure_ascii=False) + '\n'
+                        yield json.dumps({'event': 'end', 'stats': engine.stats}) + '\n'
+                        outcome = 'done'
+                    finally:
+                        METRICS.observe(engine, outcome, time.perf_counter() - started)
+            except Exception as e:
+                import traceback
+                print(f"Error during streamed comparison: {e}")
+                print(traceback.format_exc())
+                yield json.dumps({'event': 'error', 'error': str(e)}) + '\n'
+        
+        response = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+        response.call_on_close(stream_slots.release)
+        return response
+    
+    @app.route('/jobs', methods=['POST'])
+    def start_job():
+        """Start a comparison in the background and return its job id."""
+        try:
+            options = request_options(request.get_json(silent=True))
+        except RequestError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        try:
+            job = get_job_store().submit(options)
+        except ServerBusy as e:
+            return busy(str(e))
+        return jsonify(job.status()), 202, {'Location': f'/jobs/{job.id}'}
+    
+    @app.route('/jobs/<job_id>', methods=['GET'])
+    def job_status(job_id):
+        """Report the state and progress of a comparison job."""
+        job = get_job_store().get(job_id)
+        if job is None:
+            return jsonify({'error': 'Unknown or expired job'}), 404
+        return jsonify(job.status())
+    
+    @app.route('/jobs/<job_id>/result', methods=['GET'])
+    def job_result(job_id):
+        """Return the result of a finished job, in the same form as /compare."""
+        job = get_job_store().get(job_id)
+        if job is None:
+            return jsonify({'error': 'Unknown or expired job'}), 404
+        if job.state == 'done':
+            response_format = request.args.get('format', job.options['format'])
+            if response_format not in RESPONSE_FORMATS:
+                return jsonify({'error': f'Unknown response format: {response_format}'}), 400
+            return result_response(job.result, job.options['differences_only'], response_format)
+        if job.state == 'failed':
+            return jsonify({'error': job.error}), job.error_status
+        return jsonify({'error': f'Job is {job.state}'}), 409
+    
+    def _finished_index(job_id):
+        """Return (index, None) for a finished job, or (None, error response)."""
+        job = get_job_store().get(job_id)
+        if job is None:
+            return None, (jsonify({'error': 'Unknown or expired job'}), 404)
+        if job.state != 'done':
+            return None, (jsonify({'error': f'Job is {job.state}'}), 409)
+        if job.index is None:
+            return None, (jsonify({'error': 'Incremental results have no tree to browse'}), 409)
+        return job.index, None
+    
+    @app.route('/jobs/<job_id>/children', methods=['GET'])
+    def job_children(job_id):
+        """Return one page of a directory of a finished job, with rollups."""
+        index, error = _finished_index(job_id)
+        if error:
+            return error
+        path = request.args.get('path', '').strip('/')
+        offset = max(0, request.args.get('offset', 0, type=int))
+        limit = min(MAX_PAGE_SIZE, max(1, request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)))
+        differences_only = request.args.get('differences_only', '') in ('1', 'true')
+        page = index.children(path, offset, limit, differences_only)
+        if page is None:
+            return jsonify({'error': f'Not a directory: {path}'}), 404
+        return jsonify(page)
+    
+    @app.route('/jobs/<job_id>/entry', methods=['GET'])
+    def job_entry(job_id):
+        """Return the details of one file or folder of a finished job."""
+        index, error = _finished_index(job_id)
+        if error:
+            return error
+        path = request.args.get('path', '').strip('/')
+        entry = index.entry(path)
+        if entry is None:
+            return jsonify({'error': f'No such entry: {path}'}), 404
+        return jsonify(entry)
+    
+    @app.route('/jobs/<job_id>/diff', methods=['GET'])
+    def job_diff(job_id):
+        """Return one page of the line diff, or the differing byte ranges, of a file pair."""
+        index, error = _finished_index(job_id)
+        if error:
+            return error
+        options = get_job_store().get(job_id).options
+        if (options['source1'], options['source2']) != ('directory', 'directory'):
+            return jsonify({'error': 'Diffs need both trees read from directories'}), 409
+        path = request.args.get('path', '').strip('/')
+        pair = index.pair(path)
+        if pair is None:
+            return jsonify({'error': f'No such entry: {path}'}), 404
+        if any(node is None or node.type != 'file' or node.special for node in pair):
+            return jsonify({'error': f'Not a regular file on both sides: {path}'}), 400
+        try:
+            diff = diff_files(pair[0].path, pair[1].path, parse_diff_options(request.args))
+        except RequestError as e:
+            return jsonify({'error': str(e)}), 400
+        except OSError as e:
+            return jsonify({'error': f'Cannot read {path}: {e}'}), 409
+        return jsonify(dict(diff, path=path))
+    
+    @app.route('/jobs/<job_id>', methods=['DELETE'])
+    def cancel_job(job_id):
+        """Cancel a queued or running comparison job."""
+        job = get_job_store().get(job_id)
+        if job is None:
+            return jsonify({'error': 'Unknown or expired job'}), 404
+        job.cancel()
+        return jsonify(job.status())
+    
+    @app.route('/manifests/export', methods=['POST'])
+    def export_tree_manifest():
+        """Hash one directory and save its digest manifest."""
+        try:
+            data = request.get_json(silent=True)
+            if not isinstance(data, dict):
+                return jsonify({'error': 'Request body must be a JSON object'}), 400
+            root_path = str(data.get('dir') or '').strip()
+            path = str(data.get('path') or '').strip()
+            if not root_path or not path:
+                return jsonify({'error': 'Both dir and path are required'}), 400
+            try:
+                options = request_options(data, parse_engine_options)
+                filters = parse_filter_options(data)
+                path = manifest_path(path)
+            except RequestError as e:
+                return jsonify({'error': str(e)}), 400
+            root_path = normalize_path(root_path)
+            if not os.path.isdir(root_path):
+                return jsonify({'error': f'Directory does not exist: {root_path}'}), 400
+            
+            try:
+                return jsonify(export_tree(root_path, path, options, filters))
+            except RequestError as e:
+                return jsonify({'error': str(e)}), 400
+        except Exception as e:
+            print(f"Error exporting manifest: {e}")
+            return jsonify({'error': str(e)}), 500
+    
+    @app.route('/manifests/compare', methods=['POST'])
+    def compare_tree_manifests():
+        """Compare two digest manifests without touching either directory."""
+        try:
+            data = request.get_json(silent=True)
+            if not isinstance(data, dict):
+                return jsonify({'error': 'Request body must be a JSON object'}), 400
+            paths = [str(data.get(key) or '').strip() for key in ('manifest1', 'manifest2')]
+            if not all(paths):
+                return jsonify({'error': 'Both manifest paths are required'}), 400
+            try:
+                paths = [manifest_path(path) for path in paths]
+            except RequestError as e:
+                return jsonify({'error': str(e)}), 400
+            manifests = []
+            for path in paths:
+                try:
+                    manifests.append(load_tree_manifest(path))
+                except (OSError, ValueError, TypeError) as e:
+                    return jsonify({'error': f'Cannot read manifest {path}: {e}'}), 400
+            manifest1, manifest2 = manifests
+            if manifest1['algorithm'] != manifest2['algorithm']:
+                return jsonify({'error': 'Manifests were hashed with different algorithms'}), 400
+            
+            stats = {'entries_visited': 0, 'subtrees_skipped': 0}
+            differences, rollup = diff_digest_trees(manifest1['tree'], manifest2['tree'], stats)
+            return jsonify({
+                'root1': manifest1['root'],
+                'root2': manifest2['root'],
+                'created1': manifest1['created'],
+                'created2': manifest2['created'],
+                'algorithm': manifest1['algorithm'],
+                'identical': not differences,
+                'rollup': rollup,
+                'differences': differences,
+                'stats': stats
+            })
+        except Exception as e:
+            print(f"Error comparing manifests: {e}")
+            return jsonify({'error': str(e)}), 500
+    
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        """Report cumulative comparison counters in the Prometheus text format."""
+        return Response(METRICS.render(get_job_store().counts()), mimetype='text/plain; version=0.0.4')
+    
+    def hash_cache_info():
+        """Describe the persistent hash cache, reporting it empty rather than creating it."""
+        cache = get_hash_cache(create=False)
+        if cache is None:
+            return {'path': DEFAULT_CACHE_PATH, 'entries': 0, 'max_entries': DEFAULT_CACHE_ENTRIES}
+        return cache.info()
+    
+    @app.route('/cache', methods=['GET'])
+    def cache_info():
+        """Report the location and size of the persistent hash cache and the result cache."""
+        try:
+            return jsonify(dict(hash_cache_info(), results=get_result_cache().info()))
+        except Exception as e:
+            return jsonify({'error': str(e)}), 500
+    
+    @app.route('/cache/clear', methods=['POST'])
+    def cache_clear():
+        """Invalidate every digest in the persistent hash cache and every cached result."""
+        try:
+            cache = get_hash_cache(create=False)
+            if cache is not None:
+                cache.clear()
+            get_result_cache().clear()
+            return jsonify(dict(hash_cache_info(), results=get_result_cache().info()))
+        except Exception as e:
+            return jsonify({'error': str(e)}), 500
+    
+    return app
+
+
+_app = None
+_app_lock = threading.Lock()
+
+
+def get_app():
+    """Return the process-wide Flask application, creating it on first use."""
+    global _app
+    with _app_lock:
+        if _app is None:
+            _app = create_app()
+        return _app
+
+
+def __getattr__(name):
+    # Keep `module.app` working for WSGI servers and scripts without building
+    # the application (and importing Flask) when the module is loaded.
+    if name == 'app':
+        return get_app()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+CLI_CSV_FIELDS = ('pair', 'dir1', 'dir2', 'path', 'status', 'decided_by',
+                  'left_type', 'left_size', 'left_digest', 'right_type', 'right_size', 'right_digest')
+EXIT_SAME = 0
+EXIT_DIFFERENT = 1
+EXIT_ERROR = 2
+
+
+def read_pairs_file(path):
+    """Read directory pairs, one per line with the two paths separated by a tab.
+    
+    Blank lines and lines starting with '#' are skipped. Reads stdin for '-'.
+    """
+    pairs = []
+    with (sys.stdin if path == '-' else open(path, encoding='utf-8')) as f:
+        for number, line in enumerate(f, 1):
+            line = line.rstrip('\r\n')
+            if not line.strip() or line.lstrip().startswith('#'):
+                continue
+            fields = line.split('\t')
+            if len(fields) != 2:
+                raise ValueError(f'{path}:{number}: expected two tab-separated paths')
+            pairs.append((fields[0].strip(), fields[1].strip()))
+    return pairs
+
+
+def iter_comparison_records(tree1, tree2, differences_only=True):
+    """Yield (relative path, node1, node2) for the entries of two compared trees.
+    
+    Parents come before their children and siblings are in name order. With
+    differences_only, entries whose status is 'same' are skipped, together
+    with everything below an identical folder pair.
+    """
+    stack = [('', tree1, tree2)]
+    while stack:
+        rel, node1, node2 = stack.pop()
+        node = node1 or node2
+        if differences_only and node.status == 'same':
+            continue
+        yield rel, node1, node2
+        children1 = {c.name: c for c in (node1 and node1.children or ())}
+        children2 = {c.name: c for c in (node2 and node2.children or ())}
+        for name in sorted(children1.keys() | children2.keys(), reverse=True):
+            stack.append((f'{rel}/{name}' if rel else name, children1.get(name), children2.get(name)))
+
+
+def _compare_pair(data, cancel_event):
+    """Run one comparison for the CLI and return its result with Node trees."""
+    options = parse_compare_options(data)
+    with make_engine(options, cancel_event) as engine:
+        return run_comparison(options, engine)
+
+
+class RecordWriter:
+    """Write CLI comparison records as NDJSON or CSV."""
+    
+    def __init__(self, stream, output_format):
+        self.stream = stream
+        self.output_format = output_format
+        self.csv = None
+        if output_format == 'csv':
+            import csv
+            
+            self.csv = csv.writer(stream, lineterminator='\n')
+            self.csv.writerow(CLI_CSV_FIELDS)
+    
+    def entry(self, pair, dir1, dir2, rel, node1, node2):
+        node = node1 or node2
+        if self.csv is not None:
+            row = [pair, dir1, dir2, rel, node.status, node.decided_by]
+            for side in (node1, node2):
+                if side is None:
+                    row += [None, None, None]
+                else:
+                    row += [side.type, side.size, side.digest.hex() if side.digest else None]
+            self.csv.writerow(row)
+            return
+        record = {'event': 'entry', 'pair': pair, 'path': rel, 'status': node.status}
+        if node.decided_by:
+            record['decided_by'] = node.decided_by
+        record['left'] = _stream_side(node1)
+        record['right'] = _stream_side(node2)
+        self._json(record)
+    
+    def summary(self, record):
+        # CSV carries entries only; summaries go to stderr instead.
+        if self.csv is None:
+            self._json(record)
+        elif record.get('error'):
+            print(f"pair {record['pair']}: error: {record['error']}", file=sys.stderr)
+    
+    def _json(self, record):
+        self.stream.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n')
+
+
+def run_cli(args):
+    """Compare the pairs named on the command line and write their differences.
+    
+    Pairs run concurrently, args.jobs at a time, and each pair's records are
+    written as soon as it finishes, so output is in completion order and
+    every record names its pair. Returns EXIT_SAME when every pair is
+    identical, EXIT_DIFFERENT when any differs and EXIT_ERROR when any
+    pair could not be compared.
+    """
+    pairs = []
+    if args.dir1 or args.dir2:
+        if not (args.dir1 and args.dir2):
+            print('error: give both DIR1 and DIR2, or --pairs', file=sys.stderr)
+            return EXIT_ERROR
+        pairs.append((args.dir1, args.dir2))
+    if args.pairs:
+        try:
+            pairs.extend(read_pairs_file(args.pairs))
+        except (OSError, ValueError) as e:
+            print(f'error: {e}', file=sys.stderr)
+            return EXIT_ERROR
+    if not pairs:
+        print('error: nothing to compare (give DIR1 DIR2 or --pairs FILE)', file=sys.stderr)
+        return EXIT_ERROR
+    
+    base = {
+        'hash_mode': args.hash_mode,
+        'strategy': args.strategy,
+        'algorithm': args.algorithm,
+        'executor': args.executor,
+        'workers': args.workers,
+        'sample_blocks': args.sample_blocks,
+        'escalate': args.escalate,
+        'use_cache': args.use_cache,
+        'detect_moves': args.detect_moves,
+        'find_duplicates': args.find_duplicates,
+        'source1': args.source1,
+        'source2': args.source2,
+        **_filter_data(args),
+    }
+    stream = open(args.output, 'w', encoding='utf-8', newline='') if args.output else sys.stdout
+    try:
+        # Warnings printed while walking must not end up among the records.
+        with contextlib.redirect_stdout(sys.stderr):
+            return _run_pairs(pairs, base, RecordWriter(stream, args.format), args.jobs, not args.all)
+    finally:
+        if args.output:
+            stream.close()
+
+
+def _run_pairs(pairs, base, writer, jobs, differences_only):
+    cancel_event = threading.Event()
+    exit_code = EXIT_SAME
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+    try:
+        futures = {executor.submit(_compare_pair, dict(base, dir1=dir1, dir2=dir2), cancel_event): number
+                   for number, (dir1, dir2) in enumerate(pairs)}
+        for future in concurrent.futures.as_completed(futures):
+            number = futures[future]
+            dir1, dir2 = pairs[number]
+            summary = {'event': 'pair', 'pair': number, 'dir1': dir1, 'dir2': dir2}
+            try:
+                result = future.result()
+            except Exception as e:
+                summary['error'] = str(e)
+                writer.summary(summary)
+                exit_code = EXIT_ERROR
+                continue
+            tree1, tree2 = result['tree1'], result['tree2']
+            for rel, node1, node2 in iter_comparison_records(tree1, tree2, differences_only):
+                writer.entry(number, dir1, dir2, rel, node1, node2)
+            root = tree1 or tree2
+            identical = bool(tree1 and tree2) and root.status == 'same'
+            summary.update(identical=identical, rollup=root.rollup)
+            for key in ('moves', 'copies', 'duplicates'):
+                if key in result:
+                    summary[key] = result[key]
+            summary['stats'] = result['stats']
+            summary['timings'] = result['timings']
+            writer.summary(summary)
+            writer.stream.flush()
+            if not identical and exit_code == EXIT_SAME:
+                exit_code = EXIT_DIFFERENT
+    except KeyboardInterrupt:
+        cancel_event.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+        return 130
+    finally:
+        executor.shutdown(wait=True)
+    return exit_code
+
+
+def is_loopback(host):
+    """Return True if host only accepts connections from this machine."""
+    import ipaddress
+    
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def run_server(host='127.0.0.1', port=5000, debug=False, production=False, threads=16,
+               comparisons=JOB_WORKERS, queue=MAX_QUEUED_JOBS, manifest_dir=None):
+    """Start the web interface; returns the exit status.
+    
+    By default this is Flask's development server. With production, the
+    application is served by waitress (an optional dependency) on threads
+    request threads, and the folder dialog is turned off. In both modes at
+    most comparisons comparisons run at a time, with queue more waiting.
+    The interactive debugger runs code for whoever can reach it, so debug
+    is refused unless the server only listens on a loopback address, and
+    such a server only reads and writes manifests inside manifest_dir.
+    """
+    if debug and not is_loopback(host):
+        print(f'warning: not enabling the debugger on {host}, which other machines can reach',
+              file=sys.stderr)
+        debug = False
+    serve = None
+    if production:
+        try:
+            from waitress import serve
+        except ImportError:
+            print('error: production mode needs waitress (pip install waitress); '
+                  'or run gunicorn -c gunicorn.conf.py wsgi:app', file=sys.stderr)
+            return EXIT_ERROR
+    configure_job_store(workers=comparisons, max_queued=queue)
+    app = get_app()
+    if production or not is_loopback(host):
+        app.config['BROWSE_DIALOG'] = False
+        app.config['RESTRICTED'] = True
+    if manifest_dir:
+        app.config['MANIFEST_DIR'] = manifest_dir
+    
+    print("=" * 70)
+    print("xsukax Directory Tree Comparison Tool")
+    print("=" * 70)
+    print(f"\nStarting server on http://{host}:{port}")
+    print("Press Ctrl+C to stop the server\n")
+    if serve is not None:
+        serve(app, host=host, port=port, threads=threads)
+    else:
+        app.run(debug=debug, host=host, port=port, threaded=True)
+    return 0
+
+
+def _add_filter_arguments(parser):
+    parser.add_argument('--include', action='append', default=[], metavar='GLOB',
+                        help='only compare files matching this pattern (repeatable)')
+    parser.add_argument('--exclude', action='append', default=[], metavar='PATTERN',
+                        help='skip entries matching this gitignore-style pattern (repeatable)')
+    parser.add_argument('--gitignore', action='store_true', help='honour .gitignore files in the trees')
+    parser.add_argument('--max-depth', type=int, help='list folders at most this many levels deep')
+    parser.add_argument('--min-size', type=int, help='skip files smaller than this many bytes')
+    parser.add_argument('--max-size', type=int, help='skip files larger than this many bytes')
+
+
+def _filter_data(args):
+    """The request body keys of the filter arguments (see _add_filter_arguments)."""
+    return {key: getattr(args, key) for key in
+            ('include', 'exclude', 'gitignore', 'max_depth', 'min_size', 'max_size')}
+
+
+def run_export(args):
+    """Export the digest manifest of one directory and print its summary as JSON."""
+    data = {'algorithm': args.algorithm, 'executor': args.executor, 'workers': args.workers,
+            'use_cache': args.use_cache, **_filter_data(args)}
+    try:
+        options = parse_engine_options(data)
+        filters = parse_filter_options(data)
+        root_path = normalize_path(args.dir)
+        if not os.path.isdir(root_path):
+            raise RequestError(f'Directory does not exist: {root_path}')
+        with contextlib.redirect_stdout(sys.stderr):
+            summary = export_tree(root_path, args.output, options, filters)
+    except (RequestError, OSError) as e:
+        print(f'error: {e}', file=sys.stderr)
+        return EXIT_ERROR
+    except KeyboardInterrupt:
+        return 130
+    print(json.dumps(summary, ensure_ascii=False))
+    return 0
+
+
+def build_arg_parser():
+    """Describe the command line: 'serve' (the default), 'compare' or 'export'."""
+    import argparse
+    
+    parser = argparse.ArgumentParser(description='Compare two directory trees in detail.')
+    commands = parser.add_subparsers(dest='command')
+    
+    serve = commands.add_parser('serve', help='start the web interface (default)')
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=5000)
+    serve.add_argument('--debug', action='store_true',
+                       help="Flask's debugger and reloader (loopback hosts only)")
+    serve.add_argument('--production', action='store_true',
+                       help='serve with waitress instead of the development server')
+    serve.add_argument('--threads', type=int, default=16, help='request threads in production mode')
+    serve.add_argument('--comparisons', type=int, default=JOB_WORKERS,
+                       help='comparisons run at the same time')
+    serve.add_argument('--queue', type=int, default=MAX_QUEUED_JOBS,
+                       help='comparisons waiting before requests are refused with 503')
+    serve.add_argument('--manifest-dir', metavar='DIR',
+                       help='where clients of a production or non-loopback server may read and write '
+                            'manifests and archives (otherwise they cannot)')
+    
+    compare = commands.add_parser(
+        'compare', help='compare directory pairs without the web interface',
+        description='Compare directory pairs and write their differences as NDJSON or CSV. '
+                    'Exit status is 0 when every pair is identical, 1 when any differs '
+                    'and 2 when any pair could not be compared.')
+    compare.add_argument('dir1', nargs='?')
+    compare.add_argument('dir2', nargs='?')
+    compare.add_argument('--source1', choices=TREE_SOURCES, default='directory',
+                         help='what DIR1 (the first path of each pair) names')
+    compare.add_argument('--source2', choices=TREE_SOURCES, default='directory',
+                         help='what DIR2 (the second path of each pair) names')
+    compare.add_argument('--pairs', metavar='FILE',
+                         help="file of tab-separated directory pairs, one per line ('-' for stdin)")
+    compare.add_argument('--jobs', '-j', type=int, default=min(4, os.cpu_count() or 1),
+                         help='pairs compared at the same time')
+    compare.add_argument('--format', choices=('ndjson', 'csv'), default='ndjson')
+    compare.add_argument('--output', '-o', metavar='FILE', help='write records here instead of stdout')
+    compare.add_argument('--all', action='store_true', help='also list identical entries')
+    compare.add_argument('--hash-mode', choices=HASH_MODES, default='lazy')
+    compare.add_argument('--strategy', choices=STRATEGIES, default='full')
+    compare.add_argument('--algorithm', choices=sorted(HASH_ALGORITHMS), default=DEFAULT_ALGORITHM)
+    compare.add_argument('--executor', choices=EXECUTORS, default='thread')
+    compare.add_argument('--workers', type=int, help='hashing workers per pair')
+    compare.add_argument('--sample-blocks', type=int, default=DEFAULT_SAMPLE_BLOCKS)
+    compare.add_argument('--escalate', action='store_true')
+    compare.add_argument('--use-cache', action='store_true')
+    compare.add_argument('--detect-moves', action='store_true',
+                         help='match one-sided files by content (NDJSON pair records)')
+    compare.add_argument('--find-duplicates', action='store_true',
+                         help='list duplicate files within each tree (NDJSON pair records)')
+    _add_filter_arguments(compare)
+    
+    export = commands.add_parser(
+        'export', help='hash one directory into a digest manifest',
+        description='Hash one directory and save its digest manifest, to compare it later '
+                    'on another host with compare --source1/--source2 manifest.')
+    export.add_argument('dir')
+    export.add_argument('--output', '-o', metavar='FILE', required=True, help='manifest file to write')
+    export.add_argument('--algorithm', choices=sorted(HASH_ALGORITHMS), default=DEFAULT_ALGORITHM)
+    export.add_argument('--executor', choices=EXECUTORS, default='thread')
+    export.add_argument('--workers', type=int, help='hashing workers')
+    export.add_argument('--use-cache', action='store_true')
+    _add_filter_arguments(export)
+    return parser
+
+
+def main(argv=None):
+    """Run the command line; returns the process exit status."""
+    args = build_arg_parser().parse_args(argv)
+    if args.command == 'compare':
+        if args.jobs < 1:
+            print('error: --jobs must be at least 1', file=sys.stderr)
+            return EXIT_ERROR
+        return run_cli(args)
+    if args.command == 'export':
+        return run_export(args)
+    if args.command == 'serve':
+        if args.threads < 1 or args.comparisons < 1 or args.queue < 0:
+            print('error: --threads and --comparisons must be at least 1, --queue at least 0',
+                  file=sys.stderr)
+            return EXIT_ERROR
+        return run_server(args.host, args.port, args.debug, args.production, args.threads,
+                          args.comparisons, args.queue, args.manifest_dir)
+    return run_server()
+
+
+if __name__ == '__main__':
+    sys.exit(main())